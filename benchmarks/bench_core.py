@@ -0,0 +1,135 @@
+"""Measure what non-GUI consumers pay for the EZ Switch core and CLI
+
+Each measurement runs in a fresh interpreter so nothing is already imported:
+
+    python benchmarks/bench_core.py [--runs 10]
+
+Reports import time and allocated memory of ezswitch_core, checks that it
+pulls in neither tkinter nor the win32 modules, times a cold
+'ezswitch_cli.py status' against a temporary settings.json, and times the
+same command forwarded to a resident 'ezswitch serve' instance.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# Run inside the child interpreter; tracemalloc slows imports, so time and memory are separate probes
+TIME_PROBE = """
+import sys, time
+start = time.perf_counter()
+import ezswitch_core
+elapsed = time.perf_counter() - start
+gui_modules = sorted(m for m in sys.modules if m.split('.')[0] in ('tkinter', '_tkinter', 'win32gui', 'win32con'))
+print(repr((elapsed, gui_modules)))
+"""
+MEMORY_PROBE = """
+import tracemalloc
+tracemalloc.start()
+import ezswitch_core
+print(repr(tracemalloc.get_traced_memory()))
+"""
+
+def run_probe(probe):
+    output = subprocess.run([sys.executable, "-c", probe], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    return eval(output)
+
+def measure_import(runs):
+    """Return per-run (seconds, bytes_retained, bytes_peak, gui_modules) for importing the core"""
+    results = []
+    for _ in range(runs):
+        elapsed, gui_modules = run_probe(TIME_PROBE)
+        current, peak = run_probe(MEMORY_PROBE)
+        results.append((elapsed, current, peak, gui_modules))
+    return results
+
+def measure_cli(runs):
+    """Return wall-clock seconds for cold 'status' runs and for a bare interpreter"""
+    with tempfile.TemporaryDirectory() as tmp:
+        settings_file = Path(tmp) / "settings.json"
+        settings_file.write_text(json.dumps({'env': {}}))
+        command = [sys.executable, str(REPO_DIR / "ezswitch_cli.py"), "--settings-file", str(settings_file), "status"]
+
+        cli_times, bare_times = [], []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, capture_output=True, check=True)
+            cli_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"], capture_output=True, check=True)
+            bare_times.append(time.perf_counter() - start)
+    return cli_times, bare_times
+
+def measure_resident(runs):
+    """Return (in-process IPC round trips, forwarded cold CLI runs) in seconds against 'ezswitch serve'"""
+    sys.path.insert(0, str(REPO_DIR))
+    import ezswitch_ipc
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_dir = Path(tmp) / "config"
+        settings_file = Path(tmp) / "settings.json"
+        settings_file.write_text(json.dumps({'env': {}}))
+        server = subprocess.Popen([sys.executable, str(REPO_DIR / "ezswitch_cli.py"), "--config-dir", str(config_dir), "serve"],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            server.stdout.readline()  # "listening on ..."
+            argv = ["--settings-file", str(settings_file), "status"]
+            round_trips = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                reply = ezswitch_ipc.send_request({'command': 'cli', 'argv': argv, 'cwd': tmp}, config_dir)
+                round_trips.append(time.perf_counter() - start)
+                if not reply or not reply.get('ok'):
+                    raise RuntimeError(f"Resident instance did not answer: {reply}")
+
+            forwarded = []
+            command = [sys.executable, str(REPO_DIR / "ezswitch_cli.py"), "--config-dir", str(config_dir)] + argv
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(command, capture_output=True, check=True)
+                forwarded.append(time.perf_counter() - start)
+        finally:
+            server.terminate()
+            server.wait()
+    return round_trips, forwarded
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    # Warm the bytecode cache so we measure steady-state startup
+    subprocess.run([sys.executable, "-m", "compileall", "-q", "ezswitch_core.py", "ezswitch_cli.py"],
+                   cwd=REPO_DIR, check=False, env=dict(os.environ, PYTHONDONTWRITEBYTECODE=""))
+
+    imports = measure_import(args.runs)
+    import_ms = statistics.median(r[0] for r in imports) * 1000
+    retained_kib = statistics.median(r[1] for r in imports) / 1024
+    peak_kib = statistics.median(r[2] for r in imports) / 1024
+    gui_modules = sorted({m for r in imports for m in r[3]})
+
+    cli_times, bare_times = measure_cli(args.runs)
+    cli_ms = statistics.median(cli_times) * 1000
+    bare_ms = statistics.median(bare_times) * 1000
+
+    round_trips, forwarded = measure_resident(args.runs)
+
+    print(f"ezswitch_core import:  {import_ms:.1f} ms (median of {args.runs})")
+    print(f"ezswitch_core memory:  {retained_kib:.0f} KiB retained, {peak_kib:.0f} KiB peak")
+    print(f"GUI modules imported:  {', '.join(gui_modules) if gui_modules else 'none'}")
+    print(f"CLI 'status' cold run: {cli_ms:.1f} ms (bare interpreter {bare_ms:.1f} ms, overhead {cli_ms - bare_ms:.1f} ms)")
+    print(f"Resident IPC round trip: {statistics.median(round_trips) * 1000:.2f} ms; "
+          f"forwarded CLI 'status': {statistics.median(forwarded) * 1000:.1f} ms")
+    return 1 if gui_modules else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Measure time-to-first-paint of the EZ Switch window
+
+Each run starts a fresh interpreter with HOME pointed at an empty temporary
+directory, so the real config.json and settings.json are never touched:
+
+    python benchmarks/bench_gui.py [--runs 10] [--repo-dir PATH]
+
+Reports the time from interpreter start to the first fully processed frame
+(window built, idle tasks and pending paints flushed) and how many widgets
+exist at that point. Point --repo-dir at a checkout of an older revision
+(e.g. 'git worktree add /tmp/before <rev>') to compare before and after.
+Needs a display.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# Run inside the child interpreter; the font cache is left alone so repeated runs are warm
+PAINT_PROBE = """
+import time
+start = time.perf_counter()
+import tkinter as tk
+import ezswitch
+root = tk.Tk()
+app = ezswitch.ClaudeConfigSwitcher(root)
+root.update()
+elapsed = time.perf_counter() - start
+widgets, stack = 0, [root]
+while stack:
+    widget = stack.pop()
+    widgets += 1
+    stack.extend(widget.winfo_children())
+app.close_application()
+print(repr((elapsed, widgets)))
+"""
+
+def measure_first_paint(repo_dir, runs):
+    """Return per-run (seconds, widget_count) for building and painting the main window"""
+    results = []
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, "-c", PAINT_PROBE], cwd=repo_dir, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            results.append(eval(output.strip().splitlines()[-1]))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--repo-dir", type=Path, default=REPO_DIR)
+    args = parser.parse_args()
+
+    # Warm the bytecode cache so we measure steady-state startup
+    subprocess.run([sys.executable, "-m", "compileall", "-q", "."],
+                   cwd=args.repo_dir, check=False, env=dict(os.environ, PYTHONDONTWRITEBYTECODE=""))
+
+    results = measure_first_paint(args.repo_dir, args.runs)
+    paint_ms = statistics.median(r[0] for r in results) * 1000
+    widgets = results[-1][1]
+
+    print(f"Time to first paint: {paint_ms:.1f} ms (median of {args.runs})")
+    print(f"Widgets at first paint: {widgets}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""Measure what the local proxy adds to a streamed Claude Code request
+
+Runs a throwaway upstream and the proxy in this process against a temporary
+config.json, so nothing under the home directory is touched:
+
+    python benchmarks/bench_proxy.py [--runs 200] [--upload-mb 8 64] [--workers 1 4]
+
+Reports the added time-to-first-token (first SSE event through the proxy
+minus the same request sent straight to the upstream on a new connection;
+the proxy reuses its warm upstream connections) and the proxy's peak
+traced memory while relaying request bodies of different sizes; the peak
+should not grow with the body.
+
+With --workers it also measures requests per second through 'ezswitch proxy
+--workers N' for each N, driven by --clients keep-alive client processes
+against an upstream served from as many processes as there are cores (POSIX
+only). Throughput should grow roughly with N up to the number of cores.
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+import ezswitch_core as core
+import ezswitch_proxy
+
+BLOCK = memoryview(b'x' * 65536)
+FIRST_EVENT = b'event: message_start\ndata: {"type": "message_start"}\n\n'
+
+def read_request(conn, sink):
+    """Read one request head and discard its Content-Length body into sink
+
+    Returns None at EOF, else whether the client keeps the connection open.
+    """
+    head = b''
+    while b'\r\n\r\n' not in head:
+        data = conn.recv(4096)
+        if not data:
+            return None
+        head += data
+    head, _, body = head.partition(b'\r\n\r\n')
+    length, keep_alive = 0, True
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            keep_alive = value.strip().lower() != b'close'
+    length -= len(body)
+    while length > 0:
+        received = conn.recv_into(sink, min(len(sink), length))
+        if not received:
+            return None
+        length -= received
+    return keep_alive
+
+def serve_connection(conn):
+    """Answer each request with a short SSE stream until the client closes"""
+    sink = bytearray(65536)
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            keep_alive = read_request(conn, sink)
+            if keep_alive is None:
+                return
+            conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n')
+            conn.sendall(b'%x\r\n%s\r\n' % (len(FIRST_EVENT), FIRST_EVENT))
+            conn.sendall(b'0\r\n\r\n')
+            if not keep_alive:
+                return
+
+def serve_upstream(listener):
+    """Serve every upstream connection on its own thread (the proxy keeps its connections open)"""
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+def timed_request(port, body_size=2, token=None):
+    """Send one POST (body streamed from a reused block) and return seconds to the first SSE event"""
+    head = (f"POST /v1/messages HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {body_size}\r\n"
+            f"Content-Type: application/json\r\nConnection: close\r\n"
+            + (f"Authorization: Bearer {token}\r\n" if token else "") + "\r\n").encode()
+    with socket.create_connection(('127.0.0.1', port)) as conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.perf_counter()
+        conn.sendall(head)
+        remaining = body_size
+        while remaining:
+            block = BLOCK[:min(len(BLOCK), remaining)]
+            conn.sendall(block)
+            remaining -= len(block)
+        received = b''
+        while b'message_start' not in received:
+            data = conn.recv(65536)
+            if not data:
+                raise RuntimeError(f"No SSE event received: {received[:200]!r}")
+            received += data
+        elapsed = time.perf_counter() - start
+        while conn.recv(65536):
+            pass
+    return elapsed
+
+def keep_alive_client(port, token, requests, start):
+    """Send requests back to back over one connection once start is set (throughput client process)"""
+    request = (f"POST /v1/messages HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 2\r\n"
+               f"Content-Type: application/json\r\nAuthorization: Bearer {token}\r\n\r\n{{}}").encode()
+    start.wait()
+    with socket.create_connection(('127.0.0.1', port)) as conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(requests):
+            conn.sendall(request)
+            received = b''
+            while not received.endswith(b'0\r\n\r\n'):
+                data = conn.recv(65536)
+                if not data:
+                    raise RuntimeError(f"Proxy closed the connection: {received[:200]!r}")
+                received += data
+
+def measure_throughput(config_file, workers, clients, requests):
+    """Requests per second through run_workers(workers) with clients concurrent keep-alive connections"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    context = multiprocessing.get_context('fork')
+    proxy = context.Process(target=ezswitch_proxy.run_workers, args=(config_file, '127.0.0.1', port, workers))
+    proxy.start()
+    try:
+        deadline = time.perf_counter() + 10
+        while ezswitch_proxy.proxy_health(port) is None:
+            if time.perf_counter() > deadline:
+                raise RuntimeError("Proxy workers did not start")
+            time.sleep(0.05)
+        start = context.Event()
+        processes = [context.Process(target=keep_alive_client, args=(port, "bench-token", requests, start))
+                     for _ in range(clients)]
+        for process in processes:
+            process.start()
+        began = time.perf_counter()
+        start.set()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - began
+    finally:
+        proxy.terminate()
+        proxy.join()
+    return clients * requests / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--upload-mb", type=int, nargs="+", default=[8, 64])
+    parser.add_argument("--workers", type=int, nargs="+", default=[],
+                        help="Proxy worker counts to measure throughput with")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per client in the throughput runs")
+    args = parser.parse_args()
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    upstream_port = listener.getsockname()[1]
+    threading.Thread(target=serve_upstream, args=(listener,), daemon=True).start()
+    # Throughput runs need an upstream that is not limited to this process
+    upstream_processes = []
+    if args.workers:
+        context = multiprocessing.get_context('fork')
+        upstream_processes = [context.Process(target=serve_upstream, args=(listener,), daemon=True)
+                              for _ in range(os.cpu_count() or 1)]
+        for process in upstream_processes:
+            process.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = Path(tmp) / "config.json"
+        store = core.ConfigStore(config_file, legacy_path=config_file)
+        store.update(custom_url=f"http://127.0.0.1:{upstream_port}", custom_key="upstream-key",
+                     proxy_upstream="custom", proxy_token="bench-token")
+        store.save()
+        proxy = ezswitch_proxy.ProxyServer(config_file, port=0).start_in_thread()
+        proxy_port = proxy._server.sockets[0].getsockname()[1]
+        try:
+            # Warm up both paths (config load, bytecode, socket setup)
+            for _ in range(10):
+                timed_request(upstream_port)
+                timed_request(proxy_port, token="bench-token")
+
+            direct = [timed_request(upstream_port) for _ in range(args.runs)]
+            proxied = [timed_request(proxy_port, token="bench-token") for _ in range(args.runs)]
+            direct_ms = statistics.median(direct) * 1000
+            proxied_ms = statistics.median(proxied) * 1000
+
+            peaks = []
+            for size_mb in args.upload_mb:
+                tracemalloc.start()
+                timed_request(proxy_port, size_mb * 1024 * 1024, token="bench-token")
+                peaks.append((size_mb, tracemalloc.get_traced_memory()[1]))
+                tracemalloc.stop()
+        finally:
+            proxy.stop()
+
+        throughput = [(workers, measure_throughput(config_file, workers, args.clients, args.requests))
+                      for workers in args.workers]
+        for process in upstream_processes:
+            process.terminate()
+        listener.close()
+
+    print(f"Time to first SSE event: direct {direct_ms:.3f} ms, via proxy {proxied_ms:.3f} ms "
+          f"(added {proxied_ms - direct_ms:.3f} ms, median of {args.runs})")
+    for size_mb, peak in peaks:
+        print(f"Peak traced memory relaying a {size_mb} MiB request body: {peak / 1024:.0f} KiB")
+    for workers, rate in throughput:
+        print(f"Throughput with {workers} proxy worker(s): {rate:.0f} requests/s "
+              f"({args.clients} clients x {args.requests} requests, {os.cpu_count()} cores)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
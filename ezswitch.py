@@ -1,17 +1,25 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
+import copy
 import subprocess
 import os
 import sys
 import threading
 import json
+import time
 from pathlib import Path
-import platform
 
-# Platform detection and module imports
-IS_WINDOWS = platform.system() == "Windows"
-IS_LINUX = platform.system() == "Linux"
-IS_MACOS = platform.system() == "Darwin"
+# Settings/config logic shared with the headless CLI
+from ezswitch_core import (
+    IS_WINDOWS, IS_LINUX, IS_MACOS,
+    CONFIG_DIR, CONFIG_FILE, CLAUDE_SETTINGS_DIR, CLAUDE_SETTINGS_FILE, AVAILABLE_MODELS,
+    settings_cache, SettingsTransaction, SettingsWatcher, ConfigStore, atomic_write_json,
+    ZaiProfile, ClaudeSubscriptionProfile, ClaudeApiProfile, CustomProfile,
+    PROXY_UPSTREAMS, DEFAULT_PROXY_PORT, KEY_STRATEGIES, MODEL_TIERS, proxy_profile, proxy_base_url, stored_profile, detect_profile,
+    read_claude_settings, apply_settings_delta, apply_profile, describe_status, format_timings,
+)
+from ezswitch_ipc import ResidentServer, send_request
+import ezswitch_cli
 
 # Try to import Windows-specific modules
 try:
@@ -36,6 +44,50 @@ class FontManager:
         self.available_font = None
         self._font_detection_attempted = False
         self.scaling_factor = 1.0
+        # Resolved font is cached on disk so later launches skip font enumeration
+        self.cache_file = CONFIG_DIR / "font_cache.json"
+
+    def _font_directories(self):
+        """Font and fontconfig cache directories whose mtimes change when fonts are (un)installed"""
+        home = Path.home()
+        if IS_LINUX:
+            return [home / ".cache" / "fontconfig", Path("/var/cache/fontconfig"),
+                    Path("/usr/share/fonts"), Path("/usr/local/share/fonts"),
+                    home / ".local" / "share" / "fonts", home / ".fonts"]
+        elif IS_MACOS:
+            return [Path("/System/Library/Fonts"), Path("/Library/Fonts"), home / "Library" / "Fonts"]
+        else:
+            windir = os.environ.get("WINDIR", r"C:\Windows")
+            local_appdata = os.environ.get("LOCALAPPDATA", str(home / "AppData" / "Local"))
+            return [Path(windir) / "Fonts", Path(local_appdata) / "Microsoft" / "Windows" / "Fonts"]
+
+    def font_fingerprint(self):
+        """Fingerprint of the installed fonts, the Tk version and our font preferences"""
+        parts = [sys.platform, str(tk.TkVersion), self.primary_font] + self.fallback_fonts
+        for directory in self._font_directories():
+            try:
+                parts.append(f"{directory}:{os.stat(directory).st_mtime_ns}")
+            except OSError:
+                parts.append(f"{directory}:missing")
+        return "|".join(parts)
+
+    def _load_cached_font(self, fingerprint):
+        """Return the font resolved on a previous run if the fonts have not changed since"""
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('fingerprint') == fingerprint:
+                return cached.get('font')
+        except (OSError, ValueError, AttributeError):
+            pass
+        return None
+
+    def _save_cached_font(self, fingerprint, font):
+        try:
+            self.cache_file.parent.mkdir(exist_ok=True)
+            atomic_write_json(self.cache_file, {'fingerprint': fingerprint, 'font': font}, indent=2, fsync=False)
+        except OSError:
+            pass
 
     def get_available_font(self):
         """Get the best available font, preferring Poppins"""
@@ -58,20 +110,26 @@ class FontManager:
             except:
                 pass
 
-            # Get list of available font families
-            available_fonts = tkfont.families()
-
-            # Check if Poppins is available
-            if self.primary_font in available_fonts:
-                self.available_font = self.primary_font
+            # Reuse the result of a previous enumeration while the installed fonts are unchanged
+            fingerprint = self.font_fingerprint()
+            cached_font = self._load_cached_font(fingerprint)
+            if cached_font:
+                self.available_font = cached_font
                 return self.available_font
 
-            # Check fallback fonts in order of preference
-            for font in self.fallback_fonts:
+            # Get list of available font families
+            available_fonts = set(tkfont.families())
+
+            # Check if Poppins is available, then fallback fonts in order of preference
+            for font in [self.primary_font] + self.fallback_fonts:
                 if font in available_fonts:
                     self.available_font = font
+                    self._save_cached_font(fingerprint, font)
                     return self.available_font
 
+            # Remember that none of the preferred fonts is installed
+            self._save_cached_font(fingerprint, "TkDefaultFont")
+
         except Exception:
             pass
         finally:
@@ -108,9 +166,27 @@ class FontManager:
 font_manager = FontManager()
 
 class ClaudeConfigSwitcher:
-    def __init__(self, root):
+    # Display names of the stored profiles the proxy can forward to
+    proxy_upstream_labels = {'zai': "Z.ai", 'api': "Claude API Key", 'custom': "Custom"}
+
+    # Settings panel repaints are coalesced to at most one per frame (~60 Hz)
+    RENDER_INTERVAL_MS = 16
+
+    # Success dialog text per profile kind
+    success_messages = {
+        'zai': "Z.ai configuration applied successfully!\n\nClaude Code settings.json updated.",
+        'subscription': ("Claude Subscription configuration applied successfully!\n\n"
+                         "All settings cleared from Claude Code settings.json to use your official Claude subscription."),
+        'api': "Claude API configuration applied successfully!\n\nClaude Code settings.json updated.",
+        'custom': "Custom configuration applied successfully!\n\nClaude Code settings.json updated.",
+        'proxy': "Proxy configuration applied successfully!\n\nClaude Code settings.json points at the local EZ Switch proxy."
+    }
+
+    def __init__(self, root, resident=False):
         self.root = root
         self.root.title("")
+        self.resident = resident
+        self.resident_server = None
 
         # Platform-specific window settings
         if IS_LINUX:
@@ -146,13 +222,22 @@ class ClaudeConfigSwitcher:
         self.set_window_style()
 
         # Path for storing API keys persistently
-        self.config_dir = Path.home() / ".claude_ez_switch"
+        self.config_dir = CONFIG_DIR
         self.config_dir.mkdir(exist_ok=True)
-        self.config_file = self.config_dir / "config.json"
+        self.config_file = CONFIG_FILE
+        self.config_store = ConfigStore(self.config_file)
+        # Widget values as last loaded into or copied to the store (see sync_config_store)
+        self.synced_config = {}
         
         # Path for Claude Code settings.json
-        self.claude_settings_dir = Path.home() / ".claude"
-        self.claude_settings_file = self.claude_settings_dir / "settings.json"
+        self.claude_settings_dir = CLAUDE_SETTINGS_DIR
+        self.claude_settings_file = CLAUDE_SETTINGS_FILE
+
+        # Coalesced settings panel repaints (see schedule_settings_render)
+        self._render_job = None
+        self._render_settings = None
+        self._render_adjust_height = False
+        self._label_texts = {}
         
         # Configure style
         style = ttk.Style()
@@ -222,12 +307,26 @@ class ClaudeConfigSwitcher:
         self.on_config_change()
         self.on_claude_mode_change()
         self.check_current_status()
+
+        # Keep status and settings panel in sync with edits made by Claude Code or other tools
+        self.settings_watcher = SettingsWatcher(self.claude_settings_file,
+                                                self._on_settings_file_changed,
+                                                self.get_claude_settings).start()
+
+        # Claude Code sessions routed through the local proxy need it running while we are open
+        self.proxy_server = None
+        if detect_profile(self.get_claude_settings().get('env') or {}, self.config_store) == 'proxy':
+            threading.Thread(target=self.ensure_proxy_running, daemon=True).start()
         
         # Set up focus management for Linux
         if IS_LINUX:
             # Schedule focus setup after window is fully displayed
             self.root.after(1000, self.setup_linux_focus)
 
+        # In resident mode closing the window only hides it; the process keeps serving IPC
+        if self.resident:
+            self.root.protocol("WM_DELETE_WINDOW", self.root.withdraw)
+
     def set_window_style(self):
         """Set window styles for borderless window with shadow (platform-specific)"""
         if IS_WINDOWS and WIN32_AVAILABLE:
@@ -478,6 +577,7 @@ class ClaudeConfigSwitcher:
         config_label.pack(anchor=tk.W, pady=(0, 10))
         
         self.config_var = tk.StringVar(value="zai")
+        self.create_provider_state()
         
         # Configuration radio buttons container
         radio_container = tk.Frame(content_frame, bg=self.bg_color)
@@ -488,6 +588,7 @@ class ClaudeConfigSwitcher:
             self.create_custom_radio_button(radio_container, "Z.ai", "zai")
             self.create_custom_radio_button(radio_container, "Claude", "claude")
             self.create_custom_radio_button(radio_container, "Custom", "custom")
+            self.create_custom_radio_button(radio_container, "Proxy", "proxy")
         else:
             # Use standard ttk radio buttons for other platforms
             # Create radio buttons horizontally
@@ -504,19 +605,20 @@ class ClaudeConfigSwitcher:
             custom_radio = ttk.Radiobutton(radio_container, text="Custom",
                                           variable=self.config_var, value="custom",
                                           command=self.on_config_change, style='TRadiobutton')
-            custom_radio.pack(side=tk.LEFT)
+            custom_radio.pack(side=tk.LEFT, padx=(0, 20))
+
+            proxy_radio = ttk.Radiobutton(radio_container, text="Proxy",
+                                          variable=self.config_var, value="proxy",
+                                          command=self.on_config_change, style='TRadiobutton')
+            proxy_radio.pack(side=tk.LEFT)
         
         # Dynamic configuration container (where different configs will be shown)
         self.dynamic_config_container = tk.Frame(content_frame, bg=self.bg_color)
         self.dynamic_config_container.pack(fill=tk.BOTH, expand=False)
         
-        # Create all configuration frames but don't pack them yet
-        self.create_zai_frame()
-        self.create_claude_frame()
-        self.create_custom_frame()
+        # Configuration frames are built on first selection in on_config_change
 
         # Show/Hide Password Checkbutton
-        self.show_password_var = tk.BooleanVar()
         show_password_check = tk.Checkbutton(content_frame, text="Show API Keys",
                                            variable=self.show_password_var,
                                            command=self.toggle_password_visibility,
@@ -799,33 +901,30 @@ class ClaudeConfigSwitcher:
         """Set up proper focus handling for Linux"""
         try:
             # Enhanced focus setup for Linux to ensure input fields work
+            self._linux_focus_ready = True
+
+            # Set up the entry fields of every frame built so far; later frames are set up when built
+            for frame in self.provider_frames.values():
+                for entry in self._frame_entries(frame):
+                    entry.focus_set()
+                    self._bind_linux_entry_focus(entry)
+
+            # Set initial focus to zai_key_entry after a short delay
             if hasattr(self, 'zai_key_entry'):
-                # Set up all entry fields for proper focus
-                entry_fields = [
-                    self.zai_key_entry,
-                    self.zai_key_name_entry,
-                    self.claude_key_entry,
-                    self.custom_url_entry,
-                    self.custom_key_entry
-                ]
-                
-                for entry in entry_fields:
-                    if entry:
-                        # Ensure entry is enabled and can receive focus
-                        if entry.cget('state') == tk.DISABLED:
-                            entry.configure(state=tk.NORMAL)
-                        # Set focus and ensure cursor is at end
-                        entry.focus_set()
-                        entry.icursor(tk.END)
-                        # Bind additional events to ensure focus works
-                        entry.bind('<FocusIn>', lambda e, widget=entry: widget.icursor(tk.END))
-                        entry.bind('<Button-1>', lambda e, widget=entry: self._ensure_entry_focus(widget))
-                        
-                # Set initial focus to zai_key_entry after a short delay
                 self.root.after(200, lambda: self._ensure_entry_focus(self.zai_key_entry))
-                 
+
         except Exception:
             pass
+
+    def _bind_linux_entry_focus(self, entry):
+        """Make sure a Linux entry field is enabled and keeps its cursor on focus"""
+        # Ensure entry is enabled and can receive focus
+        if entry.cget('state') == tk.DISABLED:
+            entry.configure(state=tk.NORMAL)
+        entry.icursor(tk.END)
+        # Bind additional events to ensure focus works
+        entry.bind('<FocusIn>', lambda e, widget=entry: widget.icursor(tk.END))
+        entry.bind('<Button-1>', lambda e, widget=entry: self._ensure_entry_focus(widget))
     
     def _ensure_entry_focus(self, entry):
         """Helper method to ensure an entry field has proper focus"""
@@ -844,6 +943,66 @@ class ClaudeConfigSwitcher:
         except Exception:
             pass
     
+    def create_provider_state(self):
+        """Create the variables behind the configuration frames; the frames themselves are built lazily"""
+        # Entry contents live in variables so loading and saving work before a frame exists
+        self.zai_key_var = tk.StringVar()
+        self.zai_key_value_var = tk.StringVar()
+        self.zai_key_name_var = tk.StringVar()
+        self.zai_opus_model_var = tk.StringVar(value="GLM-4.7")
+        self.zai_sonnet_model_var = tk.StringVar(value="GLM-4.7")
+        self.zai_haiku_model_var = tk.StringVar(value="GLM-4.7")
+        self.claude_mode_var = tk.StringVar(value="subscription")
+        self.claude_key_var = tk.StringVar()
+        self.custom_url_var = tk.StringVar()
+        self.custom_key_var = tk.StringVar()
+        self.proxy_upstream_var = tk.StringVar(value=self.proxy_upstream_labels['zai'])
+        self.proxy_port_var = tk.StringVar(value=str(DEFAULT_PROXY_PORT))
+        self.proxy_key_strategy_var = tk.StringVar(value=KEY_STRATEGIES[0])
+        self.proxy_key_pool = []  # Z.ai key names the proxy rotates across
+        # Per-tier proxy routes; "Default" follows the upstream above
+        self.proxy_tier_route_vars = {tier: tk.StringVar(value="Default") for tier in MODEL_TIERS}
+        self.proxy_saved_routes = []
+        self.proxy_hedge_var = tk.StringVar(value="Off")
+        self.proxy_saved_hedge = {}
+        self.proxy_failover_var = tk.StringVar(value="Off")
+        self.proxy_saved_failover = {}
+        self.proxy_concurrency_var = tk.StringVar()
+        self.show_password_var = tk.BooleanVar()
+
+        # Define available GLM models
+        self.available_models = AVAILABLE_MODELS
+
+        # Initialize storage for multiple keys (shared with the config store)
+        self.zai_keys = self.config_store.zai_keys  # Format: {"name": "key"}
+        self.current_zai_key_name = None
+
+        # Frames built so far and the builder for each configuration
+        self.provider_frames = {}
+        self.provider_frame_builders = {
+            "zai": self.create_zai_frame,
+            "claude": self.create_claude_frame,
+            "custom": self.create_custom_frame,
+            "proxy": self.create_proxy_frame,
+        }
+
+    def get_provider_frame(self, config):
+        """Return the frame for a configuration, building it the first time it is selected"""
+        frame = self.provider_frames.get(config)
+        if frame is None:
+            frame = self.provider_frame_builders[config]()
+            self.provider_frames[config] = frame
+
+            # Frames built after the Linux focus setup need the same entry bindings
+            if IS_LINUX and getattr(self, '_linux_focus_ready', False):
+                for entry in self._frame_entries(frame):
+                    self._bind_linux_entry_focus(entry)
+        return frame
+
+    def _frame_entries(self, frame):
+        """Entry widgets placed directly in a configuration frame"""
+        return [widget for widget in frame.winfo_children() if isinstance(widget, tk.Entry)]
+
     def create_zai_frame(self):
         """Create Z.ai configuration frame"""
         self.zai_frame = tk.LabelFrame(self.dynamic_config_container, text="", bg=self.entry_bg,
@@ -858,7 +1017,6 @@ class ClaudeConfigSwitcher:
         key_management_frame.pack(fill=tk.X, padx=15, pady=(0, 5))
 
         # Combobox for selecting existing keys
-        self.zai_key_var = tk.StringVar()
         if IS_LINUX:
             combobox_width = 32  # Make it larger on Linux for better visibility
         else:
@@ -888,13 +1046,16 @@ class ClaudeConfigSwitcher:
         zai_key_label = ttk.Label(self.zai_frame, text="Current Z.ai API Key:")
         zai_key_label.pack(anchor=tk.W, padx=15, pady=(10, 2))
 
-        self.zai_key_entry = tk.Entry(self.zai_frame, bg=self.entry_bg, fg=self.fg_color,
+        self.zai_key_entry = tk.Entry(self.zai_frame, textvariable=self.zai_key_value_var,
+                                      bg=self.entry_bg, fg=self.fg_color,
                                       insertbackground=self.fg_color, relief=tk.FLAT,
-                                      font=font_manager.get_font(10), bd=0, show="*")
+                                      font=font_manager.get_font(10), bd=0,
+                                      show="" if self.show_password_var.get() else "*")
         self.zai_key_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
         
         # Bind focus events for proper input handling
         self.zai_key_entry.bind('<Button-1>', self.on_entry_click)
+        self.zai_key_entry.bind('<KeyRelease>', lambda e: self.on_zai_key_changed())
 
         # Add border to entry
         entry_border = tk.Frame(self.zai_frame, bg=self.accent_color, height=2)
@@ -904,7 +1065,8 @@ class ClaudeConfigSwitcher:
         key_name_label = ttk.Label(self.zai_frame, text="Key Name (for saving):")
         key_name_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
 
-        self.zai_key_name_entry = tk.Entry(self.zai_frame, bg=self.entry_bg, fg=self.fg_color,
+        self.zai_key_name_entry = tk.Entry(self.zai_frame, textvariable=self.zai_key_name_var,
+                                           bg=self.entry_bg, fg=self.fg_color,
                                            insertbackground=self.fg_color, relief=tk.FLAT,
                                            font=font_manager.get_font(10), bd=0)
         self.zai_key_name_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
@@ -933,14 +1095,10 @@ class ClaudeConfigSwitcher:
         model_frame = tk.Frame(self.zai_frame, bg=self.entry_bg)
         model_frame.pack(fill=tk.X, padx=15, pady=(0, 10))
 
-        # Define available GLM models
-        self.available_models = ["GLM-4.7", "GLM-4.6", "GLM-4.5", "GLM-4.5-Air"]
-
         # Opus Model Selection
         opus_label = ttk.Label(model_frame, text="Opus Model:")
         opus_label.grid(row=0, column=0, sticky=tk.W, pady=(2, 5))
 
-        self.zai_opus_model_var = tk.StringVar(value="GLM-4.7")
         self.zai_opus_combo = ttk.Combobox(model_frame, textvariable=self.zai_opus_model_var,
                                            values=self.available_models, state="readonly", width=20)
         self.zai_opus_combo.grid(row=0, column=1, sticky=tk.W, padx=(10, 0), pady=(2, 5))
@@ -949,7 +1107,6 @@ class ClaudeConfigSwitcher:
         sonnet_label = ttk.Label(model_frame, text="Sonnet Model:")
         sonnet_label.grid(row=1, column=0, sticky=tk.W, pady=(2, 5))
 
-        self.zai_sonnet_model_var = tk.StringVar(value="GLM-4.7")
         self.zai_sonnet_combo = ttk.Combobox(model_frame, textvariable=self.zai_sonnet_model_var,
                                              values=self.available_models, state="readonly", width=20)
         self.zai_sonnet_combo.grid(row=1, column=1, sticky=tk.W, padx=(10, 0), pady=(2, 5))
@@ -958,7 +1115,6 @@ class ClaudeConfigSwitcher:
         haiku_label = ttk.Label(model_frame, text="Haiku Model:")
         haiku_label.grid(row=2, column=0, sticky=tk.W, pady=(2, 5))
 
-        self.zai_haiku_model_var = tk.StringVar(value="GLM-4.7")
         self.zai_haiku_combo = ttk.Combobox(model_frame, textvariable=self.zai_haiku_model_var,
                                             values=self.available_models, state="readonly", width=20)
         self.zai_haiku_combo.grid(row=2, column=1, sticky=tk.W, padx=(10, 0), pady=(2, 5))
@@ -968,10 +1124,6 @@ class ClaudeConfigSwitcher:
         self.zai_sonnet_combo.bind('<<ComboboxSelected>>', lambda e: self.update_zai_env_display())
         self.zai_haiku_combo.bind('<<ComboboxSelected>>', lambda e: self.update_zai_env_display())
 
-        # Initialize storage for multiple keys
-        self.zai_keys = {}  # Format: {"name": "key"}
-        self.current_zai_key_name = None
-
         # Environment variables display (hidden by default)
         self.zai_env_frame = tk.Frame(self.zai_frame, bg=self.entry_bg)
 
@@ -1033,13 +1185,16 @@ class ClaudeConfigSwitcher:
                             font=font_manager.get_font(8, "italic"), anchor=tk.W)
         note_label.grid(row=len(zai_env_vars) + 1, column=0, columnspan=2, sticky=tk.W, pady=(8, 0))
 
+        # Fill in the saved keys and the models loaded before the frame existed
+        self.update_zai_key_combo()
+        self.update_zai_env_display()
+        return self.zai_frame
+
     def create_claude_frame(self):
         """Create Claude configuration frame"""
         self.claude_frame = tk.LabelFrame(self.dynamic_config_container, text="", bg=self.entry_bg,
                                      fg=self.fg_color, relief=tk.FLAT, bd=2)
 
-        self.claude_mode_var = tk.StringVar(value="subscription")
-
         # Create a container for radio buttons to ensure proper vertical layout
         radio_container = tk.Frame(self.claude_frame, bg=self.entry_bg)
         radio_container.pack(fill=tk.X, padx=15, pady=(10, 5))
@@ -1070,9 +1225,11 @@ class ClaudeConfigSwitcher:
         claude_key_label = ttk.Label(self.claude_frame, text="Claude API Key:")
         claude_key_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
 
-        self.claude_key_entry = tk.Entry(self.claude_frame, bg=self.entry_bg, fg=self.fg_color,
+        self.claude_key_entry = tk.Entry(self.claude_frame, textvariable=self.claude_key_var,
+                                         bg=self.entry_bg, fg=self.fg_color,
                                          insertbackground=self.fg_color, relief=tk.FLAT,
-                                         font=font_manager.get_font(10), bd=0, show="*", state=tk.DISABLED,
+                                         font=font_manager.get_font(10), bd=0,
+                                         show="" if self.show_password_var.get() else "*", state=tk.DISABLED,
                                          disabledbackground=self.entry_bg, disabledforeground="#888888")
         self.claude_key_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
 
@@ -1084,9 +1241,13 @@ class ClaudeConfigSwitcher:
         claude_entry_border = tk.Frame(self.claude_frame, bg=self.accent_color, height=2)
         claude_entry_border.pack(fill=tk.X, padx=15, pady=(0, 10))
 
+        # Enable the key entry if API mode was loaded before the frame existed
+        self.on_claude_mode_change()
+
         # Initialize custom radio button display for Linux
         if IS_LINUX:
             self.root.after(100, self.update_claude_radio_display)
+        return self.claude_frame
 
     def create_claude_custom_radio_button(self, parent, text, value):
         """Create a custom radio button for Claude that stacks vertically"""
@@ -1134,8 +1295,8 @@ class ClaudeConfigSwitcher:
             widget.bind('<Enter>', lambda e, val=value: self.on_claude_custom_radio_hover(val, True))
             widget.bind('<Leave>', lambda e, val=value: self.on_claude_custom_radio_hover(val, False))
 
-        # Set initial selection for subscription mode
-        if value == "subscription":
+        # Set initial selection to the current mode
+        if value == self.claude_mode_var.get():
             self.update_claude_custom_radio_display(value, True)
 
     def on_claude_custom_radio_click(self, value):
@@ -1206,6 +1367,8 @@ class ClaudeConfigSwitcher:
 
     def on_claude_mode_change(self):
         """Handle Claude mode radio button change"""
+        if not hasattr(self, 'claude_key_entry'):
+            return
         if self.claude_mode_var.get() == "api":
             self.claude_key_entry.configure(state=tk.NORMAL)
         else:
@@ -1219,7 +1382,8 @@ class ClaudeConfigSwitcher:
         custom_url_label = ttk.Label(self.custom_frame, text="Custom Base URL:")
         custom_url_label.pack(anchor=tk.W, padx=15, pady=(10, 2))
 
-        self.custom_url_entry = tk.Entry(self.custom_frame, bg=self.entry_bg, fg=self.fg_color,
+        self.custom_url_entry = tk.Entry(self.custom_frame, textvariable=self.custom_url_var,
+                                         bg=self.entry_bg, fg=self.fg_color,
                                          insertbackground=self.fg_color, relief=tk.FLAT,
                                          font=font_manager.get_font(10), bd=0)
         self.custom_url_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
@@ -1236,9 +1400,11 @@ class ClaudeConfigSwitcher:
         custom_key_label = ttk.Label(self.custom_frame, text="Custom API Key:")
         custom_key_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
 
-        self.custom_key_entry = tk.Entry(self.custom_frame, bg=self.entry_bg, fg=self.fg_color,
+        self.custom_key_entry = tk.Entry(self.custom_frame, textvariable=self.custom_key_var,
+                                         bg=self.entry_bg, fg=self.fg_color,
                                          insertbackground=self.fg_color, relief=tk.FLAT,
-                                         font=font_manager.get_font(10), bd=0, show="*")
+                                         font=font_manager.get_font(10), bd=0,
+                                         show="" if self.show_password_var.get() else "*")
         self.custom_key_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
         
         # Enhanced focus events for proper input handling
@@ -1309,10 +1475,166 @@ class ClaudeConfigSwitcher:
         note_label.grid(row=len(custom_env_vars) + 1, column=0, columnspan=2, sticky=tk.W, pady=(8, 0))
 
         # Bind events to save API keys when they change
-        self.zai_key_entry.bind('<KeyRelease>', lambda e: self.on_zai_key_changed())
         self.custom_key_entry.bind('<KeyRelease>', lambda e: self.save_api_keys())
         self.custom_url_entry.bind('<KeyRelease>', lambda e: self.save_api_keys())
+        return self.custom_frame
     
+    def create_proxy_frame(self):
+        """Create local proxy configuration frame"""
+        self.proxy_frame = tk.LabelFrame(self.dynamic_config_container, text="", bg=self.entry_bg,
+                                         fg=self.fg_color, relief=tk.FLAT, bd=2)
+
+        upstream_label = ttk.Label(self.proxy_frame, text="Forward Claude Code to:")
+        upstream_label.pack(anchor=tk.W, padx=15, pady=(10, 2))
+
+        self.proxy_upstream_combo = ttk.Combobox(self.proxy_frame, textvariable=self.proxy_upstream_var,
+                                                 values=[self.proxy_upstream_labels[name] for name in PROXY_UPSTREAMS],
+                                                 state="readonly", width=30)
+        self.proxy_upstream_combo.pack(anchor=tk.W, padx=15, pady=(0, 10))
+
+        port_label = ttk.Label(self.proxy_frame, text="Local Proxy Port:")
+        port_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
+
+        self.proxy_port_entry = tk.Entry(self.proxy_frame, textvariable=self.proxy_port_var,
+                                         bg=self.entry_bg, fg=self.fg_color,
+                                         insertbackground=self.fg_color, relief=tk.FLAT,
+                                         font=font_manager.get_font(10), bd=0)
+        self.proxy_port_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
+        self.proxy_port_entry.bind('<Button-1>', self.on_entry_click)
+
+        # Add border to entry
+        proxy_port_border = tk.Frame(self.proxy_frame, bg=self.accent_color, height=2)
+        proxy_port_border.pack(fill=tk.X, padx=15, pady=(0, 10))
+
+        pool_label = ttk.Label(self.proxy_frame, text="Rotate across Z.ai keys (optional, select two or more):")
+        pool_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
+
+        self.proxy_key_listbox = tk.Listbox(self.proxy_frame, selectmode=tk.MULTIPLE, exportselection=False,
+                                            height=4, bg=self.entry_bg, fg=self.fg_color,
+                                            selectbackground=self.accent_color, relief=tk.FLAT,
+                                            font=font_manager.get_font(10), bd=0, highlightthickness=0)
+        self.proxy_key_listbox.pack(fill=tk.X, padx=15, pady=(0, 5))
+        self.proxy_key_listbox.bind('<<ListboxSelect>>', self.on_proxy_key_pool_selected)
+
+        self.proxy_key_strategy_combo = ttk.Combobox(self.proxy_frame, textvariable=self.proxy_key_strategy_var,
+                                                     values=KEY_STRATEGIES, state="readonly", width=30)
+        self.proxy_key_strategy_combo.pack(anchor=tk.W, padx=15, pady=(0, 10))
+
+        concurrency_label = ttk.Label(self.proxy_frame, text="Max concurrent requests per key (blank for no limit):")
+        concurrency_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
+
+        self.proxy_concurrency_entry = tk.Entry(self.proxy_frame, textvariable=self.proxy_concurrency_var,
+                                                bg=self.entry_bg, fg=self.fg_color,
+                                                insertbackground=self.fg_color, relief=tk.FLAT,
+                                                font=font_manager.get_font(10), bd=0)
+        self.proxy_concurrency_entry.pack(fill=tk.X, padx=15, pady=(0, 2), ipady=8)
+        self.proxy_concurrency_entry.bind('<Button-1>', self.on_entry_click)
+
+        proxy_concurrency_border = tk.Frame(self.proxy_frame, bg=self.accent_color, height=2)
+        proxy_concurrency_border.pack(fill=tk.X, padx=15, pady=(0, 10))
+
+        routes_label = ttk.Label(self.proxy_frame, text="Route model tiers to:")
+        routes_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
+        routes_container = tk.Frame(self.proxy_frame, bg=self.entry_bg)
+        routes_container.pack(fill=tk.X, padx=15, pady=(0, 10))
+        route_choices = ["Default"] + [self.proxy_upstream_labels[name] for name in PROXY_UPSTREAMS]
+        for row, tier in enumerate(MODEL_TIERS):
+            tier_label = ttk.Label(routes_container, text=f"{tier.title()}:")
+            tier_label.grid(row=row, column=0, sticky=tk.W, padx=(0, 10), pady=2)
+            tier_combo = ttk.Combobox(routes_container, textvariable=self.proxy_tier_route_vars[tier],
+                                      values=route_choices, state="readonly", width=20)
+            tier_combo.grid(row=row, column=1, sticky=tk.W, pady=2)
+
+        hedge_label = ttk.Label(self.proxy_frame, text="Resend slow requests to (first answer wins):")
+        hedge_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
+        self.proxy_hedge_combo = ttk.Combobox(self.proxy_frame, textvariable=self.proxy_hedge_var,
+                                              values=["Off"] + [self.proxy_upstream_labels[name] for name in PROXY_UPSTREAMS],
+                                              state="readonly", width=30)
+        self.proxy_hedge_combo.pack(anchor=tk.W, padx=15, pady=(0, 10))
+
+        failover_label = ttk.Label(self.proxy_frame, text="Fail over when the upstream errors or stalls to:")
+        failover_label.pack(anchor=tk.W, padx=15, pady=(5, 2))
+        self.proxy_failover_combo = ttk.Combobox(self.proxy_frame, textvariable=self.proxy_failover_var,
+                                                 values=["Off"] + [self.proxy_upstream_labels[name] for name in PROXY_UPSTREAMS],
+                                                 state="readonly", width=30)
+        self.proxy_failover_combo.pack(anchor=tk.W, padx=15, pady=(0, 10))
+
+        note_label = tk.Label(self.proxy_frame,
+                              text="Claude Code connects to a local proxy that forwards to the profile above.\n"
+                                   "Changing it later takes effect without restarting Claude Code.",
+                              bg=self.entry_bg, fg="#888888", justify=tk.LEFT,
+                              font=font_manager.get_font(8, "italic"), anchor=tk.W)
+        note_label.pack(fill=tk.X, padx=15, pady=(0, 10))
+        self.refresh_proxy_key_list()
+        return self.proxy_frame
+
+    def refresh_proxy_key_list(self):
+        """List the saved Z.ai keys in the proxy frame, keeping the pooled ones selected"""
+        if not hasattr(self, 'proxy_key_listbox'):
+            return
+        names = sorted(self.zai_keys)
+        self.proxy_key_pool = [name for name in self.proxy_key_pool if name in self.zai_keys]
+        self.proxy_key_listbox.delete(0, tk.END)
+        for index, name in enumerate(names):
+            self.proxy_key_listbox.insert(tk.END, name)
+            if name in self.proxy_key_pool:
+                self.proxy_key_listbox.selection_set(index)
+
+    def on_proxy_key_pool_selected(self, event=None):
+        """Remember which saved keys are selected for rotation"""
+        self.proxy_key_pool = [self.proxy_key_listbox.get(index) for index in self.proxy_key_listbox.curselection()]
+
+    def selected_proxy_routes(self):
+        """Proxy routes from the tier selectors; pattern routes saved from the CLI are kept"""
+        labels = {label: name for name, label in self.proxy_upstream_labels.items()}
+        routes = []
+        for tier in MODEL_TIERS:
+            upstream = labels.get(self.proxy_tier_route_vars[tier].get())
+            if upstream:
+                route = {'match': tier, 'upstream': upstream}
+                # Keep a model rename saved for the same tier and upstream
+                for saved in self.proxy_saved_routes:
+                    if saved.get('match') == tier and saved.get('upstream') == upstream and saved.get('model'):
+                        route['model'] = saved['model']
+                routes.append(route)
+        return routes + [route for route in self.proxy_saved_routes if route.get('match') not in MODEL_TIERS]
+
+    def selected_proxy_hedge(self):
+        """Hedge policy from the proxy frame; a delay saved from the CLI is kept"""
+        for name, label in self.proxy_upstream_labels.items():
+            if label == self.proxy_hedge_var.get():
+                return dict(self.proxy_saved_hedge, upstream=name)
+        return {}
+
+    def selected_proxy_failover(self):
+        """Failover policy from the proxy frame; later fallbacks and thresholds saved from the CLI are kept"""
+        for name, label in self.proxy_upstream_labels.items():
+            if label == self.proxy_failover_var.get():
+                later = [other for other in self.proxy_saved_failover.get('upstreams') or [] if other != name]
+                return dict(self.proxy_saved_failover, upstreams=[name] + later)
+        return {}
+
+    def selected_proxy_upstream(self):
+        """Stored profile name for the upstream shown in the proxy frame"""
+        for name, label in self.proxy_upstream_labels.items():
+            if label == self.proxy_upstream_var.get():
+                return name
+        return None
+
+    def ensure_proxy_running(self, port=None):
+        """Serve the proxy from this process unless one is already listening (worker thread)"""
+        import ezswitch_proxy
+
+        port = port or self.config_store.get('proxy_port') or DEFAULT_PROXY_PORT
+        if ezswitch_proxy.proxy_health(port) is not None:
+            return True
+        try:
+            self.proxy_server = ezswitch_proxy.ProxyServer(self.config_file, port=port).start_in_thread()
+            return True
+        except OSError as e:
+            print(f"Warning: Could not start the EZ Switch proxy on port {port}: {e}")
+            return False
+
     def load_existing_api_keys(self):
         """Load existing API keys from Claude Code settings.json and pre-fill them"""
         try:
@@ -1331,25 +1653,21 @@ class ClaudeConfigSwitcher:
 
             # Pre-fill z.ai key only if it's set and base_url explicitly points to z.ai
             if user_auth_token and user_base_url and 'z.ai' in user_base_url:
-                if not self.zai_key_entry.get().strip():
-                    self.zai_key_entry.delete(0, tk.END)
-                    self.zai_key_entry.insert(0, user_auth_token)
+                if not self.zai_key_value_var.get().strip():
+                    self.zai_key_value_var.set(user_auth_token)
 
             # Pre-fill Claude API key only if auth token is set but no base URL (indicating API mode)
             elif user_auth_token and not user_base_url:
-                if not self.claude_key_entry.get().strip():
-                    self.claude_key_entry.delete(0, tk.END)
-                    self.claude_key_entry.insert(0, user_auth_token)
+                if not self.claude_key_var.get().strip():
+                    self.claude_key_var.set(user_auth_token)
 
             # Pre-fill custom configuration only if both auth token and base URL are set and it's not z.ai
             elif user_auth_token and user_base_url and user_base_url and 'z.ai' not in user_base_url:
-                if not self.custom_url_entry.get().strip():
-                    self.custom_url_entry.delete(0, tk.END)
-                    self.custom_url_entry.insert(0, user_base_url)
+                if not self.custom_url_var.get().strip():
+                    self.custom_url_var.set(user_base_url)
 
-                if not self.custom_key_entry.get().strip():
-                    self.custom_key_entry.delete(0, tk.END)
-                    self.custom_key_entry.insert(0, user_auth_token)
+                if not self.custom_key_var.get().strip():
+                    self.custom_key_var.set(user_auth_token)
 
             # Load model settings if z.ai configuration is detected
             if user_auth_token and user_base_url and 'z.ai' in user_base_url:
@@ -1368,7 +1686,7 @@ class ClaudeConfigSwitcher:
             haiku_model = env_vars.get('ANTHROPIC_DEFAULT_HAIKU_MODEL', '').strip()
 
             # Define available models (matching the existing available_models list)
-            available_models = ["GLM-4.6", "GLM-4.5", "GLM-4.5-Air"]
+            available_models = AVAILABLE_MODELS
 
             # Update opus model dropdown if model is valid
             if opus_model and opus_model in available_models:
@@ -1392,56 +1710,19 @@ class ClaudeConfigSwitcher:
     
     
     def get_claude_settings(self):
-        """Get current Claude Code settings.json content"""
-        try:
-            if self.claude_settings_file.exists():
-                with open(self.claude_settings_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            else:
-                # Return empty settings if file doesn't exist
-                return {}
-        except (FileNotFoundError, PermissionError) as e:
-            # Log file access errors but don't crash the app
-            print(f"Warning: Could not access Claude settings file {self.claude_settings_file}: {e}")
-            return {}
-        except json.JSONDecodeError as e:
-            # Log JSON parsing errors
-            print(f"Warning: Invalid JSON in Claude settings file {self.claude_settings_file}: {e}")
-            return {}
-        except UnicodeDecodeError as e:
-            # Log encoding errors
-            print(f"Warning: Encoding error reading Claude settings file {self.claude_settings_file}: {e}")
-            # Try with different encoding as fallback
-            try:
-                with open(self.claude_settings_file, 'r', encoding='utf-8-sig') as f:
-                    return json.load(f)
-            except Exception:
-                print(f"Warning: Could not read Claude settings file with any encoding")
-                return {}
-        except Exception as e:
-            # Log any other unexpected errors
-            print(f"Warning: Unexpected error reading Claude settings file {self.claude_settings_file}: {e}")
-            return {}
+        """Get current Claude Code settings.json content (served from cache while the file is unchanged)"""
+        return read_claude_settings(self.claude_settings_file)
 
     def update_claude_settings(self, env_vars):
         """Update Claude Code settings.json with environment variables"""
         try:
-            # Ensure .claude directory exists
-            self.claude_settings_dir.mkdir(exist_ok=True)
-
-            # Read current settings
-            current_settings = self.get_claude_settings()
-
-            # Update or add environment variables
-            if 'env' not in current_settings:
-                current_settings['env'] = {}
+            with SettingsTransaction(self.claude_settings_file) as txn:
+                # Update or add environment variables
+                if 'env' not in txn.settings:
+                    txn.settings['env'] = {}
 
-            for var_name, var_value in env_vars.items():
-                current_settings['env'][var_name] = var_value
-
-            # Write back to file with proper formatting
-            with open(self.claude_settings_file, 'w', encoding='utf-8') as f:
-                json.dump(current_settings, f, indent=4, ensure_ascii=False)
+                for var_name, var_value in env_vars.items():
+                    txn.settings['env'][var_name] = var_value
 
             return True, f"Claude Code settings updated successfully"
 
@@ -1451,27 +1732,23 @@ class ClaudeConfigSwitcher:
     def remove_claude_settings_vars(self, var_names):
         """Remove specific environment variables from Claude Code settings.json"""
         try:
-            # Read current settings
-            current_settings = self.get_claude_settings()
-
-            # Check if there are environment variables to remove
-            if 'env' not in current_settings:
-                return True, "No environment variables in Claude settings to remove"
-
-            # Remove specified variables
-            removed_vars = []
-            for var_name in var_names:
-                if var_name in current_settings['env']:
-                    del current_settings['env'][var_name]
-                    removed_vars.append(var_name)
-
-            # If no variables were removed, return early
-            if not removed_vars:
-                return True, "No matching environment variables found in Claude settings"
-
-            # Write updated settings back to file
-            with open(self.claude_settings_file, 'w', encoding='utf-8') as f:
-                json.dump(current_settings, f, indent=4, ensure_ascii=False)
+            with SettingsTransaction(self.claude_settings_file) as txn:
+                # Check if there are environment variables to remove
+                if 'env' not in txn.settings:
+                    txn.rollback()
+                    return True, "No environment variables in Claude settings to remove"
+
+                # Remove specified variables
+                removed_vars = []
+                for var_name in var_names:
+                    if var_name in txn.settings['env']:
+                        del txn.settings['env'][var_name]
+                        removed_vars.append(var_name)
+
+                # If no variables were removed, leave the file untouched
+                if not removed_vars:
+                    txn.rollback()
+                    return True, "No matching environment variables found in Claude settings"
 
             return True, f"Removed {', '.join(removed_vars)} from Claude Code settings"
 
@@ -1479,43 +1756,23 @@ class ClaudeConfigSwitcher:
             return False, f"Failed to remove from Claude settings: {str(e)}"
 
     
+    def apply_claude_settings_delta(self, set_vars, unset_vars):
+        """Apply a planned set/unset delta to settings.json in a single transaction"""
+        return apply_settings_delta(self.claude_settings_file, set_vars, unset_vars)
+
     def load_saved_api_keys(self):
         """Load API keys from the persistent storage file"""
         try:
-            saved_keys = {}
-            
-            # Check if new config file exists
-            if self.config_file.exists():
-                with open(self.config_file, 'r') as f:
-                    saved_keys = json.load(f)
-            else:
-                # Check if old config file exists and migrate it
-                old_config_file = Path.home() / ".claude_code_ez_switch_config.json"
-                if old_config_file.exists():
-                    with open(old_config_file, 'r') as f:
-                        saved_keys = json.load(f)
-                    # Save to new location
-                    with open(self.config_file, 'w') as f:
-                        json.dump(saved_keys, f, indent=2)
-                    # Remove old file
-                    old_config_file.unlink()
-            
-            # Load z.ai keys (new format)
-            if 'zai_keys' in saved_keys:
-                self.zai_keys = saved_keys['zai_keys']
-                self.update_zai_key_combo()
-            elif 'zai_key' in saved_keys:
-                # Migrate old single key format
-                old_key = saved_keys['zai_key']
-                self.zai_keys = {'Default': old_key}
-                self.update_zai_key_combo()
-                self.zai_key_var.set('Default')
-                self.on_zai_key_selected()
+            saved_keys = self.config_store.load().snapshot()
+
+            # Load z.ai keys (the store migrates the old single key format)
+            self.zai_keys = self.config_store.zai_keys
+            self.update_zai_key_combo()
 
             # Load current z.ai key name
-            if 'current_zai_key_name' in saved_keys:
+            if saved_keys.get('current_zai_key_name'):
                 self.current_zai_key_name = saved_keys['current_zai_key_name']
-                if self.current_zai_key_name and self.current_zai_key_name in self.zai_keys:
+                if self.current_zai_key_name in self.zai_keys:
                     self.zai_key_var.set(self.current_zai_key_name)
                     self.on_zai_key_selected()
             
@@ -1526,21 +1783,44 @@ class ClaudeConfigSwitcher:
                 self.on_claude_mode_change()
 
             if 'claude_key' in saved_keys:
-                self.claude_key_entry.delete(0, tk.END)
-                self.claude_key_entry.insert(0, saved_keys['claude_key'])
+                self.claude_key_var.set(saved_keys['claude_key'])
 
             # Load custom config
             if 'custom_url' in saved_keys:
-                self.custom_url_entry.delete(0, tk.END)
-                self.custom_url_entry.insert(0, saved_keys['custom_url'])
+                self.custom_url_var.set(saved_keys['custom_url'])
 
             if 'custom_key' in saved_keys:
-                self.custom_key_entry.delete(0, tk.END)
-                self.custom_key_entry.insert(0, saved_keys['custom_key'])
+                self.custom_key_var.set(saved_keys['custom_key'])
+
+            # Load proxy config
+            if saved_keys.get('proxy_upstream') in self.proxy_upstream_labels:
+                self.proxy_upstream_var.set(self.proxy_upstream_labels[saved_keys['proxy_upstream']])
+            if 'proxy_port' in saved_keys:
+                self.proxy_port_var.set(str(saved_keys['proxy_port']))
+            self.proxy_key_pool = list(saved_keys.get('proxy_key_pool') or [])
+            if saved_keys.get('proxy_max_concurrency'):
+                self.proxy_concurrency_var.set(str(saved_keys['proxy_max_concurrency']))
+            if saved_keys.get('proxy_key_strategy') in KEY_STRATEGIES:
+                self.proxy_key_strategy_var.set(saved_keys['proxy_key_strategy'])
+            for tier, model in (saved_keys.get('zai_models') or {}).items():
+                if model in AVAILABLE_MODELS and hasattr(self, f'zai_{tier}_model_var'):
+                    getattr(self, f'zai_{tier}_model_var').set(model)
+            self.proxy_saved_hedge = dict(saved_keys.get('proxy_hedge') or {})
+            if self.proxy_saved_hedge.get('upstream') in self.proxy_upstream_labels:
+                self.proxy_hedge_var.set(self.proxy_upstream_labels[self.proxy_saved_hedge['upstream']])
+            self.proxy_saved_failover = dict(saved_keys.get('proxy_failover') or {})
+            fallbacks = self.proxy_saved_failover.get('upstreams') or []
+            if fallbacks and fallbacks[0] in self.proxy_upstream_labels:
+                self.proxy_failover_var.set(self.proxy_upstream_labels[fallbacks[0]])
+            self.proxy_saved_routes = list(saved_keys.get('proxy_routes') or [])
+            for route in self.proxy_saved_routes:
+                if route.get('match') in MODEL_TIERS and route.get('upstream') in self.proxy_upstream_labels:
+                    self.proxy_tier_route_vars[route['match']].set(self.proxy_upstream_labels[route['upstream']])
 
 
             # Always default to Z.ai configuration
             self.config_var.set("zai")
+            self.synced_config = self.config_widget_values()
 
             # Update radio button display to match default config
             if IS_LINUX and hasattr(self, 'custom_radio_buttons'):
@@ -1553,37 +1833,38 @@ class ClaudeConfigSwitcher:
     def save_api_keys(self):
         """Save current API keys to persistent storage"""
         try:
-            saved_keys = {}
-            
-           # Save z.ai keys
-            saved_keys['zai_keys'] = self.zai_keys
-            saved_keys['current_zai_key_name'] = self.current_zai_key_name
-
-            # Save Claude config
-            saved_keys['claude_mode'] = self.claude_mode_var.get()
-            claude_key = self.claude_key_entry.get().strip()
-            if claude_key:
-                saved_keys['claude_key'] = claude_key
-
-            # Save custom config if not empty
-            custom_url = self.custom_url_entry.get().strip()
-            if custom_url:
-                saved_keys['custom_url'] = custom_url
-
-            custom_key = self.custom_key_entry.get().strip()
-            if custom_key:
-                saved_keys['custom_key'] = custom_key
-
-
-            # Save selected config
-            saved_keys['selected_config'] = self.config_var.get()
-            
-            # Write to file
-            with open(self.config_file, 'w') as f:
-                json.dump(saved_keys, f, indent=2)
+            self.sync_config_store()
+            self.config_store.save()
         except Exception as e:
             # Silently fail if we can't save keys
             pass
+
+    def sync_config_store(self):
+        """Copy the configuration changed in the widgets into the config store (UI thread only)
+
+        The store first takes in what CLI commands saved to config.json meanwhile;
+        widgets the user did not touch since then do not overwrite it.
+        """
+        self.config_store.refresh()
+        values = self.config_widget_values()
+        changed = {key: value for key, value in values.items() if value != self.synced_config.get(key)}
+        self.synced_config = copy.deepcopy(values)
+        # Empty values are dropped from config.json
+        self.config_store.update(**changed)
+
+    def config_widget_values(self):
+        """The persistable configuration as the widgets show it"""
+        return dict(
+            zai_keys=self.zai_keys,
+            current_zai_key_name=self.current_zai_key_name,
+            claude_mode=self.claude_mode_var.get(),
+            claude_key=self.claude_key_var.get().strip(),
+            custom_url=self.custom_url_var.get().strip(),
+            custom_key=self.custom_key_var.get().strip(),
+            zai_models={'opus': self.zai_opus_model_var.get(), 'sonnet': self.zai_sonnet_model_var.get(),
+                        'haiku': self.zai_haiku_model_var.get()},
+            selected_config=self.config_var.get()
+        )
     
     def open_github_link(self):
         """Open the GitHub repository link"""
@@ -1594,10 +1875,8 @@ class ClaudeConfigSwitcher:
         """Handle z.ai key selection from combobox"""
         selected_name = self.zai_key_var.get()
         if selected_name and selected_name in self.zai_keys:
-            self.zai_key_entry.delete(0, tk.END)
-            self.zai_key_entry.insert(0, self.zai_keys[selected_name])
-            self.zai_key_name_entry.delete(0, tk.END)
-            self.zai_key_name_entry.insert(0, selected_name)
+            self.zai_key_value_var.set(self.zai_keys[selected_name])
+            self.zai_key_name_var.set(selected_name)
             self.current_zai_key_name = selected_name
 
     def on_zai_key_changed(self):
@@ -1610,17 +1889,17 @@ class ClaudeConfigSwitcher:
         """Update the environment variables display to show selected models"""
         if hasattr(self, 'zai_env_value_labels'):
             # Update the model values in the display
-            self.zai_env_value_labels["ANTHROPIC_DEFAULT_OPUS_MODEL"].config(
-                text=self.zai_opus_model_var.get())
-            self.zai_env_value_labels["ANTHROPIC_DEFAULT_SONNET_MODEL"].config(
-                text=self.zai_sonnet_model_var.get())
-            self.zai_env_value_labels["ANTHROPIC_DEFAULT_HAIKU_MODEL"].config(
-                text=self.zai_haiku_model_var.get())
+            self._set_label_text(self.zai_env_value_labels["ANTHROPIC_DEFAULT_OPUS_MODEL"],
+                                 self.zai_opus_model_var.get())
+            self._set_label_text(self.zai_env_value_labels["ANTHROPIC_DEFAULT_SONNET_MODEL"],
+                                 self.zai_sonnet_model_var.get())
+            self._set_label_text(self.zai_env_value_labels["ANTHROPIC_DEFAULT_HAIKU_MODEL"],
+                                 self.zai_haiku_model_var.get())
 
     def add_zai_key(self):
         """Add a new z.ai key"""
-        key_name = self.zai_key_name_entry.get().strip()
-        key_value = self.zai_key_entry.get().strip()
+        key_name = self.zai_key_name_var.get().strip()
+        key_value = self.zai_key_value_var.get().strip()
 
         if not key_name:
             self.show_inline_message("Error: Please enter a name for this key", "error")
@@ -1711,8 +1990,8 @@ class ClaudeConfigSwitcher:
 
         # Clear entries if this was the current key
         if self.current_zai_key_name == selected_name:
-            self.zai_key_entry.delete(0, tk.END)
-            self.zai_key_name_entry.delete(0, tk.END)
+            self.zai_key_value_var.set("")
+            self.zai_key_name_var.set("")
             self.current_zai_key_name = None
 
         # Clean up environment variables and Claude Code settings
@@ -2153,7 +2432,8 @@ class ClaudeConfigSwitcher:
     def update_zai_key_combo(self):
         """Update the z.ai key combobox with current keys"""
         key_names = sorted(self.zai_keys.keys())
-        self.zai_key_combo['values'] = key_names
+        if hasattr(self, 'zai_key_combo'):
+            self.zai_key_combo['values'] = key_names
 
         # If no keys exist, clear selection
         if not key_names:
@@ -2162,42 +2442,38 @@ class ClaudeConfigSwitcher:
 
     def on_config_change(self):
         """Handle configuration radio button change - switch visible frame"""
-        # Hide all frames first
-        self.zai_frame.pack_forget()
-        self.claude_frame.pack_forget()
-        self.custom_frame.pack_forget()
+        # Hide the frames built so far
+        for frame in self.provider_frames.values():
+            frame.pack_forget()
         # Also hide old environment variable frames
-        self.zai_env_frame.pack_forget()
-        self.custom_env_frame.pack_forget()
+        if hasattr(self, 'zai_env_frame'):
+            self.zai_env_frame.pack_forget()
+        if hasattr(self, 'custom_env_frame'):
+            self.custom_env_frame.pack_forget()
 
-        # Show the selected frame
-        if self.config_var.get() == "zai":
-            self.zai_frame.pack(fill=tk.X, pady=(0, 10))
-        elif self.config_var.get() == "claude":
-            self.claude_frame.pack(fill=tk.X, pady=(0, 10))
-        elif self.config_var.get() == "custom":
-            self.custom_frame.pack(fill=tk.X, pady=(0, 10))
+        # Show the selected frame, building it on first use
+        if self.config_var.get() in self.provider_frame_builders:
+            self.get_provider_frame(self.config_var.get()).pack(fill=tk.X, pady=(0, 10))
+        if self.config_var.get() == "proxy":
+            # Keys may have been added or deleted on the Z.ai page since
+            self.refresh_proxy_key_list()
 
         # If Claude settings are currently visible, update them
         if self.show_env_vars_var.get():
-            # Schedule update after widgets are properly packed
-            self.root.after(100, self.update_universal_settings_display)
+            self.schedule_settings_render()
     
         
     def toggle_password_visibility(self):
         """Toggle password visibility in entry fields"""
-        if self.show_password_var.get():
-            self.zai_key_entry.configure(show="")
-            self.claude_key_entry.configure(show="")
-            self.custom_key_entry.configure(show="")
-        else:
-            self.zai_key_entry.configure(show="*")
-            self.claude_key_entry.configure(show="*")
-            self.custom_key_entry.configure(show="*")
+        # Frames not built yet pick up the setting when they are created
+        show = "" if self.show_password_var.get() else "*"
+        for entry_name in ('zai_key_entry', 'claude_key_entry', 'custom_key_entry'):
+            if hasattr(self, entry_name):
+                getattr(self, entry_name).configure(show=show)
 
         # Update universal settings display if visible
         if self.show_env_vars_var.get():
-            self.update_universal_settings_display()
+            self.schedule_settings_render()
 
     def hide_universal_settings(self):
         """Hide universal Claude settings display"""
@@ -2211,9 +2487,9 @@ class ClaudeConfigSwitcher:
 
     def hide_env_vars(self, config_type):
         """Hide settings display for a specific configuration type"""
-        if config_type == 'zai':
+        if config_type == 'zai' and hasattr(self, 'zai_env_frame'):
             self.zai_env_frame.pack_forget()
-        elif config_type == 'custom':
+        elif config_type == 'custom' and hasattr(self, 'custom_env_frame'):
             self.custom_env_frame.pack_forget()
 
         # Always uncheck the main checkbox when hiding environment variables
@@ -2228,14 +2504,8 @@ class ClaudeConfigSwitcher:
             # Show universal settings frame (regardless of configuration)
             self.universal_settings_frame.pack(fill=tk.X, pady=(0, 10))
 
-            # Update the display with current settings values
-            # Try multiple times to ensure the update works
-            self.root.after(50, self.update_universal_settings_display)
-            self.root.after(150, self.update_universal_settings_display)
-            self.root.after(300, self.update_universal_settings_display)  # Final retry
-
-            # Adjust window height to accommodate settings display
-            self.root.after(200, self._adjust_window_height_for_env_vars)  # Allow widgets to render first
+            # Update the display with current settings values and make room for it on the next frame
+            self.schedule_settings_render(adjust_height=True)
         else:
             # Hide universal settings frame
             self.universal_settings_frame.pack_forget()
@@ -2243,18 +2513,20 @@ class ClaudeConfigSwitcher:
             # Restore original window height
             self._restore_original_window_height()
 
-    def get_current_env_vars(self):
+    def get_current_env_vars(self, settings=None):
         """Get current environment variables from Claude Code settings.json"""
         env_vars = {}
         try:
-            # Get settings from Claude Code settings.json
-            settings = self.get_claude_settings()
+            # Get settings from Claude Code settings.json unless the watcher already pushed them
+            if settings is None:
+                settings = self.get_claude_settings()
 
             # Debug: Print the raw settings for troubleshooting
             if IS_WINDOWS and settings:
                 print(f"Debug: Loaded Claude settings: {list(settings.keys())}")
                 if 'env' in settings:
                     print(f"Debug: Found env vars: {list(settings['env'].keys())}")
+                print(f"Debug: Settings cache stats: {settings_cache.stats()}")
 
             # Extract environment variables from settings
             if 'env' in settings:
@@ -2284,7 +2556,7 @@ class ClaudeConfigSwitcher:
                 else:
                     display_value = value
 
-                label.configure(text=display_value)
+                self._set_label_text(label, display_value)
 
         # Update custom environment variables if that frame is visible
         if self.config_var.get() == "custom" and hasattr(self, 'custom_env_value_labels'):
@@ -2301,11 +2573,11 @@ class ClaudeConfigSwitcher:
                 else:
                     display_value = value
 
-                label.configure(text=display_value)
+                self._set_label_text(label, display_value)
 
-    def update_universal_settings_display(self):
+    def update_universal_settings_display(self, settings=None):
         """Update the universal Claude settings display with current settings.json values"""
-        env_vars = self.get_current_env_vars()
+        env_vars = self.get_current_env_vars(settings)
 
         # Debug: Print what we're about to display
         if IS_WINDOWS:
@@ -2332,11 +2604,76 @@ class ClaudeConfigSwitcher:
             else:
                 display_value = "Not set"
 
-            label.configure(text=display_value)
+            self._set_label_text(label, display_value)
 
     def close_application(self):
         """Properly close the application"""
+        if hasattr(self, 'settings_watcher'):
+            self.settings_watcher.stop()
+        if self.resident_server is not None:
+            self.resident_server.stop()
+        if self.proxy_server is not None:
+            self.proxy_server.stop()
         self.root.destroy()
+
+    def start_resident_server(self):
+        """Make this window the single instance that later launches and CLI calls talk to"""
+        server = ResidentServer(self.handle_ipc_request, self.config_dir)
+        try:
+            if server.start():
+                self.resident_server = server
+        except OSError as e:
+            print(f"Warning: Could not start resident IPC server: {e}")
+
+    def handle_ipc_request(self, request):
+        """IPC server thread: raise the window or run a forwarded CLI command"""
+        if request.get('command') == 'show':
+            self.root.after(0, self._restore_main_window)
+            return {'ok': True}
+        # CLI commands only touch settings.json/config.json; the watcher refreshes the window
+        return ezswitch_cli.handle_request(request)
+
+    def _on_settings_file_changed(self, settings):
+        """Watcher thread callback: hand the freshly parsed settings to the UI thread"""
+        try:
+            self.root.after(0, lambda: self.on_settings_changed(settings))
+        except (RuntimeError, tk.TclError):
+            # Window already destroyed
+            self.settings_watcher.stop()
+
+    def on_settings_changed(self, settings):
+        """Refresh status and the settings panel from settings pushed by the watcher"""
+        self.check_current_status(settings)
+        if self.show_env_vars_var.get():
+            self.schedule_settings_render(settings)
+
+    def schedule_settings_render(self, settings=None, adjust_height=False):
+        """Mark the settings panel dirty; it is repainted at most once per frame"""
+        if settings is not None:
+            self._render_settings = settings
+        self._render_adjust_height = self._render_adjust_height or adjust_height
+        if self._render_job is None:
+            self._render_job = self.root.after(self.RENDER_INTERVAL_MS, self._render_settings_panel)
+
+    def _render_settings_panel(self):
+        """Repaint the settings panel once for everything marked dirty since the last frame"""
+        self._render_job = None
+        settings, self._render_settings = self._render_settings, None
+        adjust_height, self._render_adjust_height = self._render_adjust_height, False
+
+        # Hidden in the meantime; the next show marks it dirty again
+        if not self.show_env_vars_var.get():
+            return
+        self.update_universal_settings_display(settings)
+        if adjust_height:
+            self._adjust_window_height_for_env_vars()
+
+    def _set_label_text(self, label, text):
+        """Reconfigure a label only when its text actually changes"""
+        key = str(label)
+        if self._label_texts.get(key) != text:
+            label.configure(text=text)
+            self._label_texts[key] = text
     
     def show_loading(self):
         """Show loading spinner"""
@@ -2354,38 +2691,15 @@ class ClaudeConfigSwitcher:
         self.refresh_button.configure(state=tk.NORMAL)
         self.root.update_idletasks()
     
-    def check_current_status(self):
+    def check_current_status(self, settings=None):
         """Check current configuration from Claude Code settings.json"""
         try:
-            # Check Claude Code settings.json
-            claude_settings = self.get_claude_settings()
-            claude_auth_token = None
-            claude_base_url = None
-
-            if 'env' in claude_settings:
-                claude_auth_token = claude_settings['env'].get('ANTHROPIC_AUTH_TOKEN')
-                claude_base_url = claude_settings['env'].get('ANTHROPIC_BASE_URL')
-
-            if claude_base_url and 'z.ai' in claude_base_url:
-                status_text = "✓ Currently using z.ai API\n"
-                status_text += "(Configured in Claude Code settings.json)"
-                self.status_label.configure(text=status_text, fg=self.success_color)
-            elif claude_auth_token and not claude_base_url:
-                status_text = "✓ Currently using Claude API Key\n"
-                status_text += "(Configured in Claude Code settings.json)"
-                self.status_label.configure(text=status_text, fg=self.success_color)
-            elif not claude_auth_token and not claude_base_url:
-                status_text = "✓ Currently using Claude Subscription\n"
-                status_text += "(No custom settings configured)"
-                self.status_label.configure(text=status_text, fg=self.success_color)
-            elif claude_base_url and claude_auth_token:
-                status_text = f"✓ Currently using Custom Base URL\n"
-                status_text += f"Base URL: {claude_base_url}\n"
-                status_text += "(Configured in Claude Code settings.json)"
-                self.status_label.configure(text=status_text, fg=self.success_color)
-            else:
-                status_text = "⚠ No configuration is currently set"
-                self.status_label.configure(text=status_text, fg=self.error_color)
+            # Check Claude Code settings.json unless the watcher already pushed it
+            claude_settings = settings if settings is not None else self.get_claude_settings()
+            # The proxy token may have been created by a CLI command since the store was loaded
+            is_configured, status_text = describe_status(claude_settings, self.config_store.refresh())
+            self.status_label.configure(text=status_text,
+                                        fg=self.success_color if is_configured else self.error_color)
 
         except Exception as e:
             self.status_label.configure(
@@ -2408,135 +2722,105 @@ class ClaudeConfigSwitcher:
         except Exception as e:
             return False, str(e)
     
-    def apply_configuration_thread(self):
-        """Thread worker for applying configuration"""
+    def build_profile(self):
+        """Build the profile selected in the UI from the widgets (UI thread only)"""
+        if self.config_var.get() == "zai":
+            return ZaiProfile(self.zai_key_value_var.get(), self.current_zai_key_name,
+                              self.zai_opus_model_var.get(),
+                              self.zai_sonnet_model_var.get(),
+                              self.zai_haiku_model_var.get())
+        elif self.config_var.get() == "claude":
+            if self.claude_mode_var.get() == "subscription":
+                return ClaudeSubscriptionProfile()
+            return ClaudeApiProfile(self.claude_key_var.get())
+        elif self.config_var.get() == "custom":
+            return CustomProfile(self.custom_url_var.get(), self.custom_key_var.get())
+        elif self.config_var.get() == "proxy":
+            try:
+                port = int(self.proxy_port_var.get().strip())
+            except ValueError:
+                port = 0  # Rejected by validate()
+            concurrency = self.proxy_concurrency_var.get().strip()
+            try:
+                max_concurrency = int(concurrency) if concurrency else 0
+            except ValueError:
+                max_concurrency = -1  # Rejected by validate()
+            # A single selected key is just that key; rotation needs two or more
+            key_pool = self.proxy_key_pool if len(self.proxy_key_pool) > 1 else []
+            return proxy_profile(self.config_store, self.selected_proxy_upstream(), port,
+                                 key_pool if self.selected_proxy_upstream() == 'zai' else [],
+                                 self.proxy_key_strategy_var.get(), self.selected_proxy_routes(),
+                                 self.selected_proxy_hedge(), self.selected_proxy_failover(), max_concurrency)
+        return None
+
+    def apply_configuration_thread(self, profile, timings):
+        """Thread worker for applying configuration: one settings.json and one config.json write"""
         try:
-            if self.config_var.get() == "zai":
-                # Apply z.ai configuration
-                zai_key = self.zai_key_entry.get().strip()
-
-                if not zai_key:
-                    self.root.after(0, lambda: messagebox.showerror("Error", "Please enter your z.ai API key"))
-                    self.root.after(0, self.hide_loading)
-                    return
-
-                # Configure z.ai settings (only in settings.json)
-                env_vars = {
-                    'ANTHROPIC_AUTH_TOKEN': zai_key,
-                    'ANTHROPIC_BASE_URL': 'https://api.z.ai/api/anthropic',
-                    'ANTHROPIC_DEFAULT_OPUS_MODEL': self.zai_opus_model_var.get(),
-                    'ANTHROPIC_DEFAULT_SONNET_MODEL': self.zai_sonnet_model_var.get(),
-                    'ANTHROPIC_DEFAULT_HAIKU_MODEL': self.zai_haiku_model_var.get(),
-                    'API_TIMEOUT_MS': '3000000'
-                }
-
-                # Update only Claude Code settings.json
-                success, output = self.update_claude_settings(env_vars)
-                if not success:
-                    self.root.after(0, lambda msg=output: messagebox.showerror("Error", f"Failed to update Claude Code settings:\n{msg}"))
-                    self.root.after(0, self.hide_loading)
-                    return
+            previous_env = self.get_claude_settings().get('env') or {}
+            success, output = apply_profile(profile, self.claude_settings_file, self.config_store, timings)
+            if not success:
+                self.root.after(0, lambda msg=output: messagebox.showerror("Error", f"Failed to update Claude Code settings:\n{msg}"))
+                self.root.after(0, self.hide_loading)
+                return
 
-                self.root.after(0, lambda: self.show_success_dialog("Success",
-                                   "Z.ai configuration applied successfully!\n\nClaude Code settings.json updated.\n\nIMPORTANT: You must restart Claude Code for changes to take effect."))
-
-            elif self.config_var.get() == "claude":
-                # Apply Claude configuration
-                if self.claude_mode_var.get() == "subscription":
-                    # Clear all Claude settings from settings.json to use subscription
-                    env_vars_to_remove = [
-                        'ANTHROPIC_AUTH_TOKEN',
-                        'ANTHROPIC_BASE_URL',
-                        'ANTHROPIC_DEFAULT_OPUS_MODEL',
-                        'ANTHROPIC_DEFAULT_SONNET_MODEL',
-                        'ANTHROPIC_DEFAULT_HAIKU_MODEL',
-                        'ANTHROPIC_API_KEY'
-                    ]
-
-                    # Clear from Claude Code settings only
-                    success, output = self.update_claude_settings({var: '' for var in env_vars_to_remove})
-                    if not success:
-                        self.root.after(0, lambda msg=output: messagebox.showerror("Error", f"Failed to update Claude Code settings:\n{msg}"))
-                        self.root.after(0, self.hide_loading)
-                        return
-
-                    self.root.after(0, lambda: self.show_success_dialog("Success",
-                                       "Claude Subscription configuration applied successfully!\n\nAll settings cleared from Claude Code settings.json to use your official Claude subscription.\n\nIMPORTANT: You must restart Claude Code for changes to take effect."))
+            timing_report = format_timings(timings)
+            print(f"Apply timings: {timing_report}")
 
+            restart_note = "\n\nIMPORTANT: You must restart Claude Code for changes to take effect."
+            if profile.kind == "proxy":
+                if not self.ensure_proxy_running(profile.port):
+                    restart_note = f"\n\nWarning: the proxy could not listen on port {profile.port}."
                 else:
-                    # API mode
-                    claude_key = self.claude_key_entry.get().strip()
-
-                    if not claude_key:
-                        self.root.after(0, lambda: messagebox.showerror("Error", "Please enter your Claude API key"))
-                        self.root.after(0, self.hide_loading)
-                        return
-
-                    # Configure Claude API settings (only in settings.json)
-                    env_vars = {
-                        'ANTHROPIC_AUTH_TOKEN': claude_key
-                    }
-
-                    # Update only Claude Code settings
-                    success, output = self.update_claude_settings(env_vars)
-                    if not success:
-                        self.root.after(0, lambda msg=output: messagebox.showerror("Error", f"Failed to update Claude Code settings:\n{msg}"))
-                        self.root.after(0, self.hide_loading)
-                        return
-
-                    self.root.after(0, lambda: self.show_success_dialog("Success",
-                                       "Claude API configuration applied successfully!\n\nClaude Code settings.json updated.\n\nIMPORTANT: You must restart Claude Code for changes to take effect."))
-
-            elif self.config_var.get() == "custom":
-                # Apply custom configuration
-                custom_url = self.custom_url_entry.get().strip()
-                custom_key = self.custom_key_entry.get().strip()
-
-                if not custom_url:
-                    self.root.after(0, lambda: messagebox.showerror("Error", "Please enter a custom base URL"))
-                    self.root.after(0, self.hide_loading)
-                    return
-
-                if not custom_key:
-                    self.root.after(0, lambda: messagebox.showerror("Error", "Please enter your custom API key"))
-                    self.root.after(0, self.hide_loading)
-                    return
-
-                # Configure custom settings (only in settings.json)
-                env_vars = {
-                    'ANTHROPIC_AUTH_TOKEN': custom_key,
-                    'ANTHROPIC_BASE_URL': custom_url
-                }
-
-                # Update only Claude Code settings
-                success, output = self.update_claude_settings(env_vars)
-                if not success:
-                    self.root.after(0, lambda msg=output: messagebox.showerror("Error", f"Failed to update Claude Code settings:\n{msg}"))
-                    self.root.after(0, self.hide_loading)
-                    return
-
-                self.root.after(0, lambda: self.show_success_dialog("Success",
-                                   "Custom configuration applied successfully!\n\nClaude Code settings.json updated.\n\nIMPORTANT: You must restart Claude Code for changes to take effect."))
-
-
-            # Save API keys after applying configuration
-            self.save_api_keys()
-
-            # Refresh status after applying
+                    # Connect to the new upstream before Claude Code's next request needs it
+                    import ezswitch_proxy
+                    ezswitch_proxy.proxy_prewarm(profile.port, profile.token)
+                    if previous_env.get('ANTHROPIC_BASE_URL') == proxy_base_url(profile.port):
+                        restart_note = "\n\nRunning Claude Code sessions use the new upstream on their next request."
+            self.root.after(0, lambda: self.show_success_dialog("Success",
+                               self.success_messages[profile.kind] + restart_note + f"\n\nApplied in {timing_report}"))
+
+            # Status refreshes itself through the settings watcher
             self.root.after(0, self.hide_loading)
-            self.root.after(500, self.check_current_status)
 
         except Exception as e:
             self.root.after(0, lambda msg=str(e): messagebox.showerror("Error", f"An unexpected error occurred:\n{msg}"))
             self.root.after(0, self.hide_loading)
-    
+
     def apply_configuration(self):
         """Apply the selected configuration using threading to prevent UI freeze"""
+        # Snapshot the widgets on the UI thread; the worker never touches Tk widgets
+        timings = {}
+        phase_start = time.perf_counter()
+        profile = self.build_profile()
+        error_message = profile.validate() if profile else "Please select a configuration"
+        self.sync_config_store()
+        if not error_message and profile.kind == "proxy":
+            # The proxy forwards with the saved values of its upstream and routed profiles
+            targets = [profile.upstream] + [route['upstream'] for route in profile.routes]
+            if profile.hedge:
+                targets.append(profile.hedge['upstream'])
+            targets += profile.failover.get('upstreams') or []
+            for name in dict.fromkeys(targets):
+                if name == 'zai' and profile.key_pool:
+                    continue
+                try:
+                    error_message = stored_profile(self.config_store, name).validate()
+                except ValueError as e:
+                    error_message = str(e)
+                if error_message:
+                    error_message = f"Set up the {self.proxy_upstream_labels[name]} configuration first: {error_message}"
+                    break
+        if error_message:
+            messagebox.showerror("Error", error_message)
+            return
+        timings['collect'] = time.perf_counter() - phase_start
+
         # Show loading indicator
         self.show_loading()
         
         # Start configuration application in a separate thread
-        config_thread = threading.Thread(target=self.apply_configuration_thread, daemon=True)
+        config_thread = threading.Thread(target=self.apply_configuration_thread,
+                                         args=(profile, timings), daemon=True)
         config_thread.start()
 
 def main():
@@ -2547,6 +2831,12 @@ def main():
         if response.lower() != 'y':
             sys.exit(1)
 
+    # Single instance: if one is already running, just bring its window to the front
+    resident = '--resident' in sys.argv[1:]
+    reply = send_request({'command': 'show'}, timeout=2.0)
+    if reply and reply.get('ok'):
+        return
+
     root = tk.Tk()
 
     # Set some basic properties before creating the app
@@ -2567,7 +2857,8 @@ def main():
         except:
             pass
 
-    app = ClaudeConfigSwitcher(root)
+    app = ClaudeConfigSwitcher(root, resident=resident)
+    app.start_resident_server()
 
     # Center window on screen with platform-specific handling
     root.update_idletasks()
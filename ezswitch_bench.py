@@ -0,0 +1,472 @@
+"""Load generator that benchmarks a stored profile with synthetic Messages API traffic
+
+    ezswitch bench zai|api|custom|proxy [--key NAME] [--concurrency 8] [--requests 200 | --duration SECONDS]
+                   [--mix sonnet:3,haiku:1] [--prompt-tokens 1000] [--max-tokens 256] [--no-stream]
+                   [--replay TRACE_FILE [--speed 2]] [--output FILE] [--compare FILE]
+
+Sends requests from --concurrency keep-alive connections straight to the
+profile's base URL (or through the local proxy for 'proxy') and reports
+throughput, time to first token, output tokens per second and latency
+percentiles, per model and overall. Mix entries are model tiers, mapped the
+way the profile maps them (Z.ai uses its GLM models), or literal model names.
+Every prompt is unique so upstream prompt caches do not flatter the numbers.
+
+With --replay the requests are those of a trace recorded by the proxy
+('ezswitch apply proxy --record'), sent at their recorded arrival times (divided
+by --speed) regardless of how many are still running, so an endpoint is tried
+under the real workload. Recorded bodies are resent as they were; without them
+a synthetic prompt of the recorded size, model, max_tokens and streaming flag.
+Only Messages requests are replayed: token counting calls
+(/v1/messages/count_tokens) take no max_tokens or stream and generate nothing
+to measure, so they are skipped.
+
+Results are saved as JSON (under ~/.claude_ez_switch/bench by default) and
+--compare prints a previous result's numbers next to the new ones. Each
+request costs tokens on a real account; 'ezswitch mock' is a free target.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+
+import ezswitch_core as core
+from ezswitch_proxy import (IDLE_CONNECTION_SECONDS, READ_SIZE, ProxyError, Upstream, body_framing, format_head,
+                            get_header, model_tier, read_head)
+
+# Models sent for each tier of the mix to profiles that do not choose their own
+DEFAULT_MODELS = {'opus': 'claude-opus-4-1', 'sonnet': 'claude-sonnet-4-5', 'haiku': 'claude-haiku-4-5'}
+ANTHROPIC_VERSION = '2023-06-01'
+MESSAGES_PATH = '/v1/messages'
+PERCENTILES = (50, 95, 99)
+REQUEST_TIMEOUT = 300.0
+# Synthetic prompts repeat this filler; a token is about BYTES_PER_TOKEN bytes of it
+PROMPT_FILLER = ("Benchmark request exercising the upstream with a synthetic prompt of roughly "
+                 "the configured size so that prefill time is comparable between runs. ")
+BYTES_PER_TOKEN = 4
+# Size and max_tokens of replayed requests whose trace entry lacks them
+DEFAULT_REPLAY_BYTES = 4000
+DEFAULT_REPLAY_MAX_TOKENS = 4096
+
+def parse_mix(spec):
+    """[(tier or model, weight)] from 'sonnet:3,haiku:1'; raises ValueError"""
+    mix = []
+    for entry in str(spec).split(','):
+        entry = entry.strip()
+        name, sep, weight = entry.rpartition(':')
+        try:
+            weight = float(weight) if sep else 1.0
+        except ValueError:
+            sep = None
+        if not sep:
+            # No weight, or a colon that is part of the model name
+            name, weight = entry, 1.0
+        if not name or weight <= 0:
+            raise ValueError(f"Invalid mix entry '{entry}': use TIER_OR_MODEL[:WEIGHT]")
+        mix.append((name, weight))
+    return mix
+
+def bench_target(store, name, key_name=None):
+    """(Upstream, {tier: model the profile uses for it}) for a stored profile or the local proxy
+
+    Raises ValueError if the profile is not configured.
+    """
+    if name == 'proxy':
+        if not store.get('proxy_token'):
+            raise ValueError("No proxy token saved yet; run 'ezswitch apply proxy' first")
+        port = store.get('proxy_port') or core.DEFAULT_PROXY_PORT
+        # The proxy maps Claude models for its upstream itself
+        return Upstream(name, core.proxy_base_url(port), store.get('proxy_token')), {}
+    if key_name is not None:
+        if name != 'zai':
+            raise ValueError("--key only applies to the zai profile")
+        if key_name not in store.zai_keys:
+            raise ValueError(f"No saved Z.ai key named '{key_name}'")
+        models = store.get('zai_models') or {}
+        profile = core.ZaiProfile(store.zai_keys[key_name], key_name,
+                                  *(models.get(tier, core.DEFAULT_ZAI_MODEL) for tier in core.MODEL_TIERS))
+    else:
+        profile = core.stored_profile(store, name)
+    env = profile.env()
+    models = {tier: env[f'ANTHROPIC_DEFAULT_{tier.upper()}_MODEL'] for tier in core.MODEL_TIERS
+              if env.get(f'ANTHROPIC_DEFAULT_{tier.upper()}_MODEL')}
+    return Upstream.from_profile(name, profile), models
+
+def percentiles(values):
+    """Nearest-rank p50/p95/p99 of values, or None when there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return {f"p{p}": round(values[max(0, math.ceil(p / 100 * len(values)) - 1)], 1) for p in PERCENTILES}
+
+def synthetic_body(model, index, prompt_bytes, max_tokens, stream):
+    """Messages API request body with a prompt of about prompt_bytes that is unique to index"""
+    filler = PROMPT_FILLER * (prompt_bytes // len(PROMPT_FILLER) + 1)
+    prompt = f"Request {index} at {time.time()}: {filler[:max(0, prompt_bytes - 64)]}\nReply with a long story."
+    return json.dumps({'model': model, 'max_tokens': max_tokens, 'stream': stream,
+                       'messages': [{'role': 'user', 'content': prompt}]}).encode('utf-8')
+
+def load_trace(path):
+    """Messages requests of a recorded trace file, in arrival order; raises ValueError if it has none"""
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short when the proxy stopped
+            if not isinstance(entry, dict) or not isinstance(entry.get('t'), (int, float)):
+                continue
+            if (entry.get('target') or MESSAGES_PATH).split('?', 1)[0] == MESSAGES_PATH:
+                entries.append(entry)
+    if not entries:
+        raise ValueError(f"No recorded requests in {path}")
+    entries.sort(key=lambda entry: entry['t'])
+    return entries
+
+def replay_request(entry, models, index):
+    """(model, target, body) that re-issue a trace entry, with its model mapped as the profile maps it"""
+    recorded = entry.get('model') or DEFAULT_MODELS['sonnet']
+    model = models.get(entry.get('tier') or model_tier(recorded)) or recorded
+    target = entry.get('target') or MESSAGES_PATH
+    if entry.get('body'):
+        try:
+            request = json.loads(entry['body'])
+        except ValueError:
+            request = None
+        if isinstance(request, dict):
+            request['model'] = model
+            return model, target, json.dumps(request).encode('utf-8')
+    body = synthetic_body(model, index, entry.get('request_bytes') or DEFAULT_REPLAY_BYTES,
+                          entry.get('max_tokens') or DEFAULT_REPLAY_MAX_TOKENS, entry.get('stream') is not False)
+    return model, target, body
+
+class Sample:
+    """Outcome of one benchmark request"""
+    def __init__(self, model):
+        self.model = model
+        self.error = None  # HTTP status or failure kind; None when the request succeeded
+        self.ttft = None
+        self.latency = None
+        self.output_tokens = 0
+
+    @property
+    def tokens_per_second(self):
+        """Output speed after the first token (the whole request for non-streamed replies)"""
+        generating = self.latency - self.ttft if self.ttft < self.latency else self.latency
+        if self.output_tokens < 2 or generating <= 0:
+            return None
+        return self.output_tokens / generating
+
+class LoadGenerator:
+    """Drives concurrency keep-alive connections against one upstream and collects Samples
+
+    With a trace file, replays it instead: each recorded request is sent at
+    its arrival offset divided by speed, on an idle connection or a new one.
+    """
+    def __init__(self, upstream, models, mix, concurrency=8, requests=None, duration=None, prompt_tokens=1000,
+                 max_tokens=256, stream=True, timeout=REQUEST_TIMEOUT, seed=None, trace=None, speed=1.0):
+        if concurrency < 1:
+            raise ValueError("Concurrency must be at least 1")
+        if requests is not None and requests < 1:
+            raise ValueError("Requests must be at least 1")
+        if duration is not None and duration <= 0:
+            raise ValueError("Duration must be positive")
+        if max_tokens < 1:
+            raise ValueError("Max tokens must be at least 1")
+        if speed <= 0:
+            raise ValueError("Replay speed must be positive")
+        self.upstream = upstream
+        self.models = models
+        self.mix = [(models.get(name) or DEFAULT_MODELS.get(name, name), weight) for name, weight in mix]
+        self.trace = trace
+        self.entries = load_trace(trace) if trace else None
+        self.speed = speed
+        self.concurrency = concurrency
+        self.requests = requests if requests is not None or duration is not None or trace else 100
+        self.duration = duration
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.stream = stream
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.samples = []
+        self._issued = 0
+        self._deadline = None
+        self._ssl_context = None
+        self._idle = []  # (connection, loop time it went idle) between replayed requests
+
+    def run(self):
+        """Run the benchmark to completion; returns the results dict"""
+        return asyncio.run(self._main())
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        start = loop.time()
+        if self.duration is not None:
+            self._deadline = start + self.duration
+        if self.entries:
+            await self._replay(start)
+        else:
+            await asyncio.gather(*(self._client() for _ in range(self.concurrency)))
+        return self.results(started, loop.time() - start)
+
+    def _next_request(self):
+        """Index and model of the next request, or None when the run is over"""
+        if self.requests is not None and self._issued >= self.requests:
+            return None
+        if self._deadline is not None and asyncio.get_running_loop().time() >= self._deadline:
+            return None
+        self._issued += 1
+        models, weights = zip(*self.mix)
+        return self._issued, self.random.choices(models, weights)[0]
+
+    async def _client(self):
+        connection = None
+        try:
+            while True:
+                request = self._next_request()
+                if request is None:
+                    break
+                index, model = request
+                body = synthetic_body(model, index, self.prompt_tokens * BYTES_PER_TOKEN, self.max_tokens, self.stream)
+                connection = await self._send(connection, Sample(model), MESSAGES_PATH, body)
+        finally:
+            if connection is not None:
+                connection[1].close()
+
+    async def _replay(self, start):
+        loop = asyncio.get_running_loop()
+        first = self.entries[0]['t']
+        tasks = []
+        try:
+            for index, entry in enumerate(self.entries[:self.requests], 1):
+                due = start + (entry['t'] - first) / self.speed
+                if self._deadline is not None and due >= self._deadline:
+                    break
+                await asyncio.sleep(due - loop.time())
+                tasks.append(asyncio.ensure_future(self._replay_one(index, entry)))
+            await asyncio.gather(*tasks)
+        finally:
+            for connection, _ in self._idle:
+                connection[1].close()
+
+    async def _replay_one(self, index, entry):
+        model, target, body = replay_request(entry, self.models, index)
+        loop = asyncio.get_running_loop()
+        connection = None
+        while self._idle and connection is None:
+            connection, idle_since = self._idle.pop()
+            # Servers drop idle connections; an old one would fail the request instead of measuring it
+            if loop.time() - idle_since > IDLE_CONNECTION_SECONDS:
+                connection[1].close()
+                connection = None
+        connection = await self._send(connection, Sample(model), target, body)
+        if connection is not None:
+            self._idle.append((connection, loop.time()))
+
+    async def _send(self, connection, sample, target, body):
+        """Run one request on connection (a new one if None); returns the connection if it can be reused"""
+        self.samples.append(sample)
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(self._connect(), self.timeout)
+            if await asyncio.wait_for(self._exchange(connection, sample, target, body), self.timeout):
+                return connection
+        except asyncio.TimeoutError:
+            sample.error = 'timeout'
+        except (OSError, asyncio.IncompleteReadError, ProxyError, ValueError):
+            sample.error = 'connection'
+        if connection is not None:
+            connection[1].close()
+        return None
+
+    async def _connect(self):
+        upstream = self.upstream
+        ssl_context = None
+        if upstream.tls:
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        return await asyncio.open_connection(upstream.host, upstream.port, ssl=ssl_context,
+                                             server_hostname=upstream.host if ssl_context else None,
+                                             limit=READ_SIZE)
+
+    async def _exchange(self, connection, sample, target, body):
+        """Send one request and read its whole response into sample; returns whether the connection is reusable"""
+        reader, writer = connection
+        upstream = self.upstream
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        writer.write(format_head(f"POST {upstream.base_path}{target} HTTP/1.1", [
+            ('Host', upstream.host_header),
+            ('Authorization', f"Bearer {upstream.api_key}"),
+            ('anthropic-version', ANTHROPIC_VERSION),
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Connection', 'keep-alive')
+        ]) + body)
+        await writer.drain()
+
+        while True:
+            head = await read_head(reader)
+            if head is None:
+                raise ConnectionError("Connection closed before a response")
+            status_line, headers = head
+            status = int(status_line.split(' ')[1])
+            if status >= 200:
+                break
+        framing = body_framing(headers, response=True)
+        reusable = framing[0] != 'eof' and 'close' not in (get_header(headers, 'connection') or '').lower()
+        streamed = (get_header(headers, 'content-type') or '').startswith('text/event-stream')
+
+        events, tail, parts = 0, b'', []
+        async for data in read_response_body(reader, *framing):
+            if not streamed:
+                parts.append(data)
+                continue
+            tail += data
+            *blocks, tail = tail.split(b'\n\n')
+            for block in blocks:
+                event = parse_event(block)
+                if event.get('type') == 'content_block_delta':
+                    events += 1
+                    if sample.ttft is None:
+                        sample.ttft = loop.time() - start
+                elif event.get('type') == 'message_delta':
+                    sample.output_tokens = (event.get('usage') or {}).get('output_tokens') or events
+                elif event.get('type') == 'error':
+                    sample.error = (event.get('error') or {}).get('type') or 'stream_error'
+        sample.latency = loop.time() - start
+
+        if status != 200:
+            sample.error = status
+        elif not streamed:
+            try:
+                usage = json.loads(b''.join(parts)).get('usage') or {}
+            except (ValueError, AttributeError):
+                sample.error = 'invalid_response'
+                return reusable
+            sample.ttft = sample.latency
+            sample.output_tokens = usage.get('output_tokens') or 0
+        elif sample.error is None and sample.ttft is None:
+            sample.error = 'empty_stream'
+        return reusable
+
+    def results(self, started, elapsed):
+        """Summary of the collected samples, as saved to JSON"""
+        succeeded = [sample for sample in self.samples if sample.error is None]
+        errors = {}
+        for sample in self.samples:
+            if sample.error is not None:
+                errors[str(sample.error)] = errors.get(str(sample.error), 0) + 1
+        by_model = {}
+        for model in dict.fromkeys(sample.model for sample in self.samples):
+            ok = [sample for sample in succeeded if sample.model == model]
+            by_model[model] = dict(summarize(ok), requests=sum(1 for sample in self.samples if sample.model == model))
+        output_tokens = sum(sample.output_tokens for sample in succeeded)
+        settings = {'requests': self.requests, 'duration': self.duration}
+        if self.trace:
+            settings.update(replay=str(self.trace), speed=self.speed)
+        else:
+            settings.update(concurrency=self.concurrency, mix=[list(entry) for entry in self.mix],
+                            prompt_tokens=self.prompt_tokens, max_tokens=self.max_tokens, stream=self.stream)
+        return {
+            'profile': self.upstream.name,
+            'base_url': self.upstream.base_url,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+            'settings': settings,
+            'elapsed_s': round(elapsed, 3),
+            'requests': len(self.samples),
+            'succeeded': len(succeeded),
+            'errors': errors,
+            'throughput_rps': round(len(succeeded) / elapsed, 2) if elapsed else None,
+            'output_tokens_per_s': round(output_tokens / elapsed, 1) if elapsed else None,
+            'output_tokens': output_tokens,
+            **summarize(succeeded),
+            'by_model': by_model,
+        }
+
+async def read_response_body(reader, framing, length):
+    """Yield a response body's data as it arrives, removing chunked framing"""
+    if framing == 'length':
+        while length > 0:
+            data = await reader.read(min(READ_SIZE, length))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', length)
+            length -= len(data)
+            yield data
+    elif framing == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                while (await reader.readline()).strip():
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+    elif framing == 'eof':
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return
+            yield data
+
+def parse_event(block):
+    """JSON data of one server-sent event ({} if it has none)"""
+    for line in block.split(b'\n'):
+        if line.startswith(b'data:'):
+            try:
+                return json.loads(line[5:])
+            except ValueError:
+                return {}
+    return {}
+
+def summarize(samples):
+    """TTFT, latency and per-request tokens/s percentiles (ms, ms, tokens/s) of successful samples"""
+    speeds = [sample.tokens_per_second for sample in samples]
+    return {'ttft_ms': percentiles([sample.ttft * 1000 for sample in samples]),
+            'latency_ms': percentiles([sample.latency * 1000 for sample in samples]),
+            'tokens_per_s': percentiles([speed for speed in speeds if speed is not None])}
+
+# Percentile lines of the report: label, results key
+REPORT_SPREADS = (('TTFT ms', 'ttft_ms'), ('Latency ms', 'latency_ms'), ('Tokens/s per request', 'tokens_per_s'))
+
+def format_results(results, previous=None):
+    """Human-readable report lines, with a previous run's numbers alongside when given"""
+    def number(value, *path):
+        text = "-" if value is None else f"{value:g}"
+        before = previous
+        for key in path:
+            before = before.get(key) if isinstance(before, dict) else None
+        if isinstance(before, (int, float)):
+            text += f" (was {before:g})"
+        return text
+
+    def spread(label, stats, *path):
+        if not stats:
+            return f"{label}: -"
+        return f"{label}: " + ", ".join(f"{p} {number(value, *path, p)}" for p, value in stats.items())
+
+    settings = results['settings']
+    if settings.get('replay'):
+        run = f"replay of {settings['replay']} at {settings['speed']:g}x speed"
+    else:
+        stop = f"{settings['requests']} requests" if settings['requests'] is not None else f"{settings['duration']:g} s"
+        run = (f"{stop}, {settings['concurrency']} concurrent, "
+               f"{'streamed' if settings['stream'] else 'not streamed'}")
+    errors = ", ".join(f"{kind} x{count}" for kind, count in results['errors'].items())
+    lines = [f"Benchmarked '{results['profile']}' ({results['base_url']}): {run}",
+             f"  Requests: {results['requests']} in {results['elapsed_s']:.1f} s, "
+             f"{number(results['succeeded'], 'succeeded')} succeeded" + (f", errors: {errors}" if errors else ""),
+             f"  Throughput: {number(results['throughput_rps'], 'throughput_rps')} requests/s, "
+             f"{number(results['output_tokens_per_s'], 'output_tokens_per_s')} output tokens/s"]
+    lines += [f"  {spread(label, results[key], key)}" for label, key in REPORT_SPREADS]
+    if len(results['by_model']) > 1:
+        for model, stats in results['by_model'].items():
+            lines.append(f"  {model}: {stats['requests']} requests; "
+                         + "; ".join(spread(label, stats[key], 'by_model', model, key)
+                                     for label, key in REPORT_SPREADS[:2]))
+    return lines
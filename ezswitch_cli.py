@@ -0,0 +1,704 @@
+"""Headless command line interface for Claude Code EZ Switch
+
+    ezswitch apply zai [--key NAME] [--opus MODEL] [--sonnet MODEL] [--haiku MODEL]
+    ezswitch apply subscription
+    ezswitch apply api [--key - | --key API_KEY]
+    ezswitch apply custom [--url URL] [--key - | --key API_KEY]
+    ezswitch apply proxy [--upstream zai|api|custom] [--port PORT]
+                         [--pool NAME... | --pool all | --pool none] [--strategy round-robin|least-outstanding|sticky]
+                         [--route TIER_OR_GLOB=UPSTREAM[:MODEL] ... | --route none]
+                         [--hedge UPSTREAM[:DELAY_MS] | --hedge none]
+                         [--failover UPSTREAM[,UPSTREAM...][:LATENCY_MS[:ERROR_RATE]] | --failover none]
+                         [--max-concurrency N] [--record TRACE_FILE [--record-bodies] | --record none]
+    ezswitch status [--json]
+    ezswitch list-keys
+    ezswitch serve [--proxy]
+    ezswitch proxy [--port PORT] [--workers N]
+    ezswitch mock [--port PORT] [--latency MS|MIN-MAX|lognormal:MEDIAN[:SIGMA]] [--tokens-per-second N]
+                  [--output-tokens N] [--rate-limit P] [--errors P] [--error-status CODE] [--resets P] [--seed N]
+    ezswitch bench zai|api|custom|proxy [--key NAME] [--concurrency N] [--requests N | --duration SECONDS]
+                   [--mix TIER_OR_MODEL[:WEIGHT],...] [--prompt-tokens N] [--max-tokens N] [--no-stream]
+                   [--replay TRACE_FILE [--speed X]] [--output FILE] [--compare FILE] [--json]
+    ezswitch usage [--days N] [--json] [--projects-dir DIR] [--rebuild] [--jobs N]
+
+Uses the same settings.json/config.json logic as the GUI but never imports
+tkinter or the win32 modules, so it starts fast and works without a display.
+When an instance is resident (the GUI or 'ezswitch serve'), commands are
+forwarded to it over IPC and run there with warm caches. API keys are best
+passed as '--key -' (read from stdin) or in $EZSWITCH_API_KEY, so they stay
+out of ps and shell history; commands given a key always run locally.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+import ezswitch_core as core
+
+# Key for 'apply api' and 'apply custom' when --key is not given; unlike argv, not visible in ps
+API_KEY_ENV = "EZSWITCH_API_KEY"
+
+def build_parser():
+    """Build the argument parser for all subcommands"""
+    parser = argparse.ArgumentParser(prog="ezswitch",
+                                     description="Switch Claude Code between Z.ai, Claude and custom endpoints")
+    parser.add_argument("--settings-file", type=Path, default=core.CLAUDE_SETTINGS_FILE,
+                        help="Claude Code settings.json to modify (default: %(default)s)")
+    parser.add_argument("--config-dir", type=Path, default=core.CONFIG_DIR,
+                        help="EZ Switch config directory (default: %(default)s)")
+    parser.add_argument("--no-resident", action="store_true",
+                        help="Run locally even if a resident instance is running")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    apply_parser = subparsers.add_parser("apply", help="Apply a configuration to settings.json")
+    profiles = apply_parser.add_subparsers(dest="profile", required=True)
+
+    zai_parser = profiles.add_parser("zai", help="Use a saved Z.ai key")
+    zai_parser.add_argument("--key", metavar="NAME", help="Name of the saved Z.ai key (default: last used)")
+    for tier in core.MODEL_TIERS:
+        zai_parser.add_argument(f"--{tier}", choices=core.AVAILABLE_MODELS,
+                                help=f"GLM model for the {tier.title()} tier")
+
+    profiles.add_parser("subscription", help="Clear overrides and use the Claude subscription")
+
+    api_parser = profiles.add_parser("api", help="Use a Claude API key")
+    api_parser.add_argument("--key", metavar="API_KEY",
+                            help=f"Claude API key, or - to read it from stdin (default: ${API_KEY_ENV}, then saved key)")
+
+    custom_parser = profiles.add_parser("custom", help="Use a custom Anthropic-compatible endpoint")
+    custom_parser.add_argument("--url", help="Base URL (default: saved URL)")
+    custom_parser.add_argument("--key", metavar="API_KEY",
+                               help=f"API key, or - to read it from stdin (default: ${API_KEY_ENV}, then saved key)")
+
+    proxy_parser = profiles.add_parser("proxy", help="Route Claude Code through the local EZ Switch proxy")
+    proxy_parser.add_argument("--upstream", choices=core.PROXY_UPSTREAMS,
+                              help="Stored profile the proxy forwards to (default: last used)")
+    proxy_parser.add_argument("--port", type=int, help=f"Local proxy port (default: {core.DEFAULT_PROXY_PORT})")
+    proxy_parser.add_argument("--pool", nargs="+", metavar="NAME",
+                              help="Saved Z.ai keys to rotate across ('all' for every key, 'none' to stop rotating)")
+    proxy_parser.add_argument("--strategy", choices=core.KEY_STRATEGIES,
+                              help="How pooled keys are picked (default: last used, else round-robin)")
+    proxy_parser.add_argument("--route", action="append", metavar="MATCH=UPSTREAM[:MODEL]",
+                              help="Send a tier (opus, sonnet, haiku) or model glob to another stored profile, "
+                                   "optionally renaming the model; repeat for more, 'none' to clear")
+    proxy_parser.add_argument("--hedge", metavar="UPSTREAM[:DELAY_MS]",
+                              help="Also send requests that have not started after DELAY_MS (default: observed p95) "
+                                   "to another stored profile; 'none' to stop")
+    proxy_parser.add_argument("--failover", metavar="UPSTREAM[,UPSTREAM...][:LATENCY_MS[:ERROR_RATE]]",
+                              help="Stored profiles to fail over to, in order, when the routed one errors or its "
+                                   "circuit is open; a circuit opens at ERROR_RATE failures (default 0.5) or "
+                                   "streams slower than LATENCY_MS to start (default 20000); 'none' to stop")
+    proxy_parser.add_argument("--max-concurrency", type=int, metavar="N",
+                              help="Requests each key runs at once; more wait in a fair queue shared between "
+                                   "sessions, Opus/Sonnet ahead of Haiku (0 for no limit)")
+    proxy_parser.add_argument("--record", metavar="TRACE_FILE",
+                              help="Append each request's model, size, streaming flag and timing to TRACE_FILE "
+                                   "for 'ezswitch bench --replay'; 'none' to stop")
+    proxy_parser.add_argument("--record-bodies", action="store_true",
+                              help="With --record, also keep request bodies (up to 1 MiB) in the trace")
+
+    status_parser = subparsers.add_parser("status", help="Show the active configuration")
+    status_parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+
+    subparsers.add_parser("list-keys", help="List saved Z.ai keys")
+
+    serve_parser = subparsers.add_parser("serve", help="Stay resident and run forwarded commands (no GUI)")
+    serve_parser.add_argument("--proxy", action="store_true", help="Also run the local proxy")
+
+    proxy_parser = subparsers.add_parser("proxy", help="Run the local proxy in the foreground")
+    proxy_parser.add_argument("--port", type=int, help="Port to listen on (default: saved proxy port)")
+    proxy_parser.add_argument("--workers", type=int, default=1, metavar="N",
+                              help="Worker processes sharing the port, for many concurrent sessions (not on Windows)")
+
+    mock_parser = subparsers.add_parser("mock", help="Run a mock Anthropic API to use as a Custom base URL")
+    mock_parser.add_argument("--port", type=int, default=18790, help="Port to listen on (default: %(default)s)")
+    mock_parser.add_argument("--latency", default="0", metavar="SPEC",
+                             help="Time to first token in ms: MS, MIN-MAX (uniform) or lognormal:MEDIAN[:SIGMA]")
+    mock_parser.add_argument("--tokens-per-second", type=float, default=0, metavar="N",
+                             help="Output speed after the first token (default: instant)")
+    mock_parser.add_argument("--output-tokens", type=int, default=200, metavar="N",
+                             help="Tokens per reply, capped by the request's max_tokens (default: %(default)s)")
+    mock_parser.add_argument("--rate-limit", type=float, default=0.0, metavar="P",
+                             help="Share of requests answered 429 with Retry-After")
+    mock_parser.add_argument("--errors", type=float, default=0.0, metavar="P",
+                             help="Share of requests answered with --error-status")
+    mock_parser.add_argument("--error-status", type=int, default=529, metavar="CODE",
+                             help="5xx status of injected errors (default: %(default)s overloaded)")
+    mock_parser.add_argument("--resets", type=float, default=0.0, metavar="P",
+                             help="Share of connections reset before or during the reply")
+    mock_parser.add_argument("--seed", type=int, help="Seed for repeatable latencies and faults")
+
+    bench_parser = subparsers.add_parser("bench", help="Benchmark a stored profile with synthetic requests")
+    bench_parser.add_argument("profile", choices=core.PROXY_UPSTREAMS + ["proxy"],
+                              help="Stored profile to send requests to, or the local proxy")
+    bench_parser.add_argument("--key", metavar="NAME", help="Saved Z.ai key to use (default: the selected one)")
+    bench_parser.add_argument("--concurrency", type=int, default=8, metavar="N",
+                              help="Requests in flight at once (default: %(default)s)")
+    bench_limit = bench_parser.add_mutually_exclusive_group()
+    bench_limit.add_argument("--requests", type=int, metavar="N", help="Requests to send (default: 100)")
+    bench_limit.add_argument("--duration", type=float, metavar="SECONDS", help="Send requests for this long instead")
+    bench_parser.add_argument("--mix", default="sonnet:3,haiku:1", metavar="TIER_OR_MODEL[:WEIGHT],...",
+                              help="Models to send and their shares (default: %(default)s)")
+    bench_parser.add_argument("--prompt-tokens", type=int, default=1000, metavar="N",
+                              help="Approximate prompt size (default: %(default)s)")
+    bench_parser.add_argument("--max-tokens", type=int, default=256, metavar="N",
+                              help="max_tokens of each request (default: %(default)s)")
+    bench_parser.add_argument("--no-stream", action="store_true", help="Request whole JSON replies instead of SSE")
+    bench_parser.add_argument("--replay", type=Path, metavar="TRACE_FILE",
+                              help="Re-send the requests of a trace recorded with 'apply proxy --record' instead")
+    bench_parser.add_argument("--speed", type=float, default=1.0, metavar="X",
+                              help="With --replay, send requests X times faster than recorded (default: %(default)s)")
+    bench_parser.add_argument("--output", type=Path, metavar="FILE",
+                              help="Where to save the JSON results (default: a new file in <config-dir>/bench)")
+    bench_parser.add_argument("--compare", type=Path, metavar="FILE", help="Show a saved result's numbers alongside")
+    bench_parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    usage_parser = subparsers.add_parser("usage", help="Token usage and response times per profile, "
+                                                       "from Claude Code's transcripts")
+    usage_parser.add_argument("--days", type=int, metavar="N", help="Only the last N days (default: all)")
+    usage_parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+    usage_parser.add_argument("--projects-dir", type=Path, default=core.CLAUDE_SETTINGS_DIR / "projects",
+                              help="Claude Code transcripts directory (default: %(default)s)")
+    usage_parser.add_argument("--rebuild", action="store_true", help="Forget the index and read every transcript again")
+    usage_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, metavar="N",
+                              help="Processes for a large backfill (default: one per core)")
+    return parser
+
+# Commands that run until interrupted, or for minutes, and are never forwarded to the resident instance
+LONG_RUNNING_COMMANDS = ("serve", "proxy", "mock", "bench", "usage")
+
+def fail(message):
+    """Print an error to stderr and return the failure exit code"""
+    print(f"Error: {message}", file=sys.stderr)
+    return 1
+
+def read_api_key(value):
+    """Resolve --key of 'apply api/custom': '-' reads stdin (prompting on a terminal), None reads $EZSWITCH_API_KEY"""
+    if value == "-":
+        if sys.stdin.isatty():
+            import getpass
+            return getpass.getpass("API key: ").strip() or None
+        return sys.stdin.readline().strip() or None
+    if value is None:
+        return os.environ.get(API_KEY_ENV) or None
+    print(f"Warning: An API key on the command line is visible to other processes and saved in shell history; "
+          f"use --key - or ${API_KEY_ENV} instead", file=sys.stderr)
+    return value
+
+def build_profile(args, store):
+    """Build the Profile selected on the command line, falling back to saved values"""
+    if args.profile == "zai":
+        key_name = args.key or store.get('current_zai_key_name')
+        if not key_name:
+            raise ValueError("No Z.ai key selected; pass --key NAME (see 'ezswitch list-keys')")
+        if key_name not in store.zai_keys:
+            raise ValueError(f"No saved Z.ai key named '{key_name}'")
+
+        # Keep the models already configured unless overridden
+        current_env = core.read_claude_settings(args.settings_file).get('env') or {}
+        models = []
+        for tier in core.MODEL_TIERS:
+            model = getattr(args, tier) or current_env.get(f'ANTHROPIC_DEFAULT_{tier.upper()}_MODEL')
+            models.append(model if model in core.AVAILABLE_MODELS else core.DEFAULT_ZAI_MODEL)
+        return core.ZaiProfile(store.zai_keys[key_name], key_name, *models)
+
+    elif args.profile == "subscription":
+        return core.ClaudeSubscriptionProfile()
+
+    elif args.profile == "api":
+        return core.ClaudeApiProfile(args.key or store.get('claude_key'))
+
+    elif args.profile == "proxy":
+        profile = core.proxy_profile(store, args.upstream, args.port, key_pool_names(args.pool, store),
+                                     args.strategy, parse_routes(args.route), parse_hedge(args.hedge),
+                                     parse_failover(args.failover), args.max_concurrency,
+                                     parse_record(args.record, args.record_bodies))
+        if args.pool and args.pool != ["none"] and profile.upstream != 'zai':
+            raise ValueError("--pool only applies to the 'zai' upstream")
+        # Fail now rather than on Claude Code's next request
+        targets = {profile.upstream} | {route['upstream'] for route in profile.routes}
+        if profile.hedge:
+            targets.add(profile.hedge['upstream'])
+        targets.update(profile.failover.get('upstreams') or [])
+        if profile.key_pool:
+            targets.discard('zai')
+        for name in sorted(targets):
+            error = core.stored_profile(store, name).validate() if name in core.PROXY_UPSTREAMS else None
+            if error:
+                raise ValueError(f"Upstream '{name}' is not configured: {error}")
+        return profile
+
+    else:
+        return core.CustomProfile(args.url or store.get('custom_url'),
+                                  args.key or store.get('custom_key'))
+
+def key_pool_names(pool, store):
+    """Resolve --pool arguments to saved key names (None keeps the saved pool)"""
+    if pool is None:
+        return None
+    if pool == ["none"]:
+        return []
+    if pool == ["all"]:
+        return sorted(store.zai_keys)
+    missing = [name for name in pool if name not in store.zai_keys]
+    if missing:
+        raise ValueError(f"No saved Z.ai key named {', '.join(repr(name) for name in missing)}")
+    return list(dict.fromkeys(pool))
+
+def parse_routes(values):
+    """Turn --route MATCH=UPSTREAM[:MODEL] arguments into proxy routes (None keeps the saved ones)"""
+    if values is None:
+        return None
+    if values == ["none"]:
+        return []
+    routes = []
+    for value in values:
+        match, sep, target = value.partition("=")
+        upstream, _, model = target.partition(":")
+        if not sep or not match or not upstream:
+            raise ValueError(f"Invalid --route '{value}'; expected MATCH=UPSTREAM[:MODEL], e.g. haiku=zai:GLM-4.5-Air")
+        route = {'match': match, 'upstream': upstream}
+        if model:
+            route['model'] = model
+        routes.append(route)
+    return routes
+
+def parse_hedge(value):
+    """Turn --hedge UPSTREAM[:DELAY_MS] into a proxy hedge policy (None keeps the saved one)"""
+    if value is None:
+        return None
+    if value == "none":
+        return {}
+    upstream, _, delay = value.partition(":")
+    if not delay:
+        return {'upstream': upstream}
+    try:
+        return {'upstream': upstream, 'delay_ms': int(delay)}
+    except ValueError:
+        raise ValueError(f"Invalid --hedge delay '{delay}'; expected milliseconds, e.g. api:1500")
+
+def parse_failover(value):
+    """Turn --failover UPSTREAMS[:LATENCY_MS[:ERROR_RATE]] into a failover policy (None keeps the saved one)"""
+    if value is None:
+        return None
+    if value == "none":
+        return {}
+    upstreams, _, thresholds = value.partition(":")
+    failover = {'upstreams': list(dict.fromkeys(name for name in upstreams.split(",") if name))}
+    latency, _, error_rate = thresholds.partition(":")
+    try:
+        if latency:
+            failover['latency_ms'] = int(latency)
+        if error_rate:
+            failover['error_rate'] = float(error_rate)
+    except ValueError:
+        raise ValueError(f"Invalid --failover thresholds '{thresholds}'; expected LATENCY_MS[:ERROR_RATE], "
+                         "e.g. api,custom:15000:0.3")
+    return failover
+
+def parse_record(value, bodies=False):
+    """Turn --record TRACE_FILE|none into a recording setting (None keeps the saved one)"""
+    if value is None:
+        if bodies:
+            raise ValueError("--record-bodies needs --record TRACE_FILE")
+        return None
+    if value == "none":
+        return {}
+    return {'path': str(Path(value).expanduser().resolve()), 'bodies': bodies}
+
+def cmd_apply(args):
+    """Apply a profile to settings.json and remember it in config.json"""
+    store = core.ConfigStore(args.config_dir / "config.json").load()
+    profile = build_profile(args, store)
+    if profile.kind == "proxy" and profile.max_concurrency:
+        import ezswitch_proxy
+
+        workers = (ezswitch_proxy.proxy_health(profile.port) or {}).get('workers', 1)
+        if profile.max_concurrency < workers:
+            return fail(f"--max-concurrency {profile.max_concurrency} is below the running proxy's {workers} "
+                        f"worker processes; each worker needs at least one slot per key")
+
+    previous_env = core.read_claude_settings(args.settings_file).get('env') or {}
+    success, output = core.apply_profile(profile, args.settings_file, store)
+    if not success:
+        return fail(output)
+
+    if profile.kind == "proxy":
+        return report_proxy_switch(profile, previous_env)
+    print(f"Applied {profile.describe()}: {output}. Restart Claude Code for changes to take effect.")
+    return 0
+
+def report_proxy_switch(profile, previous_env):
+    """Explain whether running sessions picked up a proxy switch and whether the proxy is up"""
+    import ezswitch_proxy
+
+    if previous_env.get('ANTHROPIC_BASE_URL') == core.proxy_base_url(profile.port):
+        print(f"Proxy now forwards to '{profile.upstream}'; running Claude Code sessions use it on their next request.")
+    else:
+        print(f"Applied {profile.describe()}. Restart Claude Code once to start using the proxy.")
+    if ezswitch_proxy.proxy_health(profile.port) is None:
+        print(f"Warning: no proxy is listening on port {profile.port}; start one with 'ezswitch proxy' "
+              "or keep the EZ Switch window open.", file=sys.stderr)
+        return 0
+
+    # Connect to the new upstream now so the next request does not pay for DNS, TCP and TLS
+    reply = ezswitch_proxy.proxy_prewarm(profile.port, profile.token) or {}
+    if not reply.get('ok'):
+        error = (reply.get('error') or {}).get('message', "no reply")
+        print(f"Warning: the proxy could not connect to '{profile.upstream}' yet: {error}", file=sys.stderr)
+    return 0
+
+def cmd_status(args):
+    """Print the active configuration"""
+    settings = core.read_claude_settings(args.settings_file)
+    env = settings.get('env') or {}
+    store = core.ConfigStore(args.config_dir / "config.json").load()
+    profile = core.detect_profile(env, store)
+    proxy = proxy_status(args, env, store) if profile == 'proxy' else None
+    if args.json:
+        print(json.dumps({
+            'profile': profile,
+            'base_url': env.get('ANTHROPIC_BASE_URL'),
+            'models': {tier: env.get(f'ANTHROPIC_DEFAULT_{tier.upper()}_MODEL')
+                       for tier in core.MODEL_TIERS},
+            'proxy': proxy,
+            'settings_file': str(args.settings_file)
+        }, indent=2))
+        return 0
+
+    is_configured, status_text = core.describe_status(settings, store)
+    print(status_text)
+    if proxy is not None:
+        print(f"Proxy upstream: {proxy['upstream']} ({'running' if proxy['running'] else 'not running'})")
+        for route in proxy['routes']:
+            model = f" as {route['model']}" if route.get('model') else ""
+            print(f"  route {route['match']} -> {route['upstream']}{model}")
+        for warning in proxy.get('warnings') or []:
+            print(f"  Warning: {warning}")
+        for name, hedge in ((proxy.get('hedging') or {}).get('profiles') or {}).items():
+            print(f"  {name}: hedged {hedge['hedge_rate']:.0%} of {hedge['requests']} requests after "
+                  f"{hedge['delay_ms']} ms, hedge won {hedge['win_rate']:.0%}")
+        failover = proxy.get('failover')
+        if failover:
+            print(f"  fails over to {', '.join(failover['upstreams'])} ({failover['failovers']} requests so far)")
+            for name, breaker in failover['breakers'].items():
+                state = f"open, probing in {breaker['retry_in']}s" if breaker['state'] == 'open' else breaker['state']
+                print(f"  circuit {name}: {state}, {breaker['failure_rate']:.0%} of last {breaker['samples']} "
+                      f"failed, tripped {breaker['trips']} times")
+        affinity = proxy.get('affinity')
+        if affinity and affinity['follow_ups']:
+            print(f"  cache affinity: {affinity['hit_rate']:.0%} of {affinity['follow_ups']} follow-up requests "
+                  f"stayed on their key/profile ({affinity['conversations']} conversations)")
+        for name, queue in (proxy.get('scheduler') or {}).items():
+            waits = ", ".join(f"{priority} p95 {wait['p95_ms']} ms" for priority, wait in queue['waits'].items())
+            print(f"  queue {name}: {queue['active']}/{queue['limit']} running, {queue['waiting']} waiting"
+                  + (f"; waits {waits}" if waits else ""))
+        recording = proxy.get('recording')
+        if recording:
+            print(f"  recording to {recording['path']} ({recording['recorded']} requests so far)")
+        for name, key in (proxy.get('keys') or {}).items():
+            state = f"rate limited, back in {key['retry_in']}s" if key['retry_in'] else "available"
+            print(f"  {name}: {key['requests']} requests, {key['outstanding']} in flight, {state}")
+    return 0 if is_configured else 1
+
+def proxy_status(args, env, store):
+    """Upstream and liveness of the proxy settings.json points at"""
+    import ezswitch_proxy
+    from urllib.parse import urlsplit
+
+    port = urlsplit(env['ANTHROPIC_BASE_URL']).port or core.DEFAULT_PROXY_PORT
+    health = ezswitch_proxy.proxy_health(port)
+    status = {'upstream': store.get('proxy_upstream'), 'port': port, 'running': health is not None,
+              'routes': store.get('proxy_routes') or []}
+    if health and 'routed' in health:
+        status.update(routed=health['routed'], warnings=health['warnings'])
+    if health and 'hedging' in health:
+        status['hedging'] = health['hedging']
+    if health and 'failover' in health:
+        status['failover'] = health['failover']
+    if health and 'affinity' in health:
+        status['affinity'] = health['affinity']
+    if health and 'scheduler' in health:
+        status['scheduler'] = health['scheduler']
+    if health and 'recording' in health:
+        status['recording'] = health['recording']
+    if health and health.get('keys'):
+        status.update(key_strategy=health.get('key_strategy'), keys=health['keys'])
+    return status
+
+def cmd_list_keys(args):
+    """List saved Z.ai key names, marking the last used one"""
+    store = core.ConfigStore(args.config_dir / "config.json").load()
+    current = store.get('current_zai_key_name')
+    if not store.zai_keys:
+        print("No saved Z.ai keys")
+        return 0
+    for name in sorted(store.zai_keys):
+        print(f"{'*' if name == current else ' '} {name}")
+    return 0
+
+def cmd_serve(args):
+    """Run a headless resident instance until interrupted"""
+    import ezswitch_ipc
+
+    args.config_dir.mkdir(exist_ok=True)
+    server = ezswitch_ipc.ResidentServer(handle_request, args.config_dir)
+    if not server.start():
+        return fail("Another EZ Switch instance is already running")
+
+    print(f"EZ Switch resident instance listening on {server.address}", flush=True)
+    proxy = None
+    if args.proxy:
+        import ezswitch_proxy
+        try:
+            proxy = ezswitch_proxy.ProxyServer(args.config_dir / "config.json").start_in_thread()
+            print(f"EZ Switch proxy listening on {proxy.host}:{proxy.port}", flush=True)
+        except OSError as e:
+            print(f"Warning: Could not start the proxy: {e}", file=sys.stderr)
+    if not core.IS_WINDOWS:
+        # Remove the socket on 'kill' as well as on Ctrl+C
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        if proxy is not None:
+            proxy.stop()
+    return 0
+
+def cmd_proxy(args):
+    """Run the local proxy in the foreground until interrupted"""
+    import ezswitch_proxy
+
+    config_file = args.config_dir / "config.json"
+    port = args.port or core.ConfigStore(config_file).load().get('proxy_port') or core.DEFAULT_PROXY_PORT
+    proxy = ezswitch_proxy.ProxyServer(config_file, port=port)
+    config = proxy.config()
+    if not config.token:
+        print("Warning: no proxy token saved yet; run 'ezswitch apply proxy' to point Claude Code here",
+              file=sys.stderr)
+    elif config.upstream is None:
+        print(f"Warning: {config.error}", file=sys.stderr)
+
+    if not core.IS_WINDOWS:
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: proxy.stop())
+    workers = args.workers
+    if workers < 1:
+        return fail("--workers must be at least 1")
+    if workers > 1 and core.IS_WINDOWS:
+        print("Warning: worker processes need SO_REUSEPORT, which Windows lacks; running one", file=sys.stderr)
+        workers = 1
+    if config.max_concurrency and config.max_concurrency < workers:
+        return fail(f"The concurrency limit ({config.max_concurrency} per key) is split between worker processes "
+                    f"and must be at least --workers {workers}")
+    target = f"{len(config.upstreams)} Z.ai keys ({config.key_strategy})" if config.pooled else f"'{config.upstream_name}'"
+    print(f"EZ Switch proxy forwarding to {target} "
+          f"on {proxy.host}:{proxy.port}{f' with {workers} workers' if workers > 1 else ''} (Ctrl+C to stop)",
+          flush=True)
+    try:
+        if workers > 1:
+            ezswitch_proxy.run_workers(config_file, proxy.host, proxy.port, workers)
+        else:
+            proxy.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        return fail(f"Could not start the proxy: {e}")
+    return 0
+
+def cmd_mock(args):
+    """Run the mock Anthropic API in the foreground until interrupted"""
+    import ezswitch_mock
+
+    try:
+        mock = ezswitch_mock.MockServer(port=args.port, latency=args.latency,
+                                        tokens_per_second=args.tokens_per_second, output_tokens=args.output_tokens,
+                                        rate_limit=args.rate_limit, errors=args.errors,
+                                        error_status=args.error_status, resets=args.resets, seed=args.seed)
+    except ValueError as e:
+        return fail(str(e))
+
+    if not core.IS_WINDOWS:
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: mock.stop())
+    print(f"Mock Anthropic API on http://{mock.host}:{mock.port} ({mock.describe()}); "
+          f"use it as a Custom base URL with any key (Ctrl+C to stop)", flush=True)
+    try:
+        mock.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        return fail(f"Could not start the mock API: {e}")
+    counts = mock.counts
+    print(f"Served {counts['requests']} requests: {counts['rate_limited']} rate limited, "
+          f"{counts['errors']} errors, {counts['resets']} resets")
+    return 0
+
+def cmd_bench(args):
+    """Send synthetic Messages API traffic to a profile and report its latency and throughput"""
+    import time
+    import ezswitch_bench
+
+    store = core.ConfigStore(args.config_dir / "config.json").load()
+    previous = None
+    try:
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                previous = json.load(f)
+        upstream, models = ezswitch_bench.bench_target(store, args.profile, args.key)
+        generator = ezswitch_bench.LoadGenerator(upstream, models, ezswitch_bench.parse_mix(args.mix),
+                                                 args.concurrency, args.requests, args.duration, args.prompt_tokens,
+                                                 args.max_tokens, stream=not args.no_stream, trace=args.replay,
+                                                 speed=args.speed)
+    except (OSError, ValueError) as e:
+        return fail(str(e))
+
+    if not args.json:
+        print(f"Benchmarking '{args.profile}' at {upstream.base_url} (Ctrl+C to stop)...", flush=True)
+    try:
+        results = generator.run()
+    except KeyboardInterrupt:
+        return fail("Benchmark interrupted")
+
+    output = args.output or (args.config_dir / "bench" / f"{args.profile}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    try:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        core.atomic_write_json(output, results, indent=2, fsync=False)
+    except OSError as e:
+        print(f"Warning: Could not save results to {output}: {e}", file=sys.stderr)
+        output = None
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("\n".join(ezswitch_bench.format_results(results, previous)))
+        if output:
+            print(f"Saved results to {output}")
+    return 0 if results['succeeded'] else 1
+
+def cmd_usage(args):
+    """Bring the usage index up to date with the transcripts and print usage per profile"""
+    import time
+    import ezswitch_usage
+
+    index = ezswitch_usage.UsageIndex(args.config_dir / ezswitch_usage.INDEX_NAME)
+    if not args.rebuild:
+        index.load()
+    history = core.load_switch_history(args.config_dir / core.SWITCH_HISTORY_NAME)
+    try:
+        stats = index.refresh(args.projects_dir, history, jobs=max(1, args.jobs))
+    except KeyboardInterrupt:
+        return fail("Usage indexing interrupted; run 'ezswitch usage' again to continue")
+    try:
+        index.save()
+    except OSError as e:
+        print(f"Warning: Could not save the usage index {index.path}: {e}", file=sys.stderr)
+    since = time.strftime('%Y-%m-%d', time.localtime(time.time() - (args.days - 1) * 86400)) if args.days else None
+    report = index.report(since)
+
+    if args.json:
+        print(json.dumps({'since': since, 'index': stats, 'profiles': report}, indent=2))
+        return 0
+    megabytes = stats['bytes'] / 1048576
+    line = (f"Indexed {stats['files']} transcripts: {stats['updated']} updated, "
+            f"{megabytes:.1f} MB read in {stats['seconds']:.2f} s")
+    if stats['updated'] and stats['seconds']:
+        line += (f" ({stats['updated'] / stats['seconds']:.0f} files/s, {megabytes / stats['seconds']:.1f} MB/s"
+                 + (f", {stats['jobs']} processes)" if stats['jobs'] > 1 else ")"))
+    print(line)
+    if not report:
+        print("No usage recorded" + (f" since {since}" if since else ""))
+    for label, usage in report.items():
+        print(f"{label}: {ezswitch_usage.format_summary(usage['total'])}")
+        for model, summary in usage['models'].items():
+            print(f"  {model}: {ezswitch_usage.format_summary(summary)}")
+    return 0
+
+COMMANDS = {
+    "apply": cmd_apply,
+    "status": cmd_status,
+    "list-keys": cmd_list_keys,
+    "serve": cmd_serve,
+    "proxy": cmd_proxy,
+    "mock": cmd_mock,
+    "bench": cmd_bench,
+    "usage": cmd_usage,
+}
+
+def forward_to_resident(argv, config_dir):
+    """Run the command in the resident instance; returns its exit code, or None if none is running
+
+    A command that reached the instance is never run again locally, even if its reply times out.
+    """
+    import ezswitch_ipc
+
+    try:
+        reply = ezswitch_ipc.send_request({'command': 'cli', 'argv': argv, 'cwd': os.getcwd()}, config_dir,
+                                          at_most_once=True)
+    except TimeoutError as e:
+        return fail(str(e))
+    if not reply or not reply.get('ok'):
+        return None
+    sys.stdout.write(reply.get('stdout', ''))
+    sys.stderr.write(reply.get('stderr', ''))
+    return reply.get('exit_code', 1)
+
+# Forwarded commands share the process-wide stdout/stderr, so run them one at a time
+_request_lock = threading.Lock()
+
+def handle_request(request):
+    """IPC handler for the resident instance: run a forwarded CLI command and capture its output"""
+    import io
+    from contextlib import redirect_stdout, redirect_stderr
+
+    if request.get('command') != 'cli':
+        return {'ok': False, 'error': f"Unsupported command: {request.get('command')}"}
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    with _request_lock, redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            exit_code = main(list(request.get('argv', [])), cwd=request.get('cwd') or os.getcwd())
+        except SystemExit as e:
+            # argparse exits on --help and usage errors
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    return {'ok': True, 'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+def main(argv=None, cwd=None):
+    """CLI entry point; returns the process exit code
+
+    cwd is set when the command was forwarded from another process; relative
+    paths are then resolved against the caller's working directory.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    args = build_parser().parse_args(argv)
+
+    takes_key = cwd is None and args.command == "apply" and args.profile in ("api", "custom")
+    if takes_key:
+        # Resolved here and the command then run here, so the key never travels over IPC
+        args.key = read_api_key(args.key)
+
+    if cwd is not None:
+        if args.command in LONG_RUNNING_COMMANDS:
+            return fail(f"'{args.command}' cannot run inside the resident instance")
+        args.settings_file = Path(cwd) / args.settings_file
+        args.config_dir = Path(cwd) / args.config_dir
+        if getattr(args, 'record', None) not in (None, "none"):
+            args.record = str(Path(cwd) / args.record)
+    elif args.command not in LONG_RUNNING_COMMANDS and not args.no_resident and not (takes_key and args.key):
+        exit_code = forward_to_resident(argv, args.config_dir)
+        if exit_code is not None:
+            return exit_code
+
+    try:
+        return COMMANDS[args.command](args)
+    except (OSError, ValueError) as e:
+        return fail(str(e))
+
+if __name__ == "__main__":
+    sys.exit(main())
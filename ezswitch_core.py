@@ -0,0 +1,1037 @@
+"""Settings and config logic for Claude Code EZ Switch, shared by the GUI and the CLI
+
+This module must stay importable without tkinter or the win32 modules so the
+headless CLI starts quickly and works over SSH.
+"""
+import copy
+import os
+import sys
+import threading
+import json
+import select
+import struct
+import time
+from pathlib import Path
+
+# Platform detection
+IS_WINDOWS = sys.platform == "win32"
+IS_LINUX = sys.platform.startswith("linux")
+IS_MACOS = sys.platform == "darwin"
+
+# Advisory file locking primitives (fcntl on POSIX, msvcrt on Windows);
+# only try the one that exists since failed imports scan all of sys.path
+if IS_WINDOWS:
+    import msvcrt
+    fcntl = None
+else:
+    import fcntl
+    msvcrt = None
+
+# Default locations
+CONFIG_DIR = Path.home() / ".claude_ez_switch"
+CONFIG_FILE = CONFIG_DIR / "config.json"
+LEGACY_CONFIG_FILE = Path.home() / ".claude_code_ez_switch_config.json"
+CLAUDE_SETTINGS_DIR = Path.home() / ".claude"
+CLAUDE_SETTINGS_FILE = CLAUDE_SETTINGS_DIR / "settings.json"
+# Next to config.json: one line per applied profile, for attributing usage to profiles over time
+SWITCH_HISTORY_NAME = "history.jsonl"
+
+class SettingsFileCache:
+    """In-memory cache of parsed JSON files, validated against each file's stat signature"""
+    def __init__(self):
+        self._entries = {}  # Format: {path: ((st_ino, st_mtime_ns, st_size), data)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _signature(path):
+        """Return the (inode, mtime, size) triple used to detect file changes"""
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self, path, loader):
+        """Return the parsed content of path, calling loader(path) only when the file changed"""
+        key = str(path)
+        try:
+            signature = self._signature(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            raise
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Parse outside the lock; a concurrent change is caught by the next stat
+        data = loader(path)
+        with self._lock:
+            self._entries[key] = (signature, data)
+        return data
+
+    def store(self, path, data):
+        """Prime the cache with content we just wrote ourselves"""
+        try:
+            signature = self._signature(path)
+        except OSError:
+            self.invalidate(path)
+            return
+        with self._lock:
+            self._entries[str(path)] = (signature, data)
+
+    def invalidate(self, path=None):
+        """Drop the cached entry for path, or every entry when path is None"""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(path), None)
+
+    def stats(self):
+        """Return cache counters for debugging"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+# Initialize settings cache
+settings_cache = SettingsFileCache()
+
+class SettingsFileLock:
+    """Cross-process advisory lock held on a sidecar '<name>.lock' file"""
+    # Serializes threads of this process; the OS lock serializes processes
+    _thread_lock = threading.RLock()
+
+    def __init__(self, path, timeout=10.0):
+        self.lock_path = Path(str(path) + ".lock")
+        self.timeout = timeout
+        self._fd = None
+
+    def acquire(self):
+        """Block until the lock is held or raise TimeoutError"""
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            raise TimeoutError(f"Timed out waiting for {self.lock_path}")
+        try:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            deadline = time.monotonic() + self.timeout
+            while not self._try_lock():
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for {self.lock_path}")
+                time.sleep(0.01)
+        except BaseException:
+            self._close()
+            self._thread_lock.release()
+            raise
+
+    def _try_lock(self):
+        """Attempt a non-blocking exclusive lock on the lock file"""
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def release(self):
+        """Release the OS lock and the thread lock"""
+        try:
+            if self._fd is not None:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                elif msvcrt is not None:
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
+        finally:
+            self._close()
+            self._thread_lock.release()
+
+    def _close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+def atomic_write_json(path, data, indent=4, fsync=True):
+    """Write JSON to a temp file in the same directory, fsync it, then rename it over path
+
+    A symlinked path (e.g. settings.json kept in a dotfiles repo) is written
+    through: the link stays and its target is replaced, keeping its mode.
+    """
+    # Imported lazily: tempfile pulls in shutil and random, which read-only CLI calls never need
+    import tempfile
+
+    path = Path(os.path.realpath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent, ensure_ascii=False)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        # Keep the permissions of the file we are replacing
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        except OSError:
+            pass
+
+        # On Windows the rename fails while another process holds the file open, so retry briefly
+        for attempt in range(10):
+            try:
+                os.replace(tmp_path, path)
+                break
+            except PermissionError:
+                if not IS_WINDOWS or attempt == 9:
+                    raise
+                time.sleep(0.05)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # Persist the rename itself (not supported on Windows)
+    if fsync and not IS_WINDOWS:
+        try:
+            dir_fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+class SettingsWatcher:
+    """Background watcher that reports changes to a settings file
+
+    Uses inotify on the parent directory on Linux (so atomic renames are seen)
+    and falls back to polling the file's stat signature elsewhere. Bursts of
+    events are debounced and on_change(load()) is called from the watcher thread.
+    """
+    # inotify event flags (see <sys/inotify.h>)
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, path, on_change, load, debounce=0.15, poll_interval=1.0):
+        self.path = Path(path)
+        self.on_change = on_change
+        self.load = load
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.backend = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_signature = self._signature()
+
+    def start(self):
+        """Start watching in a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="SettingsWatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Ask the watcher thread to exit"""
+        self._stop_event.set()
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _run(self):
+        inotify_fd = self._open_inotify() if IS_LINUX else None
+        try:
+            if inotify_fd is not None:
+                self.backend = "inotify"
+                self._watch_inotify(inotify_fd)
+            if not self._stop_event.is_set():
+                self.backend = "polling"
+                self._watch_polling()
+        finally:
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+
+    def _open_inotify(self):
+        """Return an inotify fd watching the settings directory, or None if unavailable"""
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = (self.IN_CLOSE_WRITE | self.IN_MODIFY | self.IN_MOVED_TO | self.IN_MOVED_FROM |
+                    self.IN_CREATE | self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+            if libc.inotify_add_watch(fd, os.fsencode(self.path.parent), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except Exception:
+            return None
+
+    def _watch_inotify(self, fd):
+        """Wait for directory events touching the settings file; returns if the watch is lost"""
+        target = os.fsencode(self.path.name)
+        deadline = None
+        while not self._stop_event.is_set():
+            timeout = 0.5 if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                relevant, watch_lost = self._parse_events(data, target)
+                if watch_lost:
+                    # Directory removed or moved; polling copes with it reappearing
+                    return
+                if relevant:
+                    # Trailing debounce: fire once the burst has been quiet for a while
+                    deadline = time.monotonic() + self.debounce
+            elif deadline is not None and time.monotonic() >= deadline:
+                deadline = None
+                self._emit_if_changed()
+
+    def _parse_events(self, data, target):
+        """Return (touches_target, watch_lost) for a buffer of inotify events"""
+        relevant = False
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(data):
+            _, mask, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                return relevant, True
+            if name == target:
+                relevant = True
+        return relevant, False
+
+    def _watch_polling(self):
+        """Fallback: compare the stat signature every poll_interval seconds"""
+        while not self._stop_event.wait(self.poll_interval):
+            self._emit_if_changed()
+
+    def _emit_if_changed(self):
+        """Load and report the settings if the file's signature moved since the last report"""
+        signature = self._signature()
+        if signature == self._last_signature:
+            return
+        self._last_signature = signature
+        try:
+            self.on_change(self.load())
+        except Exception as e:
+            print(f"Warning: Settings watcher callback failed: {e}")
+
+# Z.ai Anthropic-compatible endpoint
+ZAI_BASE_URL = 'https://api.z.ai/api/anthropic'
+# Official endpoint Claude Code uses when ANTHROPIC_BASE_URL is unset
+ANTHROPIC_BASE_URL = 'https://api.anthropic.com'
+
+# Local routing proxy (see ezswitch_proxy.py)
+PROXY_HOST = '127.0.0.1'
+DEFAULT_PROXY_PORT = 18787
+# Stored profiles the proxy can forward to
+PROXY_UPSTREAMS = ['zai', 'api', 'custom']
+# How the proxy spreads requests over a pool of saved Z.ai keys ('sticky' keeps a conversation on one key)
+KEY_STRATEGIES = ['round-robin', 'least-outstanding', 'sticky']
+
+# Variables owned by EZ Switch profiles; anything a profile does not set is removed on apply
+MANAGED_ENV_VARS = [
+    'ANTHROPIC_AUTH_TOKEN',
+    'ANTHROPIC_BASE_URL',
+    'ANTHROPIC_DEFAULT_OPUS_MODEL',
+    'ANTHROPIC_DEFAULT_SONNET_MODEL',
+    'ANTHROPIC_DEFAULT_HAIKU_MODEL',
+    'ANTHROPIC_API_KEY'
+]
+
+def plan_settings_delta(profile_env, current_env=None):
+    """Compute the (set_vars, unset_vars) needed to move settings.json to a profile
+
+    When current_env is given, variables that already hold the target value and
+    variables that are already absent are left out of the plan.
+    """
+    set_vars = dict(profile_env)
+    unset_vars = [var for var in MANAGED_ENV_VARS if var not in set_vars]
+    if current_env is not None:
+        set_vars = {k: v for k, v in set_vars.items() if current_env.get(k) != v}
+        unset_vars = [var for var in unset_vars if var in current_env]
+    return set_vars, unset_vars
+
+class SettingsTransaction:
+    """Locked read-modify-write of a JSON settings file, committed with an atomic rename
+
+    Usage:
+        with SettingsTransaction(path) as txn:
+            txn.settings.setdefault('env', {})['KEY'] = 'value'
+
+    The file is only written if the block exits without an exception and
+    rollback() was not called. Readers never observe a half-written file.
+    """
+    def __init__(self, path, cache=settings_cache, timeout=10.0):
+        self.path = Path(path)
+        self.cache = cache
+        self.lock = SettingsFileLock(self.path, timeout=timeout)
+        self.settings = None
+        self._rolled_back = False
+
+    def rollback(self):
+        """Leave the file untouched when the transaction ends"""
+        self._rolled_back = True
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.settings = self._read()
+        except BaseException:
+            self.lock.release()
+            raise
+        return self
+
+    def _read(self):
+        """Read the current file under the lock; unparseable files abort instead of being overwritten"""
+        if not self.path.exists():
+            return {}
+        with open(self.path, 'r', encoding='utf-8-sig') as f:
+            settings = json.load(f)
+        if not isinstance(settings, dict):
+            raise ValueError(f"{self.path} does not contain a JSON object")
+        return settings
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and not self._rolled_back:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                atomic_write_json(self.path, self.settings)
+                if self.cache is not None:
+                    self.cache.store(self.path, self.settings)
+        finally:
+            self.lock.release()
+        return False
+
+# Available GLM models for the Z.ai tiers
+AVAILABLE_MODELS = ["GLM-4.7", "GLM-4.6", "GLM-4.5", "GLM-4.5-Air"]
+DEFAULT_ZAI_MODEL = "GLM-4.7"
+# Claude model tiers, as named in ANTHROPIC_DEFAULT_<TIER>_MODEL and in Claude model ids
+MODEL_TIERS = ("opus", "sonnet", "haiku")
+
+class Profile:
+    """A target configuration for settings.json (subclasses define the env block)"""
+    kind = None
+    config_name = None  # Value of 'selected_config' in config.json
+
+    def env(self):
+        """Variables this profile writes to settings.json; managed variables not listed are removed"""
+        return {}
+
+    def validate(self):
+        """Return an error message if the profile cannot be applied, otherwise None"""
+        return None
+
+    def remember(self, store):
+        """Record this profile as the last applied one in a ConfigStore"""
+        store.update(selected_config=self.config_name)
+
+    def describe(self):
+        """Short human-readable label"""
+        return self.kind
+
+    def usage_label(self):
+        """Name token usage is attributed to while this profile is active (see record_switch)"""
+        return self.kind
+
+class ZaiProfile(Profile):
+    """Z.ai GLM models behind the Anthropic-compatible endpoint"""
+    kind = "zai"
+    config_name = "zai"
+
+    def __init__(self, api_key, key_name=None, opus_model=DEFAULT_ZAI_MODEL,
+                 sonnet_model=DEFAULT_ZAI_MODEL, haiku_model=DEFAULT_ZAI_MODEL):
+        self.api_key = (api_key or "").strip()
+        self.key_name = key_name
+        self.opus_model = opus_model
+        self.sonnet_model = sonnet_model
+        self.haiku_model = haiku_model
+
+    def env(self):
+        return {
+            'ANTHROPIC_AUTH_TOKEN': self.api_key,
+            'ANTHROPIC_BASE_URL': ZAI_BASE_URL,
+            'ANTHROPIC_DEFAULT_OPUS_MODEL': self.opus_model,
+            'ANTHROPIC_DEFAULT_SONNET_MODEL': self.sonnet_model,
+            'ANTHROPIC_DEFAULT_HAIKU_MODEL': self.haiku_model,
+            'API_TIMEOUT_MS': '3000000'
+        }
+
+    def validate(self):
+        if not self.api_key:
+            return "Please enter your z.ai API key"
+        return None
+
+    def remember(self, store):
+        super().remember(store)
+        # The proxy maps Claude tiers to these when it forwards to Z.ai
+        store.update(zai_models={'opus': self.opus_model, 'sonnet': self.sonnet_model, 'haiku': self.haiku_model})
+        if self.key_name:
+            store.update(current_zai_key_name=self.key_name)
+
+    def describe(self):
+        models = f"{self.opus_model}, {self.sonnet_model}, {self.haiku_model}"
+        return f"Z.ai ({self.key_name}: {models})" if self.key_name else f"Z.ai ({models})"
+
+    def usage_label(self):
+        return f"zai:{self.key_name}" if self.key_name else "zai"
+
+class ClaudeSubscriptionProfile(Profile):
+    """Official Claude subscription: every managed override is removed"""
+    kind = "subscription"
+    config_name = "claude"
+
+    def remember(self, store):
+        super().remember(store)
+        store.update(claude_mode="subscription")
+
+    def describe(self):
+        return "Claude Subscription"
+
+class ClaudeApiProfile(Profile):
+    """Claude API key against the default Anthropic endpoint"""
+    kind = "api"
+    config_name = "claude"
+
+    def __init__(self, api_key):
+        self.api_key = (api_key or "").strip()
+
+    def env(self):
+        return {
+            'ANTHROPIC_AUTH_TOKEN': self.api_key
+        }
+
+    def validate(self):
+        if not self.api_key:
+            return "Please enter your Claude API key"
+        return None
+
+    def remember(self, store):
+        super().remember(store)
+        store.update(claude_mode="api", claude_key=self.api_key)
+
+    def describe(self):
+        return "Claude API Key"
+
+class CustomProfile(Profile):
+    """Any Anthropic-compatible endpoint"""
+    kind = "custom"
+    config_name = "custom"
+
+    def __init__(self, base_url, api_key):
+        self.base_url = (base_url or "").strip()
+        self.api_key = (api_key or "").strip()
+
+    def env(self):
+        return {
+            'ANTHROPIC_AUTH_TOKEN': self.api_key,
+            'ANTHROPIC_BASE_URL': self.base_url
+        }
+
+    def validate(self):
+        if not self.base_url:
+            return "Please enter a custom base URL"
+        if not self.api_key:
+            return "Please enter your custom API key"
+        return None
+
+    def remember(self, store):
+        super().remember(store)
+        store.update(custom_url=self.base_url, custom_key=self.api_key)
+
+    def describe(self):
+        return f"Custom ({self.base_url})"
+
+class ProxyProfile(Profile):
+    """Claude Code talks to the local EZ Switch proxy, which forwards to a stored profile
+
+    Switching the upstream only changes config.json, which the running proxy
+    picks up on its next request, so open Claude Code sessions need no restart.
+    """
+    kind = "proxy"
+    config_name = "proxy"
+
+    def __init__(self, upstream, token, port=DEFAULT_PROXY_PORT, key_pool=None, key_strategy=KEY_STRATEGIES[0],
+                 routes=None, hedge=None, failover=None, max_concurrency=None, record=None):
+        self.upstream = upstream
+        self.token = token
+        self.port = int(port)
+        # Saved Z.ai key names to rotate across when the upstream is 'zai'
+        self.key_pool = list(key_pool or [])
+        self.key_strategy = key_strategy
+        # [{'match': tier or model glob, 'upstream': stored profile, 'model': optional replacement}], first match wins
+        self.routes = list(routes or [])
+        # {'upstream': stored profile, 'delay_ms': int or None for the observed p95} to hedge slow requests
+        self.hedge = dict(hedge or {})
+        # {'upstreams': stored profiles tried in order when a circuit opens,
+        #  'error_rate': 0-1 or None, 'latency_ms': int or None} (None uses the proxy's defaults)
+        self.failover = dict(failover or {})
+        # Requests each key (or upstream without a pool) runs at once; the rest queue fairly. None: no limit
+        self.max_concurrency = max_concurrency or None
+        # {'path': trace file the proxy appends request shapes to, 'bodies': also keep request bodies}
+        self.record = dict(record or {})
+
+    def env(self):
+        return {
+            'ANTHROPIC_AUTH_TOKEN': self.token,
+            'ANTHROPIC_BASE_URL': proxy_base_url(self.port)
+        }
+
+    def validate(self):
+        if self.upstream not in PROXY_UPSTREAMS:
+            return f"Proxy upstream must be one of: {', '.join(PROXY_UPSTREAMS)}"
+        if not self.token:
+            return "Missing proxy access token"
+        if not 0 < self.port < 65536:
+            return "Proxy port must be between 1 and 65535"
+        if self.key_strategy not in KEY_STRATEGIES:
+            return f"Key strategy must be one of: {', '.join(KEY_STRATEGIES)}"
+        for route in self.routes:
+            if not isinstance(route, dict) or not route.get('match'):
+                return f"Invalid proxy route: {route!r}"
+            if route.get('upstream') not in PROXY_UPSTREAMS:
+                return f"Route '{route['match']}' must forward to one of: {', '.join(PROXY_UPSTREAMS)}"
+        if self.hedge:
+            if self.hedge.get('upstream') not in PROXY_UPSTREAMS:
+                return f"Hedge upstream must be one of: {', '.join(PROXY_UPSTREAMS)}"
+            delay_ms = self.hedge.get('delay_ms')
+            if delay_ms is not None and (not isinstance(delay_ms, int) or delay_ms <= 0):
+                return "Hedge delay must be a positive number of milliseconds"
+        if self.failover:
+            upstreams = self.failover.get('upstreams')
+            if not upstreams or not isinstance(upstreams, list):
+                return "Failover needs at least one stored profile"
+            for name in upstreams:
+                if name not in PROXY_UPSTREAMS:
+                    return f"Failover profiles must be among: {', '.join(PROXY_UPSTREAMS)}"
+            error_rate = self.failover.get('error_rate')
+            if error_rate is not None and (not isinstance(error_rate, (int, float)) or not 0 < error_rate <= 1):
+                return "Failover error rate must be above 0 and at most 1"
+            latency_ms = self.failover.get('latency_ms')
+            if latency_ms is not None and (not isinstance(latency_ms, int) or latency_ms <= 0):
+                return "Failover latency must be a positive number of milliseconds"
+        if self.max_concurrency is not None and (not isinstance(self.max_concurrency, int) or self.max_concurrency < 1):
+            return "Concurrency limit must be a positive number of requests"
+        if self.record and not (isinstance(self.record.get('path'), str) and os.path.isabs(self.record['path'])):
+            return "Traffic recording needs an absolute trace file path"
+        return None
+
+    def remember(self, store):
+        super().remember(store)
+        store.update(proxy_upstream=self.upstream, proxy_token=self.token, proxy_port=self.port,
+                     proxy_key_pool=self.key_pool or None, proxy_key_strategy=self.key_strategy,
+                     proxy_routes=self.routes or None, proxy_hedge=self.hedge or None,
+                     proxy_failover=self.failover or None, proxy_max_concurrency=self.max_concurrency,
+                     proxy_record=self.record or None)
+
+    def describe(self):
+        target = self.upstream
+        if self.upstream == 'zai' and len(self.key_pool) > 1:
+            target = f"zai, {len(self.key_pool)} keys {self.key_strategy}"
+        if self.routes:
+            target += f", {len(self.routes)} routes"
+        if self.hedge:
+            target += f", hedged to {self.hedge['upstream']}"
+        if self.failover:
+            target += f", fails over to {', '.join(self.failover['upstreams'])}"
+        if self.max_concurrency:
+            target += f", {self.max_concurrency} at a time per key"
+        if self.record:
+            target += f", recording to {self.record['path']}"
+        return f"Proxy ({PROXY_HOST}:{self.port} -> {target})"
+
+    def usage_label(self):
+        return f"proxy:{self.upstream}"
+
+def proxy_base_url(port=DEFAULT_PROXY_PORT):
+    """ANTHROPIC_BASE_URL that points Claude Code at the local proxy"""
+    return f"http://{PROXY_HOST}:{port}"
+
+def new_proxy_token():
+    """Random token Claude Code presents to the local proxy instead of a real API key"""
+    import secrets
+    return "ezswitch-" + secrets.token_hex(24)
+
+def stored_profile(store, name):
+    """Build the Profile for a stored configuration ('zai', 'api' or 'custom') from config.json values"""
+    if name == "zai":
+        key_name = store.get('current_zai_key_name')
+        if not key_name or key_name not in store.zai_keys:
+            raise ValueError("No Z.ai key selected")
+        models = store.get('zai_models') or {}
+        return ZaiProfile(store.zai_keys[key_name], key_name,
+                          *(models.get(tier, DEFAULT_ZAI_MODEL) for tier in MODEL_TIERS))
+    elif name == "api":
+        return ClaudeApiProfile(store.get('claude_key'))
+    elif name == "custom":
+        return CustomProfile(store.get('custom_url'), store.get('custom_key'))
+    raise ValueError(f"Unknown stored profile '{name}'")
+
+def proxy_profile(store, upstream=None, port=None, key_pool=None, key_strategy=None, routes=None, hedge=None,
+                  failover=None, max_concurrency=None, record=None):
+    """ProxyProfile from saved proxy settings, creating the access token on first use
+
+    Arguments left as None keep their saved values; pass key_pool=[], routes=[],
+    hedge={}, failover={}, max_concurrency=0 or record={} to clear them.
+    """
+    return ProxyProfile(upstream or store.get('proxy_upstream') or 'zai',
+                        store.get('proxy_token') or new_proxy_token(),
+                        port or store.get('proxy_port') or DEFAULT_PROXY_PORT,
+                        store.get('proxy_key_pool') if key_pool is None else key_pool,
+                        key_strategy or store.get('proxy_key_strategy') or KEY_STRATEGIES[0],
+                        store.get('proxy_routes') if routes is None else routes,
+                        store.get('proxy_hedge') if hedge is None else hedge,
+                        store.get('proxy_failover') if failover is None else failover,
+                        store.get('proxy_max_concurrency') if max_concurrency is None else max_concurrency,
+                        store.get('proxy_record') if record is None else record)
+
+def _parse_settings_file(path):
+    """Parse settings.json from disk (cache loader)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except UnicodeDecodeError as e:
+        # Log encoding errors
+        print(f"Warning: Encoding error reading Claude settings file {path}: {e}")
+        # Try with different encoding as fallback
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            return json.load(f)
+
+def _copy_settings(settings):
+    """Deep-copy cached settings so callers can modify any part (env, permissions, hooks) without touching the cache"""
+    return copy.deepcopy(settings)
+
+def read_claude_settings(path=CLAUDE_SETTINGS_FILE):
+    """Get current Claude Code settings.json content (served from cache while the file is unchanged)"""
+    try:
+        if os.path.exists(path):
+            return _copy_settings(settings_cache.load(path, _parse_settings_file))
+        else:
+            # Return empty settings if file doesn't exist
+            return {}
+    except (FileNotFoundError, PermissionError) as e:
+        # Log file access errors but don't crash the app
+        print(f"Warning: Could not access Claude settings file {path}: {e}")
+        return {}
+    except json.JSONDecodeError as e:
+        # Log JSON parsing errors
+        print(f"Warning: Invalid JSON in Claude settings file {path}: {e}")
+        return {}
+    except Exception as e:
+        # Log any other unexpected errors
+        print(f"Warning: Unexpected error reading Claude settings file {path}: {e}")
+        return {}
+
+def apply_settings_delta(path, set_vars, unset_vars):
+    """Apply a planned set/unset delta to settings.json in a single transaction"""
+    try:
+        with SettingsTransaction(path) as txn:
+            env = txn.settings.get('env')
+            if not isinstance(env, dict):
+                env = {}
+
+            # Narrow the plan against the locked file so unchanged values cost no write
+            set_vars = {k: v for k, v in set_vars.items() if env.get(k) != v}
+            unset_vars = [var for var in unset_vars if var in env]
+
+            if not set_vars and not unset_vars:
+                txn.rollback()
+                return True, "Claude Code settings already up to date"
+
+            env.update(set_vars)
+            for var_name in unset_vars:
+                del env[var_name]
+            txn.settings['env'] = env
+
+        return True, "Claude Code settings updated successfully"
+
+    except Exception as e:
+        return False, f"Failed to update Claude settings: {str(e)}"
+
+def load_config(config_file=CONFIG_FILE, legacy_file=LEGACY_CONFIG_FILE):
+    """Load the EZ Switch config.json, migrating the legacy single-file config if needed"""
+    config_file = Path(config_file)
+    if config_file.exists():
+        with open(config_file, 'r') as f:
+            return json.load(f)
+
+    # Check if old config file exists and migrate it
+    legacy_file = Path(legacy_file)
+    if legacy_file.exists():
+        with open(legacy_file, 'r') as f:
+            saved_keys = json.load(f)
+        # Save to new location
+        config_file.parent.mkdir(exist_ok=True)
+        save_config(saved_keys, config_file)
+        # Remove old file
+        legacy_file.unlink()
+        return saved_keys
+    return {}
+
+def save_config(saved_keys, config_file=CONFIG_FILE, fsync=False):
+    """Write a configuration snapshot to config.json with an atomic rename"""
+    atomic_write_json(config_file, saved_keys, indent=2, fsync=fsync)
+
+def saved_zai_keys(saved_keys):
+    """Return the named z.ai keys from a config dict, upgrading the old single-key format"""
+    if 'zai_keys' in saved_keys:
+        return dict(saved_keys['zai_keys'])
+    if 'zai_key' in saved_keys:
+        return {'Default': saved_keys['zai_key']}
+    return {}
+
+# Stands for a key this process removed from config.json
+_REMOVED = object()
+
+class ConfigStore:
+    """EZ Switch config.json: saved keys plus the last applied configuration
+
+    Unknown keys are preserved so newer features can store their own settings.
+    Access is guarded by a lock because the GUI saves from worker threads.
+    Several processes share the file (the GUI, CLI commands, the proxy), so a
+    save only writes the keys this store changed and keeps everyone else's.
+    """
+    def __init__(self, path=CONFIG_FILE, legacy_path=LEGACY_CONFIG_FILE):
+        self.path = Path(path)
+        self.legacy_path = Path(legacy_path)
+        self.data = {}
+        self._saved = {}  # config.json as this store last read or wrote it
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Load config.json (migrating legacy formats) and return self"""
+        data = load_config(self.path, self.legacy_path)
+        with self._lock:
+            self.data = data
+            self._saved = copy.deepcopy(data)
+            if 'zai_keys' not in data and 'zai_key' in data:
+                # Migrate old single key format
+                data['zai_keys'] = saved_zai_keys(data)
+                data['current_zai_key_name'] = 'Default'
+                del data['zai_key']
+        return self
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.data.get(key, default)
+
+    def update(self, **values):
+        """Set config values; empty values are removed rather than stored"""
+        with self._lock:
+            for key, value in values.items():
+                if value is None or value == "":
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = value
+
+    @property
+    def zai_keys(self):
+        """Named z.ai keys, format: {"name": "key"} (the live dict, edits are saved)"""
+        with self._lock:
+            return self.data.setdefault('zai_keys', {})
+
+    def snapshot(self):
+        """Copy of the config suitable for serializing outside the lock"""
+        with self._lock:
+            snapshot = dict(self.data)
+            snapshot['zai_keys'] = dict(self.data.get('zai_keys', {}))
+            # Written even when unset, as the GUI always did
+            snapshot.setdefault('current_zai_key_name', None)
+            return snapshot
+
+    def refresh(self):
+        """Take in changes other processes saved to config.json, keeping this store's unsaved ones; returns self"""
+        with self._lock:
+            self._merge(self._read_current())
+        return self
+
+    def save(self, fsync=False):
+        """Write this store's changes over config.json's current contents with an atomic rename"""
+        self.path.parent.mkdir(exist_ok=True)
+        with SettingsFileLock(self.path), self._lock:
+            self._merge(self._read_current())
+            save_config(self.snapshot(), self.path, fsync=fsync)
+            self._saved = copy.deepcopy(self.data)
+
+    def _read_current(self):
+        """config.json as it is on disk now; empty if missing or unreadable"""
+        try:
+            with open(self.path, 'r') as f:
+                current = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return current if isinstance(current, dict) else {}
+
+    def _merge(self, current):
+        """Make current (config.json on disk) plus what this store changed since it last read or wrote it the data"""
+        changes = {}
+        for key in set(self.data) | set(self._saved):
+            value = self.data.get(key, _REMOVED)
+            if value != self._saved.get(key, _REMOVED):
+                changes[key] = value
+        self._saved = copy.deepcopy(current)
+        for key, value in changes.items():
+            if value is _REMOVED:
+                current.pop(key, None)
+            else:
+                current[key] = value
+        # zai_keys is handed out as a live dict, so keep that object
+        zai_keys = self.data.get('zai_keys')
+        if isinstance(zai_keys, dict) and isinstance(current.get('zai_keys'), dict) and current['zai_keys'] is not zai_keys:
+            zai_keys.clear()
+            zai_keys.update(current['zai_keys'])
+            current['zai_keys'] = zai_keys
+        self.data = current
+
+def apply_profile(profile, settings_file=CLAUDE_SETTINGS_FILE, store=None, timings=None):
+    """Apply a profile: one settings.json transaction, then one config.json write
+
+    Returns (success, message); per-phase durations in seconds are added to timings.
+    """
+    if timings is None:
+        timings = {}
+
+    error = profile.validate()
+    if error:
+        return False, error
+
+    # Plan the complete set/unset delta for the target profile
+    phase_start = time.perf_counter()
+    set_vars, unset_vars = plan_settings_delta(profile.env())
+    timings['plan'] = time.perf_counter() - phase_start
+
+    # Write settings.json once
+    phase_start = time.perf_counter()
+    success, message = apply_settings_delta(settings_file, set_vars, unset_vars)
+    timings['settings.json'] = time.perf_counter() - phase_start
+    if not success:
+        return False, message
+
+    # Write config.json once
+    if store is not None:
+        phase_start = time.perf_counter()
+        profile.remember(store)
+        try:
+            store.save(fsync=True)
+        except OSError as e:
+            print(f"Warning: Could not save EZ Switch config {store.path}: {e}")
+        record_switch(store.path.parent / SWITCH_HISTORY_NAME, profile)
+        timings['config.json'] = time.perf_counter() - phase_start
+
+    return True, message
+
+def record_switch(history_file, profile):
+    """Append the time and usage label of an applied profile to the switch history"""
+    line = json.dumps({'t': round(time.time(), 3), 'profile': profile.usage_label()}) + "\n"
+    try:
+        with open(history_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Warning: Could not record the switch in {history_file}: {e}")
+
+def load_switch_history(history_file=CONFIG_DIR / SWITCH_HISTORY_NAME):
+    """[(time, usage label)] of applied profiles, oldest first; empty if nothing was recorded"""
+    history = []
+    try:
+        with open(history_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    history.append((float(entry['t']), str(entry['profile'])))
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except OSError:
+        pass
+    history.sort()
+    return history
+
+def format_timings(timings):
+    """Format per-phase timings, e.g. '1.9 ms (plan 0.0 ms, settings.json 1.6 ms, ...)'"""
+    total = sum(timings.values()) * 1000
+    phases = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in timings.items())
+    return f"{total:.1f} ms ({phases})"
+
+def detect_profile(env, store=None):
+    """Classify a settings.json env block as 'zai', 'api', 'subscription', 'custom', 'proxy' or None
+
+    Only the proxy saved in store (default: config.json) counts as 'proxy'; any
+    other local endpoint, such as 'ezswitch mock', is 'custom'.
+    """
+    auth_token = env.get('ANTHROPIC_AUTH_TOKEN')
+    base_url = env.get('ANTHROPIC_BASE_URL')
+
+    if base_url and auth_token and base_url.startswith(f"http://{PROXY_HOST}:"):
+        try:
+            store = store if store is not None else ConfigStore().load()
+        except (OSError, ValueError):
+            store = ConfigStore()
+        if (auth_token == store.get('proxy_token')
+                and base_url == proxy_base_url(store.get('proxy_port') or DEFAULT_PROXY_PORT)):
+            return 'proxy'
+    if base_url and 'z.ai' in base_url:
+        return 'zai'
+    elif auth_token and not base_url:
+        return 'api'
+    elif not auth_token and not base_url:
+        return 'subscription'
+    elif base_url and auth_token:
+        return 'custom'
+    return None
+
+def describe_status(settings, store=None):
+    """Describe the active configuration as (is_configured, status_text); store as for detect_profile"""
+    env = settings.get('env') or {}
+    profile = detect_profile(env, store)
+
+    if profile == 'zai':
+        return True, "✓ Currently using z.ai API\n(Configured in Claude Code settings.json)"
+    elif profile == 'api':
+        return True, "✓ Currently using Claude API Key\n(Configured in Claude Code settings.json)"
+    elif profile == 'subscription':
+        return True, "✓ Currently using Claude Subscription\n(No custom settings configured)"
+    elif profile == 'proxy':
+        return True, (f"✓ Currently using the EZ Switch proxy\n"
+                      f"Base URL: {env.get('ANTHROPIC_BASE_URL')}\n"
+                      "(Upstream is switched without restarting Claude Code)")
+    elif profile == 'custom':
+        return True, (f"✓ Currently using Custom Base URL\n"
+                      f"Base URL: {env.get('ANTHROPIC_BASE_URL')}\n"
+                      "(Configured in Claude Code settings.json)")
+    else:
+        return False, "⚠ No configuration is currently set"
@@ -0,0 +1,235 @@
+"""Single-instance IPC for Claude Code EZ Switch
+
+The running instance (GUI or 'ezswitch serve') listens on a Unix socket in the
+config directory (a named pipe on Windows). A second launch or a CLI call sends
+its command there instead of paying for a cold start.
+
+Messages are JSON objects. On POSIX they are framed with a 4-byte big-endian
+length; on Windows multiprocessing's pipe connections frame them for us. Every
+request carries a token read from a 0600 file next to the socket.
+"""
+import hmac
+import json
+import os
+import struct
+import threading
+from pathlib import Path
+
+from ezswitch_core import IS_WINDOWS, CONFIG_DIR
+
+_LENGTH = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+def ipc_address(config_dir=CONFIG_DIR):
+    """Socket path (POSIX) or pipe name (Windows) of the resident instance for a config directory"""
+    config_dir = Path(config_dir)
+    if IS_WINDOWS:
+        # Pipe names are global, so derive one per user and config directory
+        import hashlib
+        digest = hashlib.sha1(str(config_dir.resolve()).lower().encode('utf-8')).hexdigest()[:12]
+        return rf'\\.\pipe\claude-ez-switch-{os.environ.get("USERNAME", "user")}-{digest}'
+    return str(config_dir / "ezswitch.sock")
+
+def _token_path(config_dir):
+    return Path(config_dir) / "ipc.token"
+
+def _read_token(config_dir):
+    try:
+        return _token_path(config_dir).read_text().strip()
+    except OSError:
+        return None
+
+def _create_token(config_dir):
+    """Write a fresh random token readable only by the current user"""
+    import secrets
+    token = secrets.token_hex(32)
+    path = _token_path(config_dir)
+    path.parent.mkdir(exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+class _SocketChannel:
+    """Length-prefixed JSON messages over a connected Unix socket"""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send_message(self, message):
+        payload = json.dumps(message).encode('utf-8')
+        self.sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+    def recv_message(self, timeout=None):
+        self.sock.settimeout(timeout)
+        (length,) = _LENGTH.unpack(self._recv_exact(_LENGTH.size))
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError("IPC message too large")
+        return json.loads(self._recv_exact(length).decode('utf-8'))
+
+    def _recv_exact(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise ConnectionError("IPC peer closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self.sock.close()
+
+class _PipeChannel:
+    """JSON messages over a multiprocessing pipe connection (Windows)"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send_message(self, message):
+        self.conn.send_bytes(json.dumps(message).encode('utf-8'))
+
+    def recv_message(self, timeout=None):
+        if timeout is not None and not self.conn.poll(timeout):
+            raise TimeoutError("Timed out waiting for IPC reply")
+        return json.loads(self.conn.recv_bytes(MAX_MESSAGE_SIZE).decode('utf-8'))
+
+    def close(self):
+        self.conn.close()
+
+def _connect(address, timeout):
+    """Open a channel to a listening instance; raises OSError if there is none"""
+    if IS_WINDOWS:
+        from multiprocessing.connection import Client
+        return _PipeChannel(Client(address, family='AF_PIPE'))
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except BaseException:
+        sock.close()
+        raise
+    return _SocketChannel(sock)
+
+def send_request(request, config_dir=CONFIG_DIR, timeout=10.0, at_most_once=False):
+    """Forward a request to the resident instance; returns its reply, or None if none is running
+
+    None means the request did not reach an instance. With at_most_once, a
+    request that was sent but got no reply within timeout raises TimeoutError
+    instead, because the instance may still be running it.
+    """
+    address = ipc_address(config_dir)
+    # Cheap check first so the no-resident path never imports socket
+    if not IS_WINDOWS and not os.path.exists(address):
+        return None
+    token = _read_token(config_dir)
+    if token is None:
+        return None
+    try:
+        channel = _connect(address, timeout)
+    except OSError:
+        return None
+    try:
+        try:
+            channel.send_message(dict(request, token=token))
+        except OSError:
+            return None
+        try:
+            return channel.recv_message(timeout)
+        except (OSError, ValueError):
+            if at_most_once:
+                raise TimeoutError(f"No reply from the resident instance within {timeout:g} s; "
+                                   f"the command may still be running there")
+            return None
+    finally:
+        channel.close()
+
+class ResidentServer:
+    """Accepts IPC requests for the single running instance
+
+    handler(request) runs on the server thread and returns a JSON-serializable
+    reply; requests are handled one at a time.
+    """
+    def __init__(self, handler, config_dir=CONFIG_DIR):
+        self.handler = handler
+        self.config_dir = Path(config_dir)
+        self.address = ipc_address(config_dir)
+        self._listener = None
+        self._token = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start listening in a daemon thread; returns False if another instance already owns the address"""
+        if send_request({'command': 'ping'}, self.config_dir, timeout=2.0) is not None:
+            return False
+
+        self._token = _create_token(self.config_dir)
+        if IS_WINDOWS:
+            from multiprocessing.connection import Listener
+            self._listener = Listener(self.address, family='AF_PIPE')
+        else:
+            import socket
+            # Nobody answered, so any socket file left behind is stale
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self.address)
+            os.chmod(self.address, 0o600)
+            self._listener.listen(16)
+
+        self._thread = threading.Thread(target=self._serve, name="ResidentServer", daemon=True)
+        self._thread.start()
+        return True
+
+    def serve_forever(self):
+        """Block until stop() is called (used by headless 'ezswitch serve')"""
+        self._stopped.wait()
+
+    def stop(self):
+        """Stop accepting requests and remove the socket"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except OSError:
+                pass
+        if not IS_WINDOWS:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _accept(self):
+        if IS_WINDOWS:
+            return _PipeChannel(self._listener.accept())
+        sock, _ = self._listener.accept()
+        return _SocketChannel(sock)
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            try:
+                channel = self._accept()
+            except OSError:
+                if self._stopped.is_set():
+                    return
+                continue
+            try:
+                self._handle(channel)
+            except Exception as e:
+                print(f"Warning: IPC request failed: {e}")
+            finally:
+                channel.close()
+
+    def _handle(self, channel):
+        request = channel.recv_message(timeout=10.0)
+        if not isinstance(request, dict) or not hmac.compare_digest(str(request.get('token', '')), self._token):
+            channel.send_message({'ok': False, 'error': "Invalid IPC token"})
+            return
+        if request.get('command') == 'ping':
+            channel.send_message({'ok': True, 'pid': os.getpid()})
+            return
+        channel.send_message(self.handler(request))
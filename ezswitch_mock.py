@@ -0,0 +1,327 @@
+"""Local stand-in for the Anthropic Messages API, for benchmarks and offline tests
+
+    ezswitch mock [--port 18790] [--latency 300 | 100-400 | lognormal:300:0.5]
+                  [--tokens-per-second 80] [--output-tokens 200]
+                  [--rate-limit 0.05] [--errors 0.02 [--error-status 529]] [--resets 0.01] [--seed N]
+
+Answers POST /v1/messages with generated text, either as one JSON message or
+as the SSE event stream Claude Code reads, and /v1/messages/count_tokens with
+an estimate. Any API key is accepted, so saving http://127.0.0.1:<port> as the
+Custom profile's base URL (or starting MockServer from Python) gives profile
+switching and the proxy a reproducible target without a network or account.
+
+Each request first waits for a latency drawn from the configured distribution
+(the time to the response head and first event), then produces its tokens at
+tokens_per_second. Faults are drawn per request: a 429 with Retry-After, a 5xx
+error, or a connection reset, either instead of the answer or part way through
+a stream. With a seed the sequence of latencies and faults is repeatable.
+"""
+import asyncio
+import json
+import math
+import random
+import socket
+import struct
+
+import ezswitch_core as core
+from ezswitch_proxy import (MAX_HEAD_SIZE, AsyncServer, ProxyError, body_framing, bound_write_buffer, error_body,
+                            format_head, get_header, read_head)
+
+DEFAULT_MOCK_PORT = 18790
+MESSAGES_PATH = '/v1/messages'
+COUNT_TOKENS_PATH = '/v1/messages/count_tokens'
+# Larger request bodies are answered 413 like the real API
+MAX_BODY_SIZE = 32 * 1024 * 1024
+DEFAULT_OUTPUT_TOKENS = 200
+DEFAULT_LOGNORMAL_SIGMA = 0.5
+# Retry-After sent with injected 429s; short, so benchmarks spend their time on requests
+RETRY_AFTER_SECONDS = 1
+# Generated replies cycle through these words, one token each
+WORDS = ("The quick brown fox jumps over the lazy dog while the proxy relays every token "
+         "to Claude Code as it arrives from the upstream").split()
+REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error', 502: 'Bad Gateway',
+           503: 'Service Unavailable', 504: 'Gateway Timeout', 529: 'Overloaded'}
+
+def parse_latency(spec):
+    """Sampler of seconds for '300' (fixed ms), '100-400' (uniform ms) or 'lognormal:MEDIAN_MS[:SIGMA]'
+
+    Raises ValueError for anything else.
+    """
+    spec = str(spec).strip()
+    try:
+        if spec.startswith('lognormal:'):
+            median, _, sigma = spec[len('lognormal:'):].partition(':')
+            median, sigma = float(median), float(sigma or DEFAULT_LOGNORMAL_SIGMA)
+            if median > 0 and sigma >= 0:
+                mu = math.log(median / 1000)
+                return lambda rng: rng.lognormvariate(mu, sigma)
+        else:
+            low, sep, high = spec.partition('-')
+            low = float(low)
+            high = float(high) if sep else low
+            if 0 <= low <= high:
+                return lambda rng: rng.uniform(low, high) / 1000
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency '{spec}': use MS, MIN_MS-MAX_MS or lognormal:MEDIAN_MS[:SIGMA]")
+
+def estimate_tokens(body):
+    """Rough token count of a request body (about four bytes per token)"""
+    return max(1, len(body) // 4)
+
+def sse_event(event, data):
+    """One server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+def chunk(data):
+    """Frame data as one HTTP/1.1 chunk"""
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+async def read_body(reader, framing, length):
+    """Read a whole request body; raises ProxyError(413) past MAX_BODY_SIZE"""
+    if framing == 'length':
+        if length > MAX_BODY_SIZE:
+            raise ProxyError(413, 'request_too_large', f"Request body exceeds {MAX_BODY_SIZE} bytes")
+        return await reader.readexactly(length)
+    if framing != 'chunked':
+        return b''
+    parts, size = [], 0
+    while True:
+        line = await reader.readline()
+        try:
+            chunk_size = int(line.split(b';')[0], 16)
+        except ValueError:
+            raise ProxyError(400, 'invalid_request_error', "Malformed chunked request body")
+        if not chunk_size:
+            # Skip trailers up to the blank line
+            while (await reader.readline()).strip():
+                pass
+            return b''.join(parts)
+        size += chunk_size
+        if size > MAX_BODY_SIZE:
+            raise ProxyError(413, 'request_too_large', f"Request body exceeds {MAX_BODY_SIZE} bytes")
+        parts.append(await reader.readexactly(chunk_size))
+        await reader.readexactly(2)
+
+class ConnectionReset(Exception):
+    """An injected fault: the connection is reset instead of answered"""
+
+class MockServer(AsyncServer):
+    """Asyncio HTTP/1.1 server that imitates the Anthropic Messages API
+
+    Run it in the foreground with run(), or on a daemon thread with
+    start_in_thread(); port 0 picks a free port, read back from .port once started.
+    """
+    def __init__(self, host=core.PROXY_HOST, port=DEFAULT_MOCK_PORT, latency='0', tokens_per_second=0,
+                 output_tokens=DEFAULT_OUTPUT_TOKENS, rate_limit=0.0, errors=0.0, error_status=529, resets=0.0,
+                 seed=None):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.latency = str(latency)
+        self._sample_latency = parse_latency(latency)
+        if tokens_per_second < 0:
+            raise ValueError("Tokens per second cannot be negative")
+        if output_tokens < 1:
+            raise ValueError("Output tokens must be at least 1")
+        for name, rate in (('rate limit', rate_limit), ('error', errors), ('reset', resets)):
+            if not 0 <= rate <= 1:
+                raise ValueError(f"The {name} rate must be between 0 and 1")
+        if rate_limit + errors + resets > 1:
+            raise ValueError("Rate limit, error and reset rates add up to more than 1")
+        if not 500 <= error_status <= 599:
+            raise ValueError(f"Error status must be a 5xx code, not {error_status}")
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.rate_limit = rate_limit
+        self.errors = errors
+        self.error_status = error_status
+        self.resets = resets
+        self.random = random.Random(seed)
+        self.counts = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'resets': 0}
+
+    def describe(self):
+        """One-line summary of the simulated behaviour"""
+        speed = f"{self.tokens_per_second:g} tokens/s" if self.tokens_per_second else "instant tokens"
+        faults = [f"{rate:.0%} {name}" for name, rate in (('429s', self.rate_limit),
+                                                          (f'{self.error_status}s', self.errors),
+                                                          ('resets', self.resets)) if rate]
+        latency = self.latency if self.latency.startswith('lognormal:') else f"{self.latency} ms"
+        return f"latency {latency}, {speed}" + (f", {', '.join(faults)}" if faults else "")
+
+    async def start(self):
+        """Start listening"""
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port, limit=MAX_HEAD_SIZE)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def _handle_client(self, reader, writer):
+        self._client_writers.add(writer)
+        bound_write_buffer(writer)
+        try:
+            while True:
+                try:
+                    head = await read_head(reader)
+                    if head is None:
+                        break
+                    keep_alive = await self._handle_request(head, reader, writer)
+                except ProxyError as e:
+                    await self._send_response(writer, e.status, error_body(e.error_type, str(e)), False, e.headers)
+                    break
+                if not keep_alive:
+                    break
+        except ConnectionReset:
+            self._reset(writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Warning: Mock connection failed: {e}")
+        finally:
+            self._client_writers.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, head, reader, writer):
+        """Answer one request; returns True if the client connection can be reused"""
+        request_line, headers = head
+        parts = request_line.split(' ')
+        if len(parts) != 3:
+            raise ProxyError(400, 'invalid_request_error', f"Unsupported request line: {request_line!r}")
+        method, target, version = parts
+        keep_alive = version == 'HTTP/1.1' and 'close' not in (get_header(headers, 'connection') or '').lower()
+        body = await read_body(reader, *body_framing(headers))
+        # The whole request has been read, so the connection stays usable after an error answer
+        try:
+            return await self._answer(method, target, headers, body, writer, keep_alive)
+        except ProxyError as e:
+            await self._send_response(writer, e.status, error_body(e.error_type, str(e)), keep_alive, e.headers)
+            return keep_alive
+
+    async def _answer(self, method, target, headers, body, writer, keep_alive):
+        """Answer a fully read request; raises ProxyError for error answers and ConnectionReset for resets"""
+        path = target.split('?', 1)[0]
+        if path not in (MESSAGES_PATH, COUNT_TOKENS_PATH):
+            raise ProxyError(404, 'not_found_error', f"Not found: {path}")
+        if method != 'POST':
+            raise ProxyError(405, 'invalid_request_error', f"Method {method} not allowed")
+        if not (get_header(headers, 'x-api-key') or get_header(headers, 'authorization')):
+            raise ProxyError(401, 'authentication_error', "Missing x-api-key or Authorization header")
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise ProxyError(400, 'invalid_request_error', "Request body is not valid JSON")
+        if not isinstance(request, dict) or not isinstance(request.get('messages'), list):
+            raise ProxyError(400, 'invalid_request_error', "messages: Field required")
+        input_tokens = estimate_tokens(body)
+        if path == COUNT_TOKENS_PATH:
+            await self._send_response(writer, 200, json.dumps({'input_tokens': input_tokens}).encode(), keep_alive)
+            return keep_alive
+        max_tokens = request.get('max_tokens')
+        if not isinstance(max_tokens, int) or max_tokens < 1:
+            raise ProxyError(400, 'invalid_request_error', "max_tokens: Field required")
+
+        self.counts['requests'] += 1
+        request_id = f"{self.counts['requests']:012d}"
+        roll = self.random.random()
+        latency = self._sample_latency(self.random)
+        await asyncio.sleep(latency)
+        if roll < self.rate_limit:
+            self.counts['rate_limited'] += 1
+            raise ProxyError(429, 'rate_limit_error', "Mock rate limit", [('Retry-After', str(RETRY_AFTER_SECONDS))])
+        roll -= self.rate_limit
+        if roll < self.errors:
+            self.counts['errors'] += 1
+            error_type = 'overloaded_error' if self.error_status == 529 else 'api_error'
+            raise ProxyError(self.error_status, error_type, "Mock upstream error")
+        roll -= self.errors
+        output_tokens = min(max_tokens, self.output_tokens)
+        # A reset lands before the first token or part way through the reply
+        reset_after = None
+        if roll < self.resets:
+            self.counts['resets'] += 1
+            reset_after = self.random.randrange(output_tokens)
+            if not request.get('stream') or not reset_after:
+                raise ConnectionReset()
+
+        message = {'id': f"msg_mock{request_id}", 'type': 'message', 'role': 'assistant',
+                   'model': request.get('model') or 'mock', 'content': [], 'stop_reason': None,
+                   'stop_sequence': None, 'usage': {'input_tokens': input_tokens, 'output_tokens': 0}}
+        stop_reason = 'max_tokens' if output_tokens == max_tokens else 'end_turn'
+        if not request.get('stream'):
+            await self._generate(output_tokens)
+            text = ''.join(f"{WORDS[i % len(WORDS)]} " for i in range(output_tokens))
+            message.update(content=[{'type': 'text', 'text': text}], stop_reason=stop_reason)
+            message['usage']['output_tokens'] = output_tokens
+            await self._send_response(writer, 200, json.dumps(message).encode('utf-8'), keep_alive,
+                                      [('request-id', f"req_mock{request_id}")])
+            return keep_alive
+
+        writer.write(format_head("HTTP/1.1 200 OK", [
+            ('Content-Type', 'text/event-stream'),
+            ('Cache-Control', 'no-cache'),
+            ('Transfer-Encoding', 'chunked'),
+            ('Connection', 'keep-alive' if keep_alive else 'close'),
+            ('request-id', f"req_mock{request_id}")
+        ]))
+        writer.write(chunk(sse_event('message_start', {'type': 'message_start', 'message': message})
+                           + sse_event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                                               'content_block': {'type': 'text', 'text': ''}})
+                           + sse_event('ping', {'type': 'ping'})))
+        await writer.drain()
+        sent = 0
+        async for due in self._tokens_due(reset_after or output_tokens):
+            text = ''.join(f"{WORDS[i % len(WORDS)]} " for i in range(sent, due))
+            sent = due
+            writer.write(chunk(sse_event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                                                 'delta': {'type': 'text_delta', 'text': text}})))
+            await writer.drain()
+        if reset_after:
+            raise ConnectionReset()
+        writer.write(chunk(sse_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+                           + sse_event('message_delta', {'type': 'message_delta',
+                                                         'delta': {'stop_reason': stop_reason, 'stop_sequence': None},
+                                                         'usage': {'output_tokens': output_tokens}})
+                           + sse_event('message_stop', {'type': 'message_stop'}))
+                     + b'0\r\n\r\n')
+        await writer.drain()
+        return keep_alive
+
+    async def _tokens_due(self, count):
+        """Yield how many tokens are due so far, paced at tokens_per_second, until count"""
+        if not self.tokens_per_second:
+            yield count
+            return
+        loop = asyncio.get_running_loop()
+        start, sent = loop.time(), 0
+        while sent < count:
+            due = min(count, int((loop.time() - start) * self.tokens_per_second))
+            if due <= sent:
+                await asyncio.sleep(start + (sent + 1) / self.tokens_per_second - loop.time())
+                continue
+            sent = due
+            yield due
+
+    async def _generate(self, count):
+        """Wait as long as producing count tokens takes"""
+        if self.tokens_per_second:
+            await asyncio.sleep(count / self.tokens_per_second)
+
+    def _reset(self, writer):
+        """Drop the connection with a TCP RST rather than a clean close"""
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            except OSError:
+                pass
+        writer.transport.abort()
+
+    async def _send_response(self, writer, status, body, keep_alive, headers=()):
+        writer.write(format_head(f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}", [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Connection', 'keep-alive' if keep_alive else 'close')
+        ] + list(headers)) + body)
+        await writer.drain()
@@ -0,0 +1,1761 @@
+"""Local Anthropic-compatible routing proxy for Claude Code EZ Switch
+
+Claude Code is pointed at http://127.0.0.1:<port> (see ProxyProfile) and the
+proxy forwards every request to the stored profile selected in config.json.
+config.json is re-read whenever its stat signature changes, so switching the
+upstream takes effect on the next request without restarting Claude Code.
+
+Speaks HTTP/1.1 on both sides with asyncio streams and nothing outside the
+standard library. Bodies are relayed piece by piece as they arrive, so
+streamed (SSE) responses reach Claude Code unchanged. Every read and write
+buffer has a fixed bound (see READ_SIZE and WRITE_BUFFER_HIGH): when one side
+is slower, the other side's socket stops being read, so a connection's memory
+does not grow with prompt or response size. Each block a StreamReader returns
+is written on as is, without joins or slices; avoiding that one copy per block
+would take a BufferedProtocol instead of streams, which is not worth it next
+to TLS. The exception to relaying piece by piece: when hedging, failover or
+sticky keys, a concurrency limit or recording is on, request bodies up to
+REPLAY_BODY_LIMIT are read whole first, so they can be resent and their
+conversation recognised; a rewritten model is spliced in with memoryview
+slices rather than a copy of the body (see RequestBody). Larger bodies and all
+responses are always streamed.
+
+Upstream connections are kept alive and reused (HTTP/1.1; the standard library
+has no HTTP/2 client); a buffered request whose reused connection turns out to
+have been closed by the server is sent again on a new one. After a switch 'ezswitch apply proxy' and the GUI call
+PREWARM_PATH so DNS, TCP and TLS setup to the new upstream happen before
+Claude Code's next request rather than during it.
+
+Routes (proxy_routes) send requests for a model tier or model name pattern to
+another stored profile; the model is read from the first ROUTE_SCAN_LIMIT bytes
+of the request body. Requests forwarded to Z.ai have Claude tier names replaced
+with the GLM models chosen in the Z.ai configuration.
+
+With hedging (proxy_hedge) a request whose response has not started after a
+delay (fixed, or the observed p95) is also sent to a second stored profile;
+whichever response head arrives first is relayed and the other is dropped.
+
+With failover (proxy_failover) every stored profile gets a circuit breaker
+(see CircuitBreaker). A request skips profiles whose circuit is open and, when
+its body is buffered, is resent down the fallback list after a connection
+error, timeout or 5xx/429 answer, so a degraded upstream costs milliseconds
+rather than Claude Code's API_TIMEOUT_MS. Streamed requests whose response
+has not started within the latency threshold are given up on as well.
+
+With a key pool (proxy_key_pool) Z.ai requests are spread over several saved
+keys. A key answered with 429 sits out of the rotation for its Retry-After;
+the 429 itself is passed on, and Claude Code's own retry lands on another key.
+
+Upstream prompt caches are per key and per provider, so conversations are kept
+where they are cached (see AffinityTable): with the 'sticky' key strategy a
+conversation is placed on a key by rendezvous hashing and stays there while
+the key is not rate limited, and with failover a conversation that moved to a
+fallback stays there while its circuit is closed. A conversation is recognised
+by a hash of its system prompt and first message, which every turn repeats.
+
+With a concurrency limit (proxy_max_concurrency) each key, or each upstream
+without a pool, runs at most that many requests at once; the rest wait in a
+weighted fair queue (see Scheduler) so one busy session cannot starve the
+others, and Opus/Sonnet requests get a larger share than background Haiku ones.
+
+With recording (proxy_record) every request's shape is appended to a trace
+file (see TraceRecorder) that 'ezswitch bench --replay' re-issues later.
+
+'ezswitch proxy --workers N' runs N worker processes (see run_workers) that
+share the port through SO_REUSEPORT, so the kernel spreads connections over
+them. Key rate limits and open circuits are shared through SharedDeadlines;
+concurrency limits are not shared but split into equal static shares (rounded
+down), so a limit below the worker count is rejected. The other counters on
+the health endpoint are those of whichever worker answers it.
+"""
+import asyncio
+import hashlib
+import heapq
+import hmac
+import json
+import os
+import re
+import struct
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import ezswitch_core as core
+
+MAX_HEAD_SIZE = 64 * 1024
+# Largest block relayed per read; also the upstream StreamReader limit, which pauses the socket at twice this
+READ_SIZE = 64 * 1024
+# Writers wait in drain() once this much is queued for a slow peer
+WRITE_BUFFER_HIGH = 2 * READ_SIZE
+CONNECT_TIMEOUT = 10.0
+HEALTH_PATH = '/ezswitch/health'
+# How much of a request body is buffered to find its model for routing
+ROUTE_SCAN_LIMIT = 64 * 1024
+# Hedged and failed-over requests are replayed to another upstream, so their bodies are buffered whole up to this size
+REPLAY_BODY_LIMIT = 1024 * 1024
+# Hedge delay before enough response times are known for a p95
+DEFAULT_HEDGE_DELAY = 2.0
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+# A conversation's key or profile is remembered this long after its last request (the upstream prompt
+# cache lifetime; after that there is nothing left to stick to), for at most AFFINITY_ENTRIES conversations
+AFFINITY_SECONDS = 300.0
+AFFINITY_ENTRIES = 4096
+# Deadline slots in the table shared by worker processes; names hashing to a taken slot overwrite it
+SHARED_SLOTS = 1024
+SHARED_SLOT = struct.Struct('=Qd')  # name hash, time.monotonic() deadline
+# How long run_workers waits for every worker to be listening
+WORKER_START_TIMEOUT = 10.0
+# Queued requests share capacity by these weights; Opus, Sonnet and unknown models are interactive
+PRIORITY_WEIGHTS = {'interactive': 4, 'background': 1}
+# Recent queue waits kept per key and priority for the reported percentiles
+SCHEDULER_WINDOW = 200
+# Statuses that lose a hedge race to any other answer, and that a request fails over from
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504, 529}
+# Statuses that count against an upstream's circuit breaker (a 429 is about the key, not the upstream)
+BREAKER_FAILURE_STATUSES = RETRYABLE_STATUSES - {429}
+# Circuit breaker defaults: failure share over the last BREAKER_WINDOW outcomes that opens a circuit,
+# once at least BREAKER_MIN_REQUESTS are in, and how long a streamed response may take to start
+DEFAULT_BREAKER_ERROR_RATE = 0.5
+DEFAULT_BREAKER_LATENCY_MS = 20000
+BREAKER_WINDOW = 20
+BREAKER_MIN_REQUESTS = 5
+# An open circuit lets a probe through after this long, doubling after each failed probe up to the maximum
+BREAKER_OPEN_SECONDS = 15.0
+BREAKER_MAX_OPEN_SECONDS = 300.0
+PREWARM_PATH = '/ezswitch/prewarm'
+# Idle upstream connections kept per endpoint, and how long before they are dropped
+# (below the usual server keep-alive timeouts, so we rarely reuse one the server is closing)
+MAX_IDLE_CONNECTIONS = 8
+IDLE_CONNECTION_SECONDS = 30.0
+PREWARM_CONNECTIONS = 2
+# How long a pooled key rests after a 429 that carries no usable Retry-After
+DEFAULT_THROTTLE_SECONDS = 30.0
+MAX_THROTTLE_SECONDS = 3600.0
+
+# Headers that describe a single connection and are never forwarded
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+                      'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade'}
+# Replaced by the proxy on the way upstream
+CLIENT_ONLY_HEADERS = {'host', 'authorization', 'x-api-key', 'content-length'}
+
+class ProxyError(Exception):
+    """Failure answered to Claude Code as an Anthropic-style error response"""
+    def __init__(self, status, error_type, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.headers = list(headers)
+
+class StreamInterrupted(Exception):
+    """The response was already being relayed when a connection failed; the client connection is dropped"""
+
+class Upstream:
+    """Endpoint and credentials of a stored profile"""
+    def __init__(self, name, base_url, api_key, key_name=None):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Invalid base URL for '{name}': {base_url}")
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.key_name = key_name
+        self.tls = parts.scheme == 'https'
+        self.host = parts.hostname
+        default_port = 443 if self.tls else 80
+        self.port = parts.port or default_port
+        self.base_path = parts.path.rstrip('/')
+        self.host_header = self.host if self.port == default_port else f"{self.host}:{self.port}"
+        # Pooled Z.ai keys share one endpoint and therefore one set of connections
+        self.endpoint = (self.host, self.port, self.tls)
+
+    @classmethod
+    def from_profile(cls, name, profile):
+        """Upstream for a stored Profile; raises ValueError if the profile is incomplete"""
+        error = profile.validate()
+        if error:
+            raise ValueError(f"{name}: {error}")
+        env = profile.env()
+        return cls(name, env.get('ANTHROPIC_BASE_URL') or core.ANTHROPIC_BASE_URL,
+                   env.get('ANTHROPIC_AUTH_TOKEN', ''), getattr(profile, 'key_name', None))
+
+class ProxyConfig:
+    """Routing state derived from one version of config.json"""
+    def __init__(self, store):
+        self.token = store.get('proxy_token')
+        self.upstream_name = store.get('proxy_upstream') or 'zai'
+        self.key_strategy = store.get('proxy_key_strategy') or core.KEY_STRATEGIES[0]
+        self.zai_models = store.get('zai_models') or {}
+        self.upstreams = []
+        self.error = None
+        try:
+            self.upstreams = self._target_upstreams(store, self.upstream_name)
+        except ValueError as e:
+            self.error = str(e)
+        self.upstream = self.upstreams[0] if self.upstreams else None
+        self.pooled = len(self.upstreams) > 1
+
+        # Stored profile name -> its upstreams, for the default target and every usable route
+        self.targets = {self.upstream_name: self.upstreams}
+        self.routes = []
+        self.warnings = []
+        for route in store.get('proxy_routes') or []:
+            if self._add_target(store, route.get('upstream'), f"Route '{route.get('match')}' skipped"):
+                self.routes.append((route['match'], route['upstream'], route.get('model')))
+
+        hedge = store.get('proxy_hedge') or {}
+        self.hedge_upstream = None
+        self.hedge_delay_ms = hedge.get('delay_ms')
+        if hedge and self._add_target(store, hedge.get('upstream'), "Hedging disabled"):
+            self.hedge_upstream = hedge['upstream']
+
+        failover = store.get('proxy_failover') or {}
+        self.fallbacks = [name for name in failover.get('upstreams') or []
+                          if self._add_target(store, name, f"Fallback '{name}' skipped")]
+        self.breaker_error_rate = failover.get('error_rate') or DEFAULT_BREAKER_ERROR_RATE
+        self.breaker_latency_ms = failover.get('latency_ms') or DEFAULT_BREAKER_LATENCY_MS
+        self.max_concurrency = store.get('proxy_max_concurrency') or None
+        self.record = store.get('proxy_record') or None
+
+    def _add_target(self, store, name, context):
+        """Make a stored profile routable; a profile that is not configured becomes a warning"""
+        if name not in self.targets:
+            try:
+                self.targets[name] = self._target_upstreams(store, name)
+            except ValueError as e:
+                self.warnings.append(f"{context}: {e}")
+                return False
+        return True
+
+    @property
+    def inspects_model(self):
+        """Whether requests must be opened to read their model"""
+        return bool(self.routes) or any(name == 'zai' and self.zai_models for name in self.targets)
+
+    @property
+    def sticky(self):
+        """Whether requests are fingerprinted to keep conversations on one key or profile"""
+        return bool(self.fallbacks) or (self.key_strategy == 'sticky'
+                                        and any(len(upstreams) > 1 for upstreams in self.targets.values()))
+
+    def candidates(self, name, prefer=None):
+        """Stored profiles to try for a request routed to name, in order, starting with prefer if it is one"""
+        candidates = [name] + [fallback for fallback in self.fallbacks if fallback != name]
+        if prefer in candidates:
+            candidates.remove(prefer)
+            candidates.insert(0, prefer)
+        return candidates
+
+    def route(self, model):
+        """(profile name, replacement model or None) for a request's model"""
+        for pattern, name, replacement in self.routes:
+            if route_matches(pattern, model):
+                return name, replacement or self.target_model(name, model)
+        return self.upstream_name, self.target_model(self.upstream_name, model)
+
+    def target_model(self, name, model):
+        """Model to send to a stored profile instead of model, or None to keep it"""
+        if name == 'zai':
+            # Same tier mapping as ANTHROPIC_DEFAULT_<TIER>_MODEL in direct Z.ai mode
+            return self.zai_models.get(model_tier(model))
+        return None
+
+    def all_upstreams(self):
+        return [upstream for upstreams in self.targets.values() for upstream in upstreams]
+
+    @staticmethod
+    def _target_upstreams(store, name):
+        """Upstreams for a stored profile: one per pooled key for Z.ai with a key pool"""
+        if name == 'zai' and store.get('proxy_key_pool'):
+            return ProxyConfig._pooled_upstreams(store)
+        return [Upstream.from_profile(name, core.stored_profile(store, name))]
+
+    @staticmethod
+    def _pooled_upstreams(store):
+        """One Z.ai upstream per pooled key name; names no longer saved are skipped"""
+        upstreams = [Upstream.from_profile(f"zai:{name}", core.ZaiProfile(store.zai_keys[name], name))
+                     for name in store.get('proxy_key_pool') if name in store.zai_keys]
+        if not upstreams:
+            raise ValueError("None of the pooled Z.ai keys are saved any more")
+        return upstreams
+
+class SharedDeadlines:
+    """Deadlines (key rate limits, open circuits) shared by proxy worker processes
+
+    A fixed table in an anonymous shared memory mapping created before the
+    workers fork. time.monotonic() is system-wide, so a deadline written by one
+    worker means the same to all. Slots are read and written without locks: a
+    torn or overwritten slot only makes a worker send one request it could have
+    skipped, which the upstream answers as it would have anyway.
+    """
+    def __init__(self):
+        import mmap
+
+        self._map = mmap.mmap(-1, SHARED_SLOTS * SHARED_SLOT.size)
+        self._slots = {}
+
+    def _slot(self, name):
+        slot = self._slots.get(name)
+        if slot is None:
+            digest = int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little') | 1
+            slot = self._slots[name] = (digest, digest % SHARED_SLOTS * SHARED_SLOT.size)
+        return slot
+
+    def get(self, name):
+        """Deadline stored for name, or 0.0"""
+        digest, offset = self._slot(name)
+        stored, deadline = SHARED_SLOT.unpack_from(self._map, offset)
+        return deadline if stored == digest else 0.0
+
+    def set(self, name, deadline):
+        digest, offset = self._slot(name)
+        SHARED_SLOT.pack_into(self._map, offset, digest, deadline)
+
+class KeyState:
+    """Rotation counters for one pooled key"""
+    def __init__(self):
+        self.outstanding = 0
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_until = 0.0
+
+class KeyPool:
+    """Picks a pooled key per request and rests keys that were rate limited
+
+    Lives on the ProxyServer rather than the ProxyConfig so counters and
+    throttling survive config.json reloads. Only touched from the event loop.
+    With worker processes, rate limits are also published in shared.
+    """
+    def __init__(self, clock=time.monotonic, shared=None):
+        self.clock = clock
+        self.shared = shared
+        self.keys = {}
+        self._turn = 0
+
+    def state(self, upstream):
+        return self.keys.setdefault(upstream.key_name, KeyState())
+
+    def throttled_until(self, upstream):
+        until = self.state(upstream).throttled_until
+        if self.shared is not None:
+            until = max(until, self.shared.get(f"key:{upstream.key_name}"))
+        return until
+
+    def acquire(self, upstreams, strategy, fingerprint=None, prefer=None):
+        """Reserve a key for one request; raises a 429 ProxyError when every key is throttled
+
+        With the 'sticky' strategy a fingerprinted request gets the key named
+        prefer if it is available, else the key its fingerprint hashes to.
+        """
+        now = self.clock()
+        available = [upstream for upstream in upstreams if self.throttled_until(upstream) <= now]
+        if not available:
+            wait = min(self.throttled_until(upstream) for upstream in upstreams) - now
+            retry_after = max(1, int(wait + 0.999))
+            raise ProxyError(429, 'rate_limit_error',
+                             f"All {len(upstreams)} pooled Z.ai keys are rate limited; retry in {retry_after}s",
+                             [('Retry-After', str(retry_after))])
+
+        # Rotating the start point spreads ties in least-outstanding too
+        start = self._turn % len(available)
+        self._turn += 1
+        available = available[start:] + available[:start]
+        if strategy == 'sticky' and fingerprint is not None:
+            preferred = [u for u in available if u.key_name == prefer]
+            upstream = preferred[0] if preferred else max(available, key=lambda u: rendezvous_score(fingerprint, u.key_name))
+        elif strategy == 'least-outstanding':
+            upstream = min(available, key=lambda u: self.state(u).outstanding)
+        else:
+            upstream = available[0]
+
+        state = self.state(upstream)
+        state.outstanding += 1
+        state.requests += 1
+        return upstream
+
+    def release(self, upstream, status=None, headers=()):
+        """Finish a request; a 429 takes the key out of rotation for its Retry-After"""
+        state = self.state(upstream)
+        state.outstanding -= 1
+        if status == 429:
+            state.throttled += 1
+            state.throttled_until = self.clock() + retry_after_seconds(get_header(headers, 'retry-after'))
+            if self.shared is not None:
+                self.shared.set(f"key:{upstream.key_name}", state.throttled_until)
+
+    def stats(self, upstreams):
+        """Per-key counters for the health endpoint"""
+        now = self.clock()
+        stats = {}
+        for upstream in upstreams:
+            state = self.state(upstream)
+            stats[upstream.key_name] = {'outstanding': state.outstanding, 'requests': state.requests,
+                                        'throttled': state.throttled,
+                                        'retry_in': round(max(0.0, self.throttled_until(upstream) - now), 1)}
+        return stats
+
+class AffinityTable:
+    """Which profile and key recently served each conversation, and how often a conversation stayed put
+
+    A follow-up request is one whose conversation was seen within
+    AFFINITY_SECONDS; the hit rate is the share of follow-ups answered by the
+    same key (or profile) as the request before, i.e. where the upstream prompt
+    cache could be reused. Event loop thread only.
+    """
+    def __init__(self, clock=time.monotonic):
+        from collections import OrderedDict
+
+        self.clock = clock
+        self.entries = OrderedDict()  # fingerprint -> (routed profile, serving profile, upstream name, last seen)
+        self.requests = 0
+        self.follow_ups = 0
+        self.hits = 0
+
+    def lookup(self, fingerprint, routed):
+        """(serving profile, key name) that last answered this conversation while it was routed to routed, or None"""
+        entry = self.entries.get(fingerprint)
+        if entry is None or entry[0] != routed or self.clock() - entry[3] >= AFFINITY_SECONDS:
+            return None
+        return entry[1], entry[2]
+
+    def record(self, fingerprint, routed, profile, upstream):
+        """Remember who answered a conversation's latest request"""
+        now = self.clock()
+        entry = self.entries.pop(fingerprint, None)
+        self.requests += 1
+        if entry is not None and now - entry[3] < AFFINITY_SECONDS:
+            self.follow_ups += 1
+            if entry[1:3] == (profile, upstream.key_name):
+                self.hits += 1
+        self.entries[fingerprint] = (routed, profile, upstream.key_name, now)
+        if len(self.entries) > AFFINITY_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """Counters for the health endpoint"""
+        return {'conversations': len(self.entries), 'requests': self.requests, 'follow_ups': self.follow_ups,
+                'hit_rate': round(self.hits / self.follow_ups, 3) if self.follow_ups else 0.0}
+
+class CircuitBreaker:
+    """Closed, open or half-open state of one stored profile
+
+    Closed: outcomes of the last BREAKER_WINDOW requests are kept, and once
+    BREAKER_MIN_REQUESTS are in, a failure share at the error rate opens the
+    circuit. Open: requests skip the profile until the open time is up. Half-open:
+    a single probe request is let through; its success closes the circuit and
+    its failure opens it again for twice as long. Event loop thread only.
+
+    With worker processes the open time is published in shared under name, and
+    a circuit opened by another worker is treated as open here too; the worker
+    that opened it sends the probe.
+    """
+    def __init__(self, clock=time.monotonic, shared=None, name=None):
+        from collections import deque
+
+        self.clock = clock
+        self.shared = shared
+        self.name = name
+        self.state = 'closed'
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.open_until = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def allow(self):
+        """Whether a request may go to this profile now (claims the probe when half-open)"""
+        if self.state == 'closed' and self.shared_open_until() > self.clock():
+            return False
+        if self.state == 'open' and self.clock() >= self.open_until:
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            if self.probing:
+                return False
+            self.probing = True
+        return self.state != 'open'
+
+    def record(self, ok, error_rate):
+        """Count an outcome: True, False (error or too slow) or None for an attempt abandoned without one"""
+        if ok is None:
+            self.probing = False
+        elif self.state == 'half-open':
+            self.probing = False
+            if ok:
+                self.state = 'closed'
+                self.open_seconds = BREAKER_OPEN_SECONDS
+                if self.shared is not None:
+                    self.shared.set(f"circuit:{self.name}", 0.0)
+            else:
+                self._open(min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS))
+        elif self.state == 'closed':
+            self.outcomes.append(ok)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= BREAKER_MIN_REQUESTS and failures >= error_rate * len(self.outcomes):
+                self._open(BREAKER_OPEN_SECONDS)
+
+    def _open(self, seconds):
+        self.state = 'open'
+        self.open_seconds = seconds
+        self.open_until = self.clock() + seconds
+        self.outcomes.clear()
+        self.trips += 1
+        if self.shared is not None:
+            self.shared.set(f"circuit:{self.name}", self.open_until)
+
+    def shared_open_until(self):
+        """When a circuit opened by another worker process closes again, or 0.0"""
+        return self.shared.get(f"circuit:{self.name}") if self.shared is not None else 0.0
+
+    def stats(self):
+        """State and counters for the health endpoint"""
+        failures = self.outcomes.count(False)
+        state, now = self.state, self.clock()
+        retry_in = max(0.0, self.open_until - now) if state == 'open' else 0.0
+        if state == 'closed' and self.shared_open_until() > now:
+            state, retry_in = 'open', self.shared_open_until() - now
+        return {'state': state, 'trips': self.trips, 'samples': len(self.outcomes),
+                'failure_rate': round(failures / len(self.outcomes), 3) if self.outcomes else 0.0,
+                'retry_in': round(retry_in, 1)}
+
+class BackendQueue:
+    """Requests running on one key or upstream and those waiting for it"""
+    def __init__(self):
+        from collections import deque
+
+        self.limit = 1
+        self.active = 0
+        self.waiting = []  # heap of (finish tag, sequence, future, enqueued at, priority)
+        self.virtual = 0.0  # finish tag of the request let through last
+        self.last_tag = {}  # session -> finish tag of its latest queued request
+        self.queued = 0  # requests that had to wait
+        self.waits = {priority: deque(maxlen=SCHEDULER_WINDOW) for priority in PRIORITY_WEIGHTS}
+
+class Scheduler:
+    """Per-key concurrency limits with weighted fair queuing across client sessions
+
+    A request that finds its key at the limit is queued with a virtual finish
+    tag: its session's previous tag (or the queue's current one, whichever is
+    later) plus 1/weight. The lowest tag goes first, so sessions take turns
+    however many requests each has queued, and an interactive request costs a
+    session a quarter of a background one. Event loop thread only.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.queues = {}
+        self._sequence = 0
+
+    async def acquire(self, backend, limit, session, priority):
+        """Wait for a slot on backend; every acquire must be followed by release(backend)"""
+        queue = self.queues.setdefault(backend, BackendQueue())
+        queue.limit = limit
+        if queue.active < limit and not queue.waiting:
+            queue.active += 1
+            queue.waits[priority].append(0.0)
+            return
+
+        tag = max(queue.virtual, queue.last_tag.get(session, 0.0)) + 1 / PRIORITY_WEIGHTS[priority]
+        queue.last_tag[session] = tag
+        self._sequence += 1
+        entry = (tag, self._sequence, asyncio.get_running_loop().create_future(), self.clock(), priority)
+        heapq.heappush(queue.waiting, entry)
+        queue.queued += 1
+        self._dispatch(queue)
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            if entry[2].done() and not entry[2].cancelled():
+                self.release(backend)  # the slot arrived together with the cancellation
+            elif entry in queue.waiting:
+                # Still queued (_dispatch drops cancelled entries it reaches first)
+                queue.waiting.remove(entry)
+                heapq.heapify(queue.waiting)
+            raise
+
+    def release(self, backend):
+        queue = self.queues[backend]
+        queue.active -= 1
+        self._dispatch(queue)
+
+    def _dispatch(self, queue):
+        """Let queued requests through, lowest finish tag first, while there are free slots"""
+        while queue.waiting and queue.active < queue.limit:
+            tag, _, future, enqueued, priority = heapq.heappop(queue.waiting)
+            if future.done():
+                continue  # cancelled while queued; its waiter has not run its cleanup yet
+            queue.virtual = tag
+            queue.active += 1
+            queue.waits[priority].append(self.clock() - enqueued)
+            future.set_result(None)
+        if not queue.waiting:
+            queue.last_tag.clear()
+
+    def stats(self):
+        """Slots, queue depth and wait percentiles per key for the health endpoint"""
+        stats = {}
+        for backend, queue in self.queues.items():
+            waits = {}
+            for priority, samples in queue.waits.items():
+                ordered = sorted(samples)
+                if ordered:
+                    waits[priority] = {'p50_ms': round(ordered[len(ordered) // 2] * 1000),
+                                       'p95_ms': round(ordered[int(len(ordered) * 0.95)] * 1000)}
+            stats[backend] = {'limit': queue.limit, 'active': queue.active, 'waiting': len(queue.waiting),
+                              'queued': queue.queued, 'waits': waits}
+        return stats
+
+class OutgoingRequest:
+    """A client request as _send forwards it, whichever profile it goes to"""
+    def __init__(self, method, target, headers, reader):
+        self.method = method
+        self.target = target
+        self.headers = headers
+        self.reader = reader  # client connection the rest of the body comes from
+        self.fingerprint = None  # conversation, for sticky keys
+        self.prefer_key = None  # key name that last served the conversation
+        self.session = None  # client session the scheduler shares slots between
+        self.priority = 'interactive'
+
+class Exchange:
+    """A request sent upstream whose response head has arrived, holding its connection and pooled key"""
+    def __init__(self, upstream, pooled):
+        self.upstream = upstream
+        self.pooled = pooled
+        self.profile = None
+        self.slot = None  # scheduler backend holding a slot for this request
+        self.connection = None
+        self.status_line = None
+        self.status = None
+        self.headers = []
+
+class UpstreamConnection:
+    """An open upstream connection and when it was last returned to the pool"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = time.monotonic()
+        self.from_pool = False  # taken from the idle pool rather than opened for this request
+
+    def usable(self, now):
+        """Still open, not closed by the server and not idle too long"""
+        return (not self.writer.is_closing() and not self.reader.at_eof()
+                and now - self.idle_since < IDLE_CONNECTION_SECONDS)
+
+    def close(self):
+        self.writer.close()
+
+class ConnectionPool:
+    """Idle keep-alive connections per upstream endpoint (event loop thread only)"""
+    def __init__(self, ssl_context):
+        self.ssl_context = ssl_context
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+        self.stale = 0  # pooled connections the server closed as they were reused
+
+    async def open(self, upstream):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(upstream.host, upstream.port, limit=READ_SIZE,
+                                    ssl=self.ssl_context() if upstream.tls else None),
+            CONNECT_TIMEOUT)
+        bound_write_buffer(writer)
+        self.opened += 1
+        return UpstreamConnection(reader, writer)
+
+    def _usable_idle(self, upstream):
+        """Idle connections to upstream's endpoint, dropping stale ones"""
+        now = time.monotonic()
+        idle = self.idle.setdefault(upstream.endpoint, [])
+        for connection in [c for c in idle if not c.usable(now)]:
+            idle.remove(connection)
+            connection.close()
+        return idle
+
+    async def acquire(self, upstream):
+        """An idle connection to upstream, or a new one"""
+        idle = self._usable_idle(upstream)
+        if idle:
+            self.reused += 1
+            # Most recently used first: the least likely to be timing out on the server
+            connection = idle.pop()
+            connection.from_pool = True
+            return connection
+        return await self.open(upstream)
+
+    def release(self, upstream, connection, reusable):
+        """Return a connection after a request; anything not cleanly finished is closed"""
+        idle = self.idle.setdefault(upstream.endpoint, [])
+        if reusable and len(idle) < MAX_IDLE_CONNECTIONS and not connection.writer.is_closing():
+            connection.idle_since = time.monotonic()
+            idle.append(connection)
+        else:
+            connection.close()
+
+    async def prewarm(self, upstream, count=PREWARM_CONNECTIONS):
+        """Open connections until count are idle for upstream; returns how many were opened"""
+        missing = count - len(self._usable_idle(upstream))
+        if missing <= 0:
+            return 0
+        results = await asyncio.gather(*(self.open(upstream) for _ in range(missing)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            self.release(upstream, result, True)
+        return missing
+
+    def retain(self, endpoints):
+        """Close idle connections to endpoints no longer configured (e.g. after a switch)"""
+        for endpoint in [endpoint for endpoint in self.idle if endpoint not in endpoints]:
+            for connection in self.idle.pop(endpoint):
+                connection.close()
+
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused, 'stale': self.stale,
+                'idle': sum(len(idle) for idle in self.idle.values())}
+
+    def close_all(self):
+        for idle in self.idle.values():
+            for connection in idle:
+                connection.close()
+        self.idle.clear()
+
+def retry_after_seconds(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                seconds = DEFAULT_THROTTLE_SECONDS
+        return min(max(seconds, 0.0), MAX_THROTTLE_SECONDS)
+    return DEFAULT_THROTTLE_SECONDS
+
+def model_tier(model):
+    """'opus', 'sonnet' or 'haiku' for a Claude model id, else None"""
+    model = model.lower()
+    for tier in core.MODEL_TIERS:
+        if tier in model:
+            return tier
+    return None
+
+def route_matches(pattern, model):
+    """A route matches a tier name ('haiku') or a case-insensitive model glob ('claude-opus-4*')"""
+    from fnmatch import fnmatchcase
+
+    pattern = pattern.lower()
+    if pattern in core.MODEL_TIERS:
+        return model_tier(model) == pattern
+    return fnmatchcase(model.lower(), pattern)
+
+# Top-level keys are walked in order; the C scanner in JSONDecoder skips each value
+OBJECT_START = re.compile(r'\s*\{\s*')
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+KEY_SEPARATOR = re.compile(r'\s*:\s*')
+VALUE_SEPARATOR = re.compile(r'\s*,\s*')
+FIRST_ITEM = re.compile(r'\[\s*')
+JSON_DECODER = json.JSONDecoder()
+
+def find_fields(prefix, names, first_items=()):
+    """Locate top-level values in a (possibly truncated) JSON body
+
+    Returns {name: (value, start, end)} with start:end spanning each raw value,
+    for those of names whose value lies wholly within prefix. For names in
+    first_items (arrays) only the first item is read.
+    """
+    text = prefix.decode('latin-1')  # one character per byte, so offsets carry over
+    wanted = {json.dumps(name): name for name in list(names) + list(first_items)}
+    found = {}
+    start = OBJECT_START.match(text)
+    position = start.end() if start else len(text)
+    while len(found) < len(wanted):
+        key = JSON_STRING.match(text, position)
+        separator = key and KEY_SEPARATOR.match(text, key.end())
+        if not separator:
+            break
+        name = wanted.get(key.group())
+        start = separator.end()
+        try:
+            if name in first_items:
+                item = FIRST_ITEM.match(text, start)
+                if item:
+                    item_end = JSON_DECODER.raw_decode(text, item.end())[1]
+                    found.setdefault(name, (json.loads(prefix[item.end():item_end]), item.end(), item_end))
+            end = JSON_DECODER.raw_decode(text, start)[1]
+        except ValueError:
+            break  # cut off by the end of prefix
+        if name and name not in first_items:
+            found.setdefault(name, (json.loads(prefix[start:end]), start, end))
+        comma = VALUE_SEPARATOR.match(text, end)
+        if not comma:
+            break
+        position = comma.end()
+    return found
+
+def conversation_fingerprint(fields):
+    """Hash of the system prompt and first message found by find_fields, or None without a first message
+
+    cache_control markers are left out: Claude Code moves them to the newest
+    messages as a conversation grows.
+    """
+    if 'messages' not in fields:
+        return None
+    parts = [without_cache_control(fields[name][0]) if name in fields else None for name in ('system', 'messages')]
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+def client_session(headers, fields, fingerprint):
+    """Who a request belongs to for fair sharing: Claude Code's session, else its conversation"""
+    session = get_header(headers, 'x-claude-code-session-id')
+    if session:
+        return session
+    metadata = fields.get('metadata', (None,))[0]
+    if isinstance(metadata, dict) and isinstance(metadata.get('user_id'), str):
+        return metadata['user_id']  # Claude Code's includes the session id
+    return fingerprint or 'anonymous'
+
+def without_cache_control(value):
+    if isinstance(value, dict):
+        return {key: without_cache_control(item) for key, item in value.items() if key != 'cache_control'}
+    if isinstance(value, list):
+        return [without_cache_control(item) for item in value]
+    return value
+
+def rendezvous_score(fingerprint, key_name):
+    """Rendezvous (highest random weight) score of a key for a conversation
+
+    A conversation goes to the available key with the highest score, so taking
+    a key out of rotation only moves the conversations that were on it.
+    """
+    return hashlib.blake2b(f"{fingerprint}:{key_name}".encode('utf-8'), digest_size=8).digest()
+
+class RequestBody:
+    """A request body on its way upstream: an optional buffered prefix, then the rest from the client"""
+    def __init__(self, framing, length):
+        self.framing = framing
+        self.length = length
+        self.prefix = b''  # bytes read from the client
+        self.parts = ()  # what is sent in their place: the prefix, or memoryview slices of it around spliced data
+        self._unread = length
+
+    async def buffer_prefix(self, reader, limit):
+        """Read up to limit bytes of a Content-Length body into prefix"""
+        self.prefix = await reader.readexactly(min(self.length, limit))
+        self.parts = (self.prefix,)
+        self._unread = self.length - len(self.prefix)
+
+    @property
+    def buffered(self):
+        """True if nothing is left to read from the client, so the body can be sent more than once"""
+        return self.framing == 'none' or (self.framing == 'length' and not self._unread)
+
+    def replaced(self, start, end, data):
+        """Copy with data spliced into the buffered prefix and length kept in step
+
+        The copy shares the prefix through memoryview slices, so rewriting the
+        model of a buffered body (once per profile tried) does not copy it.
+        """
+        view = memoryview(self.prefix)
+        body = RequestBody(self.framing, self.length + len(data) - (end - start))
+        body.prefix = self.prefix
+        body.parts = (view[:start], data, view[end:])
+        body._unread = self._unread
+        return body
+
+    async def relay(self, reader, writer):
+        if self.framing == 'length':
+            # One write per part: the transport sends what the socket takes without joining them first
+            for part in self.parts:
+                writer.write(part)
+            await writer.drain()
+            await relay_block(reader, writer, self._unread)
+        else:
+            await relay_body(reader, writer, self.framing, self.length)
+
+class TraceRecorder:
+    """Appends one JSON line per proxied request to the proxy_record trace file
+
+    A line holds the request's arrival time, model, tier, streaming flag,
+    max_tokens and size, and how the answering profile responded; the body
+    only when proxy_record asks for it (and it was buffered, see REPLAY_BODY_LIMIT).
+    Each line is a single O_APPEND write, so worker processes can share a file.
+    """
+    def __init__(self):
+        self.path = None
+        self.recorded = 0
+        self._fd = None
+
+    def write(self, path, record):
+        """Append record to path, (re)opening the file when the configured path changed"""
+        if path != self.path:
+            self.close()
+            self.path = path
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                # Kept bodies are whole prompts, so the trace is private like config.json
+                self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            except OSError as e:
+                print(f"Warning: Cannot record proxy traffic to {path}: {e}")
+        if self._fd is None:
+            return
+        try:
+            os.write(self._fd, json.dumps(record).encode('utf-8') + b'\n')
+            self.recorded += 1
+        except OSError as e:
+            print(f"Warning: Cannot record proxy traffic to {path}: {e}")
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = None
+        self.path = None
+
+def load_proxy_config(path):
+    """Parse config.json into a ProxyConfig (cache loader)"""
+    return ProxyConfig(core.ConfigStore(path, legacy_path=path).load())
+
+def get_header(headers, name):
+    """Value of the first header called name (case-insensitive), or None"""
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+async def read_head(reader):
+    """Read a start line and headers; returns (start_line, [(name, value)]) or None at a clean EOF"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise ProxyError(400, 'invalid_request_error', "Incomplete HTTP message head")
+    except asyncio.LimitOverrunError:
+        raise ProxyError(431, 'invalid_request_error', "HTTP message head too large")
+
+    lines = head[:-4].decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ProxyError(400, 'invalid_request_error', f"Malformed header line: {line!r}")
+        headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+def body_framing(headers, response=False):
+    """How a message body is delimited: ('length', n), ('chunked', None), ('eof', None) or ('none', None)"""
+    transfer_encoding = get_header(headers, 'transfer-encoding')
+    if transfer_encoding and transfer_encoding.lower().endswith('chunked'):
+        return 'chunked', None
+    content_length = get_header(headers, 'content-length')
+    if content_length is not None:
+        try:
+            length = int(content_length)
+        except ValueError:
+            raise ProxyError(400, 'invalid_request_error', f"Invalid Content-Length: {content_length}")
+        return 'length', length
+    # Requests without framing have no body; responses run until the connection closes
+    return ('eof', None) if response else ('none', None)
+
+def bound_write_buffer(writer):
+    """Make drain() wait once WRITE_BUFFER_HIGH bytes are queued for the peer"""
+    writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+
+async def relay_block(reader, writer, size):
+    """Relay exactly size bytes, at most READ_SIZE per write, waiting for the writer each time"""
+    while size:
+        data = await reader.read(min(READ_SIZE, size))
+        if not data:
+            raise ConnectionError("Connection closed mid-body")
+        size -= len(data)
+        # bytes from the reader go to the transport as is; no joins or slicing copies
+        writer.write(data)
+        await writer.drain()
+
+async def relay_body(reader, writer, framing, length=None, rechunk=False):
+    """Copy a body from reader to writer as it arrives, waiting for the writer to drain
+
+    rechunk sends an EOF-delimited body with chunked encoding so the client
+    connection can stay open.
+    """
+    if framing == 'length':
+        await relay_block(reader, writer, length)
+
+    elif framing == 'chunked':
+        while True:
+            size_line = await reader.readline()
+            if not size_line.endswith(b'\n'):
+                raise ConnectionError("Connection closed mid-body")
+            try:
+                size = int(size_line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise ConnectionError(f"Malformed chunk size: {size_line!r}")
+            writer.write(size_line)
+            if size == 0:
+                # Trailers end with an empty line
+                while True:
+                    line = await reader.readline()
+                    if not line.endswith(b'\n'):
+                        raise ConnectionError("Connection closed mid-body")
+                    writer.write(line)
+                    if line in (b'\r\n', b'\n'):
+                        break
+                await writer.drain()
+                return
+            # Chunk data plus its CRLF; a huge chunk is still relayed block by block
+            await relay_block(reader, writer, size + 2)
+
+    elif framing == 'eof':
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            if rechunk:
+                writer.writelines((b'%x\r\n' % len(data), data, b'\r\n'))
+            else:
+                writer.write(data)
+            await writer.drain()
+        if rechunk:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+
+def format_head(start_line, headers):
+    """Serialize a start line and header list into an HTTP message head"""
+    lines = [start_line] + [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+def error_body(error_type, message):
+    """Anthropic API error payload"""
+    return json.dumps({'type': 'error', 'error': {'type': error_type, 'message': message}}).encode('utf-8')
+
+class AsyncServer:
+    """Foreground or background lifecycle of an asyncio server (ProxyServer, ezswitch_mock.MockServer)
+
+    Subclasses implement start(), which sets _server, and a client handler
+    that keeps each open connection's writer in _client_writers so stopping
+    closes it; _release() frees whatever else they hold at shutdown.
+    """
+    def __init__(self):
+        self._server = None
+        self._loop = None
+        self._stop_event = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._start_error = None
+        self._client_writers = set()
+
+    async def start(self):
+        raise NotImplementedError
+
+    def _release(self):
+        pass
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        try:
+            await self.start()
+        except OSError as e:
+            self._start_error = e
+            self._ready.set()
+            raise
+        self._ready.set()
+        await self._stop_event.wait()
+
+        self._server.close()
+        for writer in list(self._client_writers):
+            writer.close()
+        self._release()
+        await self._server.wait_closed()
+
+    def run(self):
+        """Serve in the foreground until stop() is called or the process is interrupted"""
+        asyncio.run(self._main())
+
+    def start_in_thread(self):
+        """Serve on a daemon thread; returns once listening, raises OSError if the port is taken"""
+        def target():
+            try:
+                asyncio.run(self._main())
+            except OSError:
+                pass
+
+        self._thread = threading.Thread(target=target, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._start_error is not None:
+            raise self._start_error
+        return self
+
+    def stop(self):
+        """Stop listening and close client connections (safe to call from any thread)"""
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+
+class ProxyServer(AsyncServer):
+    """Asyncio HTTP/1.1 proxy that forwards Claude Code traffic to the active stored profile
+
+    Run it in the foreground with run(), or on a daemon thread with
+    start_in_thread() (used by the GUI and 'ezswitch serve --proxy'). As one of
+    run_workers() processes it is given the worker count and the shared deadlines.
+    """
+    def __init__(self, config_file=core.CONFIG_FILE, host=core.PROXY_HOST, port=None, workers=1, shared=None):
+        super().__init__()
+        self.config_file = Path(config_file)
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.shared = shared
+        self._config_cache = core.SettingsFileCache()
+        self._ssl_context = None
+        self.key_pool = KeyPool(shared=shared)
+        self.routed = {}  # stored profile name -> requests routed there
+        self.hedging = {}  # stored profile name -> hedge counters
+        self.head_latency = {}  # stored profile name -> recent seconds to response head
+        self.breakers = {}  # stored profile name -> CircuitBreaker
+        self.failovers = 0  # requests answered by a profile other than the one they were routed to
+        self.affinity = AffinityTable()
+        self.scheduler = Scheduler()
+        self.recorder = TraceRecorder()
+        self.connections = ConnectionPool(self.ssl_context)
+        self._prewarm_task = None
+        self.requests = 0
+        self.errors = 0
+        self.active = 0
+
+    def config(self):
+        """Current ProxyConfig, re-read only when config.json changed"""
+        try:
+            return self._config_cache.load(self.config_file, load_proxy_config)
+        except (OSError, ValueError) as e:
+            raise ProxyError(503, 'api_error', f"Cannot read EZ Switch config {self.config_file}: {e}")
+
+    def ssl_context(self):
+        """Shared client TLS context (loading the CA bundle is slow, so do it once)"""
+        if self._ssl_context is None:
+            import ssl
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    def stats(self):
+        """Request counters reported on the health endpoint"""
+        return {'requests': self.requests, 'errors': self.errors, 'active': self.active,
+                'upstream_connections': self.connections.stats()}
+
+    async def start(self):
+        """Start listening; the port defaults to proxy_port from config.json"""
+        if self.port is None:
+            try:
+                store = core.ConfigStore(self.config_file, legacy_path=self.config_file).load()
+                self.port = int(store.get('proxy_port') or core.DEFAULT_PROXY_PORT)
+            except (OSError, ValueError):
+                self.port = core.DEFAULT_PROXY_PORT
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port, limit=MAX_HEAD_SIZE,
+                                                  reuse_port=self.workers > 1 or None)
+        self._prewarm_task = asyncio.create_task(self._prewarm_quietly())
+        return self
+
+    async def prewarm(self):
+        """Open connections to the configured upstream ahead of the next request; returns how many"""
+        config = self.config()
+        if config.error:
+            raise ProxyError(503, 'api_error', f"Proxy upstream is not usable: {config.error}")
+        # One entry per endpoint: all keys of a pool share connections; routed targets are warmed too
+        upstreams = {upstream.endpoint: upstream for upstream in config.all_upstreams()}
+        self.connections.retain(upstreams)
+        opened = await asyncio.gather(*(self.connections.prewarm(upstream) for upstream in upstreams.values()))
+        return sum(opened)
+
+    async def _prewarm_quietly(self):
+        # At startup the network may not be up yet; requests open connections on demand anyway
+        try:
+            await self.prewarm()
+        except (ProxyError, OSError, asyncio.TimeoutError):
+            pass
+
+    def _release(self):
+        self.connections.close_all()
+        self.recorder.close()
+
+    async def _handle_client(self, reader, writer):
+        self._client_writers.add(writer)
+        bound_write_buffer(writer)
+        try:
+            while True:
+                try:
+                    head = await read_head(reader)
+                except ProxyError as e:
+                    await self._send_error(writer, e)
+                    break
+                if head is None:
+                    break
+                if not await self._handle_request(head, reader, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Idle connections are cancelled at shutdown; finishing quietly avoids a traceback on 3.11
+            pass
+        except Exception as e:
+            print(f"Warning: Proxy connection failed: {e}")
+        finally:
+            self._client_writers.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, head, reader, writer):
+        """Serve one request; returns True if the client connection can be reused"""
+        request_line, headers = head
+        self.requests += 1
+        self.active += 1
+        trace = None
+        try:
+            parts = request_line.split(' ')
+            if len(parts) != 3 or not parts[1].startswith('/'):
+                raise ProxyError(400, 'invalid_request_error', f"Unsupported request line: {request_line!r}")
+            method, target, version = parts
+            connection = (get_header(headers, 'connection') or '').lower()
+            keep_alive = version == 'HTTP/1.1' and 'close' not in connection
+
+            if target == HEALTH_PATH:
+                config = self.config()
+                health = dict(self.stats(), ok=True, pid=os.getpid(), upstream=config.upstream_name, error=config.error)
+                if self.workers > 1:
+                    health['workers'] = self.workers
+                if config.routes or config.warnings:
+                    health.update(routed=self.routed, warnings=config.warnings)
+                if config.hedge_upstream:
+                    health['hedging'] = self.hedge_report(config)
+                if config.fallbacks:
+                    health['failover'] = {'upstreams': config.fallbacks, 'failovers': self.failovers,
+                                          'breakers': {name: self.breaker(name).stats() for name in config.targets}}
+                if config.sticky:
+                    health['affinity'] = self.affinity.stats()
+                if config.max_concurrency:
+                    health['scheduler'] = self.scheduler.stats()
+                if config.record:
+                    health['recording'] = {'path': config.record.get('path'), 'recorded': self.recorder.recorded}
+                if config.pooled:
+                    health.update(key_strategy=config.key_strategy, keys=self.key_pool.stats(config.upstreams))
+                body = json.dumps(health).encode('utf-8')
+                await self._send_response(writer, 200, body, keep_alive)
+                return keep_alive
+
+            config = self.config()
+            self._authorize(headers, config)
+            if target == PREWARM_PATH:
+                # Nothing reads a request body here, so only an empty one leaves the connection reusable
+                keep_alive = keep_alive and body_framing(headers) in (('none', None), ('length', 0))
+                opened = await self.prewarm()
+                body = json.dumps({'ok': True, 'opened': opened, 'upstream': config.upstream_name}).encode('utf-8')
+                await self._send_response(writer, 200, body, keep_alive)
+                return keep_alive
+            if config.record:
+                trace = {'t': round(time.time(), 3), 'target': target}
+                started = time.monotonic()
+            elif self.recorder.path:
+                self.recorder.close()
+            request = RequestBody(*body_framing(headers))
+            if request.framing == 'length' and request.length:
+                # Small bodies are kept whole so a hedge or failover can resend them
+                # and the conversation and session can be recognised (or recorded)
+                whole = config.hedge_upstream or config.sticky or config.max_concurrency or config.record
+                limit = REPLAY_BODY_LIMIT if whole else ROUTE_SCAN_LIMIT if config.inspects_model else 0
+                if limit:
+                    await request.buffer_prefix(reader, limit)
+            fields = {}
+            if request.prefix and (config.sticky or config.max_concurrency or config.record):
+                fields = find_fields(request.prefix, ('model', 'stream', 'system', 'metadata', 'max_tokens'),
+                                     ('messages',))
+            elif request.prefix and config.inspects_model:
+                fields = find_fields(request.prefix, ('model',))
+            found = fields.get('model')
+            if found and not isinstance(found[0], str):
+                found = None
+            if trace is not None:
+                trace.update(model=found and found[0], tier=found and model_tier(found[0]),
+                             stream=fields.get('stream', (None,))[0], max_tokens=fields.get('max_tokens', (None,))[0],
+                             request_bytes=request.length if request.framing == 'length' else None)
+                if config.record.get('bodies') and request.buffered and request.prefix:
+                    trace['body'] = request.prefix.decode('utf-8', 'replace')
+
+            def body_for(name):
+                """The request body as sent to a stored profile, with its model replaced if needed"""
+                replacement = config.target_model(name, found[0]) if found else None
+                if name == routed_name and found:
+                    replacement = routed_model
+                if not replacement or replacement == found[0]:
+                    return request
+                return request.replaced(found[1], found[2], json.dumps(replacement).encode('utf-8'))
+
+            routed_name, routed_model = config.route(found[0]) if found else (config.upstream_name, None)
+            upstreams = config.targets.get(routed_name)
+            if not upstreams:
+                raise ProxyError(503, 'api_error', f"Proxy upstream is not usable: {config.error}")
+            if config.routes:
+                self.routed[routed_name] = self.routed.get(routed_name, 0) + 1
+
+            send = OutgoingRequest(method, target, headers, reader)
+            send.fingerprint = conversation_fingerprint(fields) if fields else None
+            stuck = self.affinity.lookup(send.fingerprint, routed_name) if send.fingerprint and config.sticky else None
+            send.prefer_key = stuck and stuck[1]
+            if config.max_concurrency:
+                if config.max_concurrency < self.workers:
+                    # Split per worker, the limit would otherwise be exceeded
+                    raise ProxyError(503, 'api_error',
+                                     f"Concurrency limit {config.max_concurrency} is below the proxy's {self.workers} "
+                                     f"worker processes; raise it or restart the proxy with fewer workers")
+                send.session = client_session(headers, fields, send.fingerprint)
+                send.priority = 'background' if found and model_tier(found[0]) == 'haiku' else 'interactive'
+            # Only a streamed response starts right away, so only those are held to the latency threshold
+            streamed = bool(config.fallbacks) and fields.get('stream', (False,))[0] is True
+            head_timeout = config.breaker_latency_ms / 1000 if streamed else None
+            if config.fallbacks:
+                exchange = await self._send_failover(config, routed_name, body_for, send, request.buffered,
+                                                     head_timeout, stuck and stuck[0])
+            else:
+                exchange = await self._send_to(config, routed_name, body_for, send, request.buffered)
+            if send.fingerprint and config.sticky:
+                self.affinity.record(send.fingerprint, routed_name, exchange.profile, exchange.upstream)
+            if trace is not None:
+                trace.update(profile=exchange.profile, status=exchange.status,
+                             head_ms=round((time.monotonic() - started) * 1000))
+            await self._relay(exchange, method, writer, keep_alive)
+            if trace is not None:
+                trace['latency_ms'] = round((time.monotonic() - started) * 1000)
+            return keep_alive
+
+        except StreamInterrupted:
+            self.errors += 1
+            if trace is not None:
+                trace['interrupted'] = True
+            return False
+        except ProxyError as e:
+            self.errors += 1
+            if trace is not None:
+                trace['status'] = e.status
+            await self._send_error(writer, e)
+            return False
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self.errors += 1
+            if trace is not None:
+                trace['status'] = 502
+            await self._send_error(writer, ProxyError(502, 'api_error', f"Upstream request failed: {e}"))
+            return False
+        finally:
+            self.active -= 1
+            if trace is not None:
+                self.recorder.write(config.record['path'], trace)
+
+    def _authorize(self, headers, config):
+        """Reject requests that do not carry the proxy token written to settings.json"""
+        if not config.token:
+            raise ProxyError(401, 'authentication_error', "Proxy token is not configured; run 'ezswitch apply proxy'")
+        presented = get_header(headers, 'x-api-key') or ''
+        authorization = get_header(headers, 'authorization') or ''
+        if authorization.lower().startswith('bearer '):
+            presented = authorization[7:].strip()
+        if not hmac.compare_digest(presented.encode('utf-8'), config.token.encode('utf-8')):
+            raise ProxyError(401, 'authentication_error', "Invalid proxy token")
+
+    async def _send(self, config, upstreams, body, send, head_timeout=None, sent=None):
+        """Send a request to upstreams (a key picked from a pool) and wait for its response head
+
+        send is an OutgoingRequest. With a concurrency limit this first waits
+        for a slot on the key; that wait is not the upstream's doing, so
+        head_timeout (asyncio.TimeoutError when exceeded) only starts once the
+        slot is held, which is also when the future sent is resolved. The
+        returned Exchange must be finished with _relay() or _close().
+        """
+        pooled = len(upstreams) > 1
+        if pooled:
+            upstream = self.key_pool.acquire(upstreams, config.key_strategy, send.fingerprint, send.prefer_key)
+        else:
+            upstream = upstreams[0]
+        exchange = Exchange(upstream, pooled)
+        try:
+            if config.max_concurrency:
+                # Not shared: each worker process gets an even share of the limit (at least 1, see _handle_request)
+                limit = config.max_concurrency // self.workers
+                await self.scheduler.acquire(upstream.name, limit, send.session, send.priority)
+                exchange.slot = upstream.name
+            if sent is not None and not sent.done():
+                sent.set_result(None)
+            exchanged = self._exchange(exchange, body, send)
+            return await (asyncio.wait_for(exchanged, head_timeout) if head_timeout else exchanged)
+        except BaseException:
+            # Also runs when a losing hedge attempt is cancelled
+            self._close(exchange)
+            raise
+
+    async def _exchange(self, exchange, body, send):
+        """Connect, send the request head and body, and read the response head into exchange
+
+        The server may close an idle keep-alive connection just as it is taken
+        from the pool. When that connection fails before any response arrived
+        and the body can be sent again (buffered whole, see REPLAY_BODY_LIMIT),
+        the request is retried once on a new connection.
+        """
+        upstream = exchange.upstream
+        exchange.connection = await self.connections.acquire(upstream)
+        try:
+            return await self._exchange_on(exchange, body, send)
+        except ConnectionError:
+            if not (exchange.connection.from_pool and exchange.status_line is None and body.buffered):
+                raise
+        self.connections.stale += 1
+        self.connections.release(upstream, exchange.connection, False)
+        exchange.connection = None
+        exchange.connection = await self.connections.open(upstream)
+        return await self._exchange_on(exchange, body, send)
+
+    async def _exchange_on(self, exchange, body, send):
+        """Send the request over exchange.connection and read its response head"""
+        upstream = exchange.upstream
+        upstream_reader, upstream_writer = exchange.connection.reader, exchange.connection.writer
+
+        # Request head: same headers, upstream host and credentials
+        forward_headers = [('Host', upstream.host_header)]
+        forward_headers += [(name, value) for name, value in send.headers
+                            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in CLIENT_ONLY_HEADERS]
+        forward_headers.append(('Authorization', f"Bearer {upstream.api_key}"))
+        if body.framing == 'length':
+            forward_headers.append(('Content-Length', str(body.length)))
+        elif body.framing == 'chunked':
+            forward_headers.append(('Transfer-Encoding', 'chunked'))
+        forward_headers.append(('Connection', 'keep-alive'))
+        upstream_writer.write(format_head(f"{send.method} {upstream.base_path}{send.target} HTTP/1.1",
+                                          forward_headers))
+        await body.relay(send.reader, upstream_writer)
+
+        # Response head, skipping interim 1xx responses
+        while True:
+            head = await read_head(upstream_reader)
+            if head is None:
+                raise ConnectionError("Upstream closed the connection without a response")
+            exchange.status_line, exchange.headers = head
+            exchange.status = int(exchange.status_line.split(' ', 2)[1])
+            if not 100 <= exchange.status < 200:
+                return exchange
+
+    def breaker(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers[name] = CircuitBreaker(shared=self.shared, name=name)
+        return breaker
+
+    async def _attempt(self, config, name, body, send, head_timeout=None, sent=None):
+        """_send to a stored profile and count the outcome on its circuit breaker
+
+        A response head that takes longer than head_timeout after the request
+        got its concurrency slot is given up on with a 504 and counts as a failure.
+        """
+        breaker = self.breaker(name)
+        try:
+            exchange = await self._send(config, config.targets[name], body, send, head_timeout, sent)
+        except asyncio.TimeoutError:
+            breaker.record(False, config.breaker_error_rate)
+            if not head_timeout:
+                raise
+            raise ProxyError(504, 'api_error', f"'{name}' did not start responding within {head_timeout:g}s")
+        except (OSError, asyncio.IncompleteReadError):
+            breaker.record(False, config.breaker_error_rate)
+            raise
+        except BaseException:
+            # Cancelled (a lost hedge race) or refused before sending (every pooled key throttled)
+            breaker.record(None, config.breaker_error_rate)
+            raise
+        breaker.record(exchange.status not in BREAKER_FAILURE_STATUSES, config.breaker_error_rate)
+        exchange.profile = name
+        return exchange
+
+    async def _send_to(self, config, name, body_for, send, replayable, head_timeout=None):
+        """Send a request to a stored profile, hedged when configured and the body can be resent"""
+        if config.hedge_upstream and config.hedge_upstream != name and replayable:
+            return await self._send_hedged(config, name, body_for(name), body_for(config.hedge_upstream),
+                                           send, head_timeout)
+        return await self._attempt(config, name, body_for(name), send, head_timeout)
+
+    async def _send_failover(self, config, name, body_for, send, replayable, head_timeout=None, prefer=None):
+        """Send to name, or down the fallback list when its circuit is open or it fails
+
+        A conversation last answered by prefer goes there first while its
+        circuit is closed. Profiles with an open circuit are skipped without a
+        connection attempt.
+        A body that could not be buffered is only ever sent once. When every
+        attempt fails, the last retryable answer (or error) is what the client gets.
+        """
+        fallback = failure = served = None
+        attempted = False
+        if prefer and self.breaker(prefer).state != 'closed':
+            prefer = None
+        for candidate in config.candidates(name, prefer):
+            if attempted and not replayable:
+                break
+            if not self.breaker(candidate).allow():
+                continue
+            attempted = True
+            try:
+                exchange = await self._send_to(config, candidate, body_for, send, replayable, head_timeout)
+            except (ProxyError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                failure = e
+                continue
+            except BaseException:
+                if fallback is not None:
+                    self._close(fallback)
+                raise
+            if fallback is not None:
+                self._close(fallback)
+            fallback, served = exchange, candidate
+            if exchange.status not in RETRYABLE_STATUSES:
+                break
+
+        if fallback is not None:
+            if served != name:
+                self.failovers += 1
+            return fallback
+        if failure is not None:
+            raise failure
+        # Every circuit is open
+        retry_after = max(1, int(min(self.breaker(candidate).stats()['retry_in']
+                                     for candidate in config.candidates(name)) + 0.999))
+        raise ProxyError(503, 'overloaded_error',
+                         f"Circuit open for {', '.join(config.candidates(name))}; retry in {retry_after}s",
+                         [('Retry-After', str(retry_after))])
+
+    async def _relay(self, exchange, method, client_writer, keep_alive):
+        """Stream an exchange's response to the client, then give back its connection and key"""
+        reusable = False
+        try:
+            status, response_headers = exchange.status, exchange.headers
+            if method == 'HEAD' or status in (204, 304):
+                framing, length = 'none', None
+            else:
+                framing, length = body_framing(response_headers, response=True)
+            rechunk = framing == 'eof' and keep_alive
+
+            out_headers = [(name, value) for name, value in response_headers
+                           if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length']
+            if framing == 'length':
+                out_headers.append(('Content-Length', str(length)))
+            elif framing == 'chunked' or rechunk:
+                out_headers.append(('Transfer-Encoding', 'chunked'))
+            out_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+            client_writer.write(format_head(f"HTTP/1.1 {exchange.status_line.split(' ', 1)[1]}", out_headers))
+            try:
+                await relay_body(exchange.connection.reader, client_writer, framing, length, rechunk=rechunk)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                raise StreamInterrupted(str(e)) from e
+
+            # Only a fully relayed, self-delimited response leaves the connection at a message boundary
+            reusable = (framing != 'eof' and exchange.status_line.startswith('HTTP/1.1 ')
+                        and 'close' not in (get_header(response_headers, 'connection') or '').lower())
+        finally:
+            self._close(exchange, reusable)
+
+    def _close(self, exchange, reusable=False):
+        """Give back an exchange's connection, scheduler slot and pooled key (once)"""
+        if exchange.connection is not None:
+            self.connections.release(exchange.upstream, exchange.connection, reusable)
+            exchange.connection = None
+        if exchange.slot is not None:
+            self.scheduler.release(exchange.slot)
+            exchange.slot = None
+        if exchange.pooled:
+            exchange.pooled = False
+            self.key_pool.release(exchange.upstream, exchange.status, exchange.headers)
+
+    def hedge_delay(self, config, name):
+        """Seconds to wait for name's response head before hedging: fixed, or the observed p95"""
+        if config.hedge_delay_ms:
+            return config.hedge_delay_ms / 1000
+        samples = self.head_latency.get(name)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95)]
+
+    async def _send_hedged(self, config, name, body, hedge_body, send, head_timeout=None):
+        """Race name against the hedge profile once name is slower than the hedge delay
+
+        The first usable response head wins; a retryable error (429, 5xx) only
+        wins if the other attempt fails too. The loser is cancelled or closed.
+        """
+        from collections import deque
+
+        stats = self.hedging.setdefault(name, {'requests': 0, 'hedged': 0, 'hedge_wins': 0})
+        stats['requests'] += 1
+        samples = self.head_latency.setdefault(name, deque(maxlen=HEDGE_WINDOW))
+        loop = asyncio.get_running_loop()
+        sent = loop.create_future()
+        primary = asyncio.ensure_future(self._attempt(config, name, body, send, head_timeout, sent))
+        hedge = None
+        winner = fallback = failure = None
+        pending = {primary}
+        try:
+            # A request queued for a concurrency slot is not slow upstream, so the delay starts once it is sent
+            await asyncio.wait({primary, sent}, return_when=asyncio.FIRST_COMPLETED)
+            started = loop.time()
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay(config, name))
+            # With failover, a hedge profile whose circuit is open is not raced
+            if pending and (not config.fallbacks or self.breaker(config.hedge_upstream).allow()):
+                stats['hedged'] += 1
+                hedge = asyncio.ensure_future(self._attempt(config, config.hedge_upstream, hedge_body, send,
+                                                            head_timeout))
+                pending.add(hedge)
+            while True:
+                for task in done:
+                    if task is primary:
+                        samples.append(loop.time() - started)
+                    if task.exception() is not None:
+                        failure = task.exception()
+                        continue
+                    exchange = task.result()
+                    if exchange.status in RETRYABLE_STATUSES and pending and fallback is None:
+                        fallback = exchange
+                    elif winner is None:
+                        winner = exchange
+                        if task is hedge and exchange.status not in RETRYABLE_STATUSES:
+                            stats['hedge_wins'] += 1
+                    else:
+                        self._close(exchange)
+                if winner is not None or not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            # The client went away mid-race: give back whatever already answered
+            for task in (primary, hedge):
+                if task is not None and task.done() and not task.cancelled() and task.exception() is None:
+                    self._close(task.result())
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+        if primary in pending:
+            # The primary took at least this long; counting it keeps the p95 from drifting down
+            samples.append(loop.time() - started)
+
+        if winner is None:
+            winner, fallback = fallback, None
+        if fallback is not None:
+            self._close(fallback)
+        if winner is None:
+            raise failure
+        return winner
+
+    def hedge_report(self, config):
+        """Hedge and win rates per routed profile for the health endpoint"""
+        profiles = {}
+        for name, stats in self.hedging.items():
+            profiles[name] = dict(stats, delay_ms=round(self.hedge_delay(config, name) * 1000),
+                                  hedge_rate=round(stats['hedged'] / stats['requests'], 3) if stats['requests'] else 0.0,
+                                  win_rate=round(stats['hedge_wins'] / stats['hedged'], 3) if stats['hedged'] else 0.0)
+        return {'upstream': config.hedge_upstream, 'profiles': profiles}
+
+    async def _send_response(self, writer, status, body, keep_alive, content_type='application/json', headers=()):
+        reason = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 429: 'Too Many Requests',
+                  431: 'Request Header Fields Too Large', 502: 'Bad Gateway',
+                  503: 'Service Unavailable', 504: 'Gateway Timeout'}.get(status, 'Error')
+        writer.write(format_head(f"HTTP/1.1 {status} {reason}", [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+            ('Connection', 'keep-alive' if keep_alive else 'close')
+        ] + list(headers)) + body)
+        await writer.drain()
+
+    async def _send_error(self, writer, error):
+        try:
+            await self._send_response(writer, error.status, error_body(error.error_type, str(error)), False,
+                                      headers=error.headers)
+        except ConnectionError:
+            pass
+
+def proxy_prewarm(port, token, host=core.PROXY_HOST, timeout=5.0):
+    """Ask a running proxy to connect to its (new) upstream now; returns the reply, or None"""
+    import http.client
+
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('POST', PREWARM_PATH, headers={'Authorization': f"Bearer {token}"})
+        response = connection.getresponse()
+        return json.loads(response.read())
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+    finally:
+        connection.close()
+
+def proxy_health(port=core.DEFAULT_PROXY_PORT, host=core.PROXY_HOST, timeout=1.0):
+    """Return the health reply of a proxy listening on port, or None if none answers"""
+    import http.client
+
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', HEALTH_PATH)
+        response = connection.getresponse()
+        if response.status != 200:
+            return None
+        return json.loads(response.read())
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+    finally:
+        connection.close()
+
+def run_workers(config_file=core.CONFIG_FILE, host=core.PROXY_HOST, port=core.DEFAULT_PROXY_PORT, workers=2):
+    """Serve from worker processes that share port through SO_REUSEPORT, until interrupted (POSIX only)
+
+    Raises OSError if a worker cannot listen, e.g. because another process
+    holds the port without SO_REUSEPORT.
+    """
+    import multiprocessing
+    import queue
+    import signal
+
+    shared = SharedDeadlines()  # mapped before forking, so every worker sees the same memory
+    context = multiprocessing.get_context('fork')
+    ready = context.Queue()
+    processes = [context.Process(target=_worker_main, args=(config_file, host, port, workers, shared, ready),
+                                 name=f"ezswitch-proxy-{index}", daemon=True)
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(signum=None, frame=None):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    previous_handler = signal.signal(signal.SIGTERM, stop)
+    try:
+        for _ in processes:
+            try:
+                error = ready.get(timeout=WORKER_START_TIMEOUT)
+            except queue.Empty:
+                raise OSError(f"Proxy workers did not start listening on port {port}")
+            if error:
+                raise OSError(error)
+        for process in processes:
+            process.join()
+    finally:
+        stop()
+        for process in processes:
+            process.join(timeout=5.0)
+        signal.signal(signal.SIGTERM, previous_handler)
+
+def _worker_main(config_file, host, port, workers, shared, ready):
+    """One run_workers process: serve until terminated, reporting whether listening worked"""
+    import signal
+
+    server = ProxyServer(config_file, host, port, workers=workers, shared=shared)
+    try:
+        server.start_in_thread()
+    except OSError as e:
+        ready.put(str(e) or "Cannot listen")
+        return
+    ready.put(None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,385 @@
+"""Incremental token and response-time accounting over Claude Code transcripts
+
+    ezswitch usage [--days N] [--json] [--projects-dir DIR] [--rebuild]
+
+Claude Code appends every API response, with its token usage, to JSONL
+transcripts under ~/.claude/projects, and those files grow to gigabytes.
+UsageIndex remembers each file's inode and the byte offset it has read up to,
+so a refresh costs one stat per file plus reading the bytes appended since
+the last refresh; a file whose inode changed or that shrank is read again.
+
+Each response is attributed to the EZ Switch profile that was active at its
+timestamp according to the switch history apply_profile keeps (see
+core.load_switch_history; 'unknown' before the first recorded switch) and
+added to totals per profile, model and local day in usage_index.json next to
+config.json. Response time is measured from the preceding user line (prompt
+or tool result) to the response's first line, and kept as a histogram with
+LATENCY_STEPS buckets per doubling so totals stay small and can be merged.
+
+When more than BACKFILL_BYTES are unread, e.g. on the first run over years of
+history, refresh hands over to backfill: transcripts are packed into shards
+of up to SHARD_BYTES, scanned from memory maps in a process pool, and each
+shard's partial totals and read positions are merged together into the
+index. The index is saved every BACKFILL_SAVE_INTERVAL seconds and when
+interrupted, so a backfill stopped with Ctrl+C resumes where it left off.
+"""
+import bisect
+import json
+import math
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+
+import ezswitch_core as core
+
+PROJECTS_DIR = core.CLAUDE_SETTINGS_DIR / "projects"
+INDEX_NAME = "usage_index.json"
+# Bumped when the index layout changes; an index of another version is rebuilt
+INDEX_VERSION = 1
+READ_BLOCK = 1024 * 1024
+BACKFILL_BYTES = 64 * 1024 * 1024
+SHARD_BYTES = 32 * 1024 * 1024
+BACKFILL_SAVE_INTERVAL = 2.0
+TOKEN_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+LATENCY_STEPS = 4
+UNKNOWN_PROFILE = 'unknown'
+# Claude Code writes these for locally generated messages (errors, interruptions) that used no tokens
+SYNTHETIC_MODEL = '<synthetic>'
+
+# Transcripts are compact JSON, so a line's kind can be told without parsing it.
+# User lines (often large tool results) are only searched for their timestamp.
+ASSISTANT_MARK = b'"type":"assistant"'
+USER_MARK = b'"type":"user"'
+TIMESTAMP = re.compile(rb'"timestamp":"([^"]+)"')
+
+def parse_timestamp(value):
+    """Epoch seconds of a transcript timestamp ('2025-06-01T12:34:56.789Z'), or None"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def attribution(history):
+    """Function from epoch seconds to the usage label of the profile active then"""
+    times = [t for t, _ in history]
+    labels = [label for _, label in history]
+
+    def profile_at(t):
+        index = bisect.bisect_right(times, t)
+        return labels[index - 1] if index else UNKNOWN_PROFILE
+    return profile_at
+
+def new_totals():
+    """Empty counters for one profile, model and day"""
+    return dict({field: 0 for field in TOKEN_FIELDS}, responses=0, latency={})
+
+def add_totals(into, other):
+    """Add the counters and response-time histogram of other to into"""
+    into['responses'] += other['responses']
+    for field in TOKEN_FIELDS:
+        into[field] += other[field]
+    for bucket, count in other['latency'].items():
+        into['latency'][bucket] = into['latency'].get(bucket, 0) + count
+
+def merge_usage(into, other):
+    """Add usage totals ({profile: {model: {day: totals}}}) of other to into"""
+    for label, models in other.items():
+        for model, days in models.items():
+            target = into.setdefault(label, {}).setdefault(model, {})
+            for day, totals in days.items():
+                add_totals(target.setdefault(day, new_totals()), totals)
+
+def latency_bucket(ms):
+    """Histogram bucket (a string, as stored in JSON) of a response time"""
+    return str(max(0, int(math.log2(max(ms, 1.0)) * LATENCY_STEPS)))
+
+def latency_percentile(histogram, fraction):
+    """Approximate response time in ms below which fraction of the histogram lies, or None"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in sorted(histogram, key=int):
+        seen += histogram[bucket]
+        if seen >= fraction * total:
+            break
+    return round(2 ** ((int(bucket) + 0.5) / LATENCY_STEPS))
+
+def scan_lines(lines, state, profile_at, usage):
+    """Add the responses among transcript lines to usage ({profile: {model: {day: totals}}})
+
+    state is the file's index entry: it carries the last counted message id
+    (a response is written as one line per content block, all with the same
+    id and usage) and the time of the last user line between calls.
+    """
+    for line in lines:
+        if ASSISTANT_MARK in line:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(entry, dict) or entry.get('type') != 'assistant':
+                continue
+            message = entry.get('message')
+            if not isinstance(message, dict):
+                continue
+            counts = message.get('usage')
+            message_id = message.get('id') or entry.get('requestId')
+            if not isinstance(counts, dict) or (message_id and message_id == state.get('last_message')):
+                continue
+            state['last_message'] = message_id
+            t = parse_timestamp(entry.get('timestamp'))
+            model = message.get('model') or SYNTHETIC_MODEL
+            if t is None or model == SYNTHETIC_MODEL:
+                continue
+            day = time.strftime('%Y-%m-%d', time.localtime(t))
+            totals = usage.setdefault(profile_at(t), {}).setdefault(model, {}).setdefault(day, new_totals())
+            totals['responses'] += 1
+            for field in TOKEN_FIELDS:
+                value = counts.get(field)
+                if isinstance(value, int):
+                    totals[field] += value
+            prompt_t = state.pop('prompt_t', None)
+            if prompt_t is not None and t >= prompt_t:
+                bucket = latency_bucket((t - prompt_t) * 1000)
+                totals['latency'][bucket] = totals['latency'].get(bucket, 0) + 1
+        elif USER_MARK in line:
+            match = TIMESTAMP.search(line)
+            t = parse_timestamp(match.group(1).decode('ascii', 'replace')) if match else None
+            if t is not None:
+                state['prompt_t'] = t
+
+def read_appended(path, state):
+    """Yield the complete lines of path past state['offset'], advancing the offset past each block
+
+    A last line without its newline is still being written and is left for the next refresh.
+    """
+    with open(path, 'rb') as f:
+        position = state['offset']
+        f.seek(position)
+        tail = b''
+        while True:
+            block = f.read(READ_BLOCK)
+            if not block:
+                return
+            position += len(block)
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop()
+            yield from lines
+            state['offset'] = position - len(tail)
+
+def mapped_lines(path, state):
+    """Like read_appended, but splits a memory-mapped file in place instead of copying it in blocks"""
+    import mmap
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        find = mapped.find
+        start = state['offset']
+        while True:
+            end = find(b'\n', start)
+            if end < 0:
+                return
+            yield mapped[start:end]
+            start = state['offset'] = end + 1
+
+def make_shards(pending, jobs):
+    """Pack pending (path, state, size) into lists of (path, state), largest files first
+
+    Shards are small enough that every worker gets several, so one big
+    transcript does not leave the others idle at the end.
+    """
+    total = sum(size - state['offset'] for _, state, size in pending)
+    limit = max(READ_BLOCK, min(SHARD_BYTES, total // (jobs * 4)))
+    shards, shard, shard_bytes = [], [], 0
+    for path, state, size in sorted(pending, key=lambda item: item[2] - item[1]['offset'], reverse=True):
+        shard.append((str(path), state))
+        shard_bytes += size - state['offset']
+        if shard_bytes >= limit:
+            shards.append(shard)
+            shard, shard_bytes = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+def scan_shard(shard, history):
+    """Backfill worker: scan a shard's transcripts into fresh totals
+
+    Returns ([(path, state, bytes read, error or None)], usage) for the parent to merge.
+    """
+    profile_at = attribution(history)
+    results, usage = [], {}
+    for path, state in shard:
+        offset, error = state['offset'], None
+        try:
+            scan_lines(mapped_lines(path, state), state, profile_at, usage)
+        except (OSError, ValueError) as e:  # ValueError: mapping a file that was just emptied
+            error = str(e)
+        results.append((path, state, state['offset'] - offset, error))
+    return results, usage
+
+def _ignore_interrupts():
+    """Pool initializer: Ctrl+C reaches the whole process group, but only the parent handles it"""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class UsageIndex:
+    """usage_index.json: per-transcript read positions and usage totals per profile, model and day"""
+    def __init__(self, path=core.CONFIG_DIR / INDEX_NAME):
+        self.path = Path(path)
+        self.files = {}  # transcript path -> {'inode', 'offset', 'last_message', 'prompt_t'}
+        self.usage = {}  # profile -> model -> day -> totals
+
+    def load(self):
+        """Load the index (a missing, unreadable or outdated one starts empty) and return self"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if isinstance(data, dict) and data.get('version') == INDEX_VERSION:
+            self.files = data.get('files') or {}
+            self.usage = data.get('usage') or {}
+        return self
+
+    def save(self):
+        """Write the index compactly with an atomic rename"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        core.atomic_write_json(self.path, {'version': INDEX_VERSION, 'files': self.files, 'usage': self.usage},
+                               indent=None, fsync=False)
+
+    def pending(self, projects_dir):
+        """(path, state, size) of transcripts with unread bytes; forgets transcripts that are gone"""
+        pending, seen = [], set()
+        for path in sorted(Path(projects_dir).rglob('*.jsonl')):
+            key = str(path)
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            seen.add(key)
+            state = self.files.get(key)
+            if state is None or state.get('inode') != stat.st_ino or stat.st_size < state.get('offset', 0):
+                # New, replaced or truncated: read from the start
+                state = self.files[key] = {'inode': stat.st_ino, 'offset': 0}
+            if stat.st_size > state['offset']:
+                pending.append((path, state, stat.st_size))
+        for key in set(self.files) - seen:
+            del self.files[key]
+        return pending
+
+    def refresh(self, projects_dir=PROJECTS_DIR, history=(), jobs=1):
+        """Read what was appended to every transcript since the last refresh; returns counters
+
+        With jobs > 1 and more than BACKFILL_BYTES unread, the transcripts are
+        scanned by backfill in that many processes.
+        """
+        start = time.perf_counter()
+        pending = self.pending(projects_dir)
+        if jobs > 1 and sum(size - state['offset'] for _, state, size in pending) > BACKFILL_BYTES:
+            return self.backfill(pending, history, jobs, start)
+        profile_at = attribution(history)
+        stats = {'files': 0, 'updated': 0, 'bytes': 0, 'jobs': 1}
+        for path, state, _ in pending:
+            offset = state['offset']
+            try:
+                scan_lines(read_appended(path, state), state, profile_at, self.usage)
+            except OSError as e:
+                print(f"Warning: Could not read transcript {path}: {e}")
+            stats['bytes'] += state['offset'] - offset
+            stats['updated'] += 1
+        stats['files'] = len(self.files)
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        return stats
+
+    def backfill(self, pending, history, jobs, start):
+        """Scan pending transcripts in a pool of jobs processes, merging and saving as shards finish
+
+        On Ctrl+C the merged shards are saved and KeyboardInterrupt is raised;
+        the next refresh reads the remaining transcripts.
+        """
+        import functools
+        import multiprocessing
+        import signal
+        import threading
+
+        shards = make_shards(pending, jobs)
+        stats = {'files': 0, 'updated': 0, 'bytes': 0, 'jobs': min(jobs, len(shards))}
+        # Defer Ctrl+C until the current shard is merged, so the saved index never counts a line twice
+        interrupted = []
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+        pool = multiprocessing.Pool(stats['jobs'], initializer=_ignore_interrupts)
+        try:
+            results = pool.imap_unordered(functools.partial(scan_shard, history=list(history)), shards)
+            saved, merged = time.perf_counter(), 0
+            while merged < len(shards) and not interrupted:
+                try:
+                    shard_results, usage = results.next(timeout=0.2)
+                except multiprocessing.TimeoutError:
+                    continue
+                merged += 1
+                merge_usage(self.usage, usage)
+                for path, state, read, error in shard_results:
+                    self.files[path] = state
+                    stats['bytes'] += read
+                    stats['updated'] += 1
+                    if error:
+                        print(f"Warning: Could not read transcript {path}: {error}")
+                if time.perf_counter() - saved >= BACKFILL_SAVE_INTERVAL:
+                    self.save()
+                    saved = time.perf_counter()
+        finally:
+            pool.terminate()
+            pool.join()
+            if previous_handler is not None:
+                signal.signal(signal.SIGINT, previous_handler)
+        if interrupted:
+            self.save()
+            raise KeyboardInterrupt
+        stats['files'] = len(self.files)
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        return stats
+
+    def report(self, since=None):
+        """{profile: {'total': summary, 'models': {model: summary}}} for days on or after since ('YYYY-MM-DD')"""
+        report = {}
+        for label, models in sorted(self.usage.items()):
+            total, per_model = new_totals(), {}
+            for model, days in sorted(models.items()):
+                totals = new_totals()
+                for day, day_totals in days.items():
+                    if since is None or day >= since:
+                        add_totals(totals, day_totals)
+                if totals['responses']:
+                    add_totals(total, totals)
+                    per_model[model] = summarize(totals)
+            if total['responses']:
+                report[label] = {'total': summarize(total), 'models': per_model}
+        return report
+
+def summarize(totals):
+    """Token counters plus p50/p95 response time (ms) of one set of totals"""
+    summary = {field: totals[field] for field in ('responses',) + TOKEN_FIELDS}
+    summary.update(response_p50_ms=latency_percentile(totals['latency'], 0.5),
+                   response_p95_ms=latency_percentile(totals['latency'], 0.95))
+    return summary
+
+def format_count(value):
+    """Compact token count: 950, 12.3k, 4.5M"""
+    for limit, suffix in ((1e9, 'B'), (1e6, 'M'), (1e3, 'k')):
+        if value >= limit:
+            return f"{value / limit:.1f}{suffix}"
+    return str(value)
+
+def format_summary(summary):
+    """One line of a usage report"""
+    line = (f"{summary['responses']} responses, {format_count(summary['input_tokens'])} input "
+            f"(+{format_count(summary['cache_read_input_tokens'])} cache read, "
+            f"{format_count(summary['cache_creation_input_tokens'])} cache write), "
+            f"{format_count(summary['output_tokens'])} output")
+    if summary['response_p50_ms'] is not None:
+        line += (f", response p50 {summary['response_p50_ms'] / 1000:.1f} s, "
+                 f"p95 {summary['response_p95_ms'] / 1000:.1f} s")
+    return line
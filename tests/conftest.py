@@ -0,0 +1,21 @@
+"""Shared fixtures: a throwaway config directory and settings.json for each test"""
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+import ezswitch_core as core
+
+@pytest.fixture
+def settings_file(tmp_path):
+    """Path of a settings.json that does not exist yet"""
+    return tmp_path / "claude" / "settings.json"
+
+@pytest.fixture
+def store(tmp_path):
+    """Empty ConfigStore backed by a temporary config.json"""
+    config_file = tmp_path / "config" / "config.json"
+    return core.ConfigStore(config_file, legacy_path=config_file)
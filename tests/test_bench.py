@@ -0,0 +1,77 @@
+"""ezswitch_bench: mix parsing, latency percentiles and trace replay"""
+import asyncio
+import json
+
+import pytest
+
+import ezswitch_bench as bench
+
+def test_parse_mix_weights():
+    assert bench.parse_mix('sonnet:3,haiku:1') == [('sonnet', 3.0), ('haiku', 1.0)]
+    assert bench.parse_mix(' opus , haiku:0.5 ') == [('opus', 1.0), ('haiku', 0.5)]
+
+def test_parse_mix_keeps_colons_that_belong_to_the_model_name():
+    assert bench.parse_mix('glm-4.5:air') == [('glm-4.5:air', 1.0)]
+    assert bench.parse_mix('glm-4.5:air:2') == [('glm-4.5:air', 2.0)]
+
+@pytest.mark.parametrize('spec', ['', 'sonnet,', ':2', 'sonnet:0', 'haiku:-1'])
+def test_parse_mix_rejects_bad_entries(spec):
+    with pytest.raises(ValueError, match="Invalid mix entry"):
+        bench.parse_mix(spec)
+
+def test_percentiles_of_no_samples():
+    assert bench.percentiles([]) is None
+
+def test_percentiles_of_one_sample():
+    assert bench.percentiles([12.34]) == {'p50': 12.3, 'p95': 12.3, 'p99': 12.3}
+
+def test_percentiles_use_the_nearest_rank():
+    assert bench.percentiles(list(range(100, 0, -1))) == {'p50': 50, 'p95': 95, 'p99': 99}
+    assert bench.percentiles([1, 2, 3]) == {'p50': 2, 'p95': 3, 'p99': 3}
+
+def write_trace(path, entries):
+    path.write_text(''.join(json.dumps(entry) + '\n' for entry in entries) + '{"t": 9, "cut short')
+    return path
+
+def test_load_trace_orders_entries_and_skips_token_counting(tmp_path):
+    trace = write_trace(tmp_path / "trace.jsonl", [
+        {'t': 2.0, 'target': '/v1/messages?beta=true'},
+        {'t': 1.0, 'target': '/v1/messages/count_tokens'},
+        {'t': 1.5, 'target': '/v1/messages'},
+        {'target': '/v1/messages'}])
+    assert [entry['t'] for entry in bench.load_trace(trace)] == [1.5, 2.0]
+    with pytest.raises(ValueError, match="No recorded requests"):
+        bench.load_trace(write_trace(tmp_path / "counts.jsonl", [{'t': 1.0, 'target': '/v1/messages/count_tokens'}]))
+
+def test_replay_resends_a_recorded_body_with_the_model_mapped():
+    body = json.dumps({'model': 'claude-haiku-4-5', 'max_tokens': 99, 'system': 'be brief',
+                       'messages': [{'role': 'user', 'content': 'hi'}]})
+    entry = {'t': 1.0, 'target': '/v1/messages?beta=true', 'model': 'claude-haiku-4-5', 'tier': 'haiku', 'body': body}
+    model, target, sent = bench.replay_request(entry, {'haiku': 'glm-4.5-air'}, 1)
+    assert (model, target) == ('glm-4.5-air', '/v1/messages?beta=true')
+    assert json.loads(sent) == dict(json.loads(body), model='glm-4.5-air')
+
+def test_replay_builds_a_synthetic_body_of_the_recorded_shape():
+    entry = {'t': 1.0, 'model': 'claude-sonnet-4-5', 'request_bytes': 20000, 'max_tokens': 123, 'stream': False}
+    model, target, sent = bench.replay_request(entry, {}, 7)
+    request = json.loads(sent)
+    assert (model, target) == ('claude-sonnet-4-5', '/v1/messages')
+    assert (request['model'], request['max_tokens'], request['stream']) == ('claude-sonnet-4-5', 123, False)
+    assert len(sent) == pytest.approx(20000, rel=0.05)
+    assert json.loads(bench.replay_request({'t': 1.0}, {}, 8)[2])['stream'] is True
+
+def test_replay_keeps_arrival_offsets_divided_by_speed(tmp_path):
+    trace = write_trace(tmp_path / "trace.jsonl", [{'t': 100.0 + offset} for offset in (0.0, 0.4, 1.2)])
+    upstream = bench.Upstream('mock', "http://127.0.0.1:9", "key")
+    generator = bench.LoadGenerator(upstream, {}, [('sonnet', 1)], trace=trace, speed=4)
+    sent = []
+
+    async def replay_one(index, entry):
+        sent.append(asyncio.get_running_loop().time())
+    generator._replay_one = replay_one
+
+    async def replay():
+        await generator._replay(asyncio.get_running_loop().time())
+    asyncio.run(replay())
+    offsets = [t - sent[0] for t in sent]
+    assert offsets == pytest.approx([0.0, 0.1, 0.3], abs=0.05)
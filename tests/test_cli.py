@@ -0,0 +1,30 @@
+"""ezswitch_cli: argument handling that does not need a resident instance"""
+import io
+import json
+
+import ezswitch_cli
+
+def run(tmp_path, *argv):
+    return ezswitch_cli.main(["--settings-file", str(tmp_path / "settings.json"),
+                              "--config-dir", str(tmp_path / "config"), *argv])
+
+def settings_env(tmp_path):
+    return json.loads((tmp_path / "settings.json").read_text())['env']
+
+def test_api_key_from_stdin_is_never_forwarded(tmp_path, monkeypatch):
+    forwarded = []
+    monkeypatch.setattr(ezswitch_cli, "forward_to_resident", lambda *args: forwarded.append(args))
+    monkeypatch.setattr("sys.stdin", io.StringIO("sk-ant-from-stdin\n"))
+    assert run(tmp_path, "apply", "api", "--key", "-") == 0
+    assert forwarded == []
+    assert settings_env(tmp_path)['ANTHROPIC_AUTH_TOKEN'] == "sk-ant-from-stdin"
+
+def test_custom_key_from_environment(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(ezswitch_cli.API_KEY_ENV, "env-key")
+    assert run(tmp_path, "--no-resident", "apply", "custom", "--url", "https://example.com/anthropic") == 0
+    assert settings_env(tmp_path)['ANTHROPIC_AUTH_TOKEN'] == "env-key"
+    assert "Warning" not in capsys.readouterr().err
+
+def test_api_key_on_argv_warns(tmp_path, capsys):
+    assert run(tmp_path, "--no-resident", "apply", "api", "--key", "sk-ant-argv") == 0
+    assert "visible to other processes" in capsys.readouterr().err
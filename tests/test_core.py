@@ -0,0 +1,68 @@
+"""ezswitch_core: settings cache, atomic writes and profile detection"""
+import json
+
+import ezswitch_core as core
+
+def test_cached_settings_are_deep_copies(settings_file):
+    settings_file.parent.mkdir(parents=True)
+    settings_file.write_text(json.dumps({'permissions': {'allow': ['Read']}, 'hooks': {'Stop': []}, 'env': {}}))
+    settings = core.read_claude_settings(settings_file)
+    settings['permissions']['allow'].append('Bash')
+    settings['hooks']['Stop'].append({'command': 'true'})
+    again = core.read_claude_settings(settings_file)
+    assert again['permissions'] == {'allow': ['Read']}
+    assert again['hooks'] == {'Stop': []}
+
+def test_atomic_write_follows_symlink_and_keeps_mode(tmp_path):
+    target = tmp_path / "dotfiles" / "settings.json"
+    target.parent.mkdir()
+    target.write_text('{}')
+    target.chmod(0o644)
+    link = tmp_path / "settings.json"
+    link.symlink_to(target)
+    core.atomic_write_json(link, {'env': {'A': '1'}})
+    assert link.is_symlink()
+    assert json.loads(target.read_text()) == {'env': {'A': '1'}}
+    assert target.stat().st_mode & 0o777 == 0o644
+
+def test_config_store_save_keeps_changes_from_other_processes(store):
+    store.update(custom_url="https://a.example", zai_keys={'work': 'k1'})
+    store.save()
+    gui = core.ConfigStore(store.path, legacy_path=store.path).load()
+    cli = core.ConfigStore(store.path, legacy_path=store.path).load()
+    live_keys = gui.zai_keys
+
+    cli.update(custom_url="https://b.example", proxy_upstream="zai")
+    cli.zai_keys['home'] = 'k2'
+    cli.save()
+    gui.update(claude_key="sk-ant-gui")
+    gui.save()
+
+    saved = json.loads(store.path.read_text())
+    assert saved['custom_url'] == "https://b.example"
+    assert saved['proxy_upstream'] == "zai"
+    assert saved['claude_key'] == "sk-ant-gui"
+    assert saved['zai_keys'] == {'work': 'k1', 'home': 'k2'}
+    assert gui.zai_keys is live_keys and live_keys == saved['zai_keys']
+
+def test_config_store_removal_and_refresh(store):
+    store.update(custom_url="https://a.example", custom_key="key")
+    store.save()
+    other = core.ConfigStore(store.path, legacy_path=store.path).load()
+    store.update(custom_key=None)
+    store.save()
+    other.update(claude_mode="api")
+    assert other.refresh().get('custom_key') is None
+    assert other.get('claude_mode') == "api"
+    other.save()
+    assert 'custom_key' not in json.loads(store.path.read_text())
+
+def test_only_the_configured_proxy_is_detected_as_proxy(store):
+    profile = core.proxy_profile(store, 'custom', 18787)
+    profile.remember(store)
+    assert core.detect_profile(profile.env(), store) == 'proxy'
+    mock = {'ANTHROPIC_BASE_URL': "http://127.0.0.1:18790", 'ANTHROPIC_AUTH_TOKEN': "any-key"}
+    assert core.detect_profile(mock, store) == 'custom'
+    wrong_port = dict(profile.env(), ANTHROPIC_BASE_URL=core.proxy_base_url(18788))
+    assert core.detect_profile(wrong_port, store) == 'custom'
+    assert core.describe_status({'env': mock}, store)[1].startswith("✓ Currently using Custom Base URL")
@@ -0,0 +1,64 @@
+"""ezswitch_ipc and CLI forwarding to a resident instance"""
+import sys
+import threading
+
+import pytest
+
+import ezswitch_cli
+import ezswitch_ipc
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="uses the Unix socket transport")
+
+@pytest.fixture
+def resident(tmp_path):
+    """Start a ResidentServer whose handler is set by the test"""
+    servers = []
+
+    def start(handler):
+        server = ezswitch_ipc.ResidentServer(handler, tmp_path)
+        assert server.start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+def test_request_round_trip(tmp_path, resident):
+    resident(lambda request: {'ok': True, 'echo': request['argv']})
+    reply = ezswitch_ipc.send_request({'command': 'cli', 'argv': ['status']}, tmp_path)
+    assert reply == {'ok': True, 'echo': ['status']}
+
+def test_no_resident_returns_none(tmp_path):
+    assert ezswitch_ipc.send_request({'command': 'cli', 'argv': []}, tmp_path) is None
+
+def test_sent_request_without_reply_raises_when_at_most_once(tmp_path, resident):
+    release = threading.Event()
+    resident(lambda request: release.wait(5) and {'ok': True})
+    try:
+        assert ezswitch_ipc.send_request({'command': 'cli', 'argv': []}, tmp_path, timeout=0.2) is None
+        with pytest.raises(TimeoutError):
+            ezswitch_ipc.send_request({'command': 'cli', 'argv': []}, tmp_path, timeout=0.2, at_most_once=True)
+    finally:
+        release.set()
+
+def test_forwarded_command_is_not_rerun_locally_after_timeout(tmp_path, monkeypatch, capsys):
+    def no_reply(*args, **kwargs):
+        raise TimeoutError("No reply from the resident instance")
+    monkeypatch.setattr(ezswitch_ipc, "send_request", no_reply)
+    settings_file = tmp_path / "settings.json"
+    exit_code = ezswitch_cli.main(["--settings-file", str(settings_file), "--config-dir", str(tmp_path),
+                                   "apply", "subscription"])
+    assert exit_code == 1
+    assert not settings_file.exists()
+    assert "No reply" in capsys.readouterr().err
+
+def test_forwarded_command_runs_in_resident(tmp_path, monkeypatch, resident, capsys):
+    resident(ezswitch_cli.handle_request)
+    monkeypatch.chdir(tmp_path)
+    exit_code = ezswitch_cli.main(["--settings-file", "settings.json", "--config-dir", str(tmp_path),
+                                   "apply", "custom", "--url", "https://example.com/anthropic"])
+    assert exit_code == 1  # no key saved: reported by the resident, not run again locally
+    exit_code = ezswitch_cli.main(["--settings-file", "settings.json", "--config-dir", str(tmp_path),
+                                   "apply", "subscription"])
+    assert exit_code == 0
+    assert "Applied Claude Subscription" in capsys.readouterr().out
@@ -0,0 +1,73 @@
+"""ezswitch_mock: latency specs, fault injection and repeatable runs"""
+import http.client
+import json
+import random
+import statistics
+
+import pytest
+
+import ezswitch_mock
+
+def test_fixed_latency():
+    sample = ezswitch_mock.parse_latency('300')
+    assert sample(random.Random(1)) == pytest.approx(0.3)
+
+def test_uniform_latency_stays_in_range():
+    sample = ezswitch_mock.parse_latency('100-400')
+    rng = random.Random(1)
+    samples = [sample(rng) for _ in range(500)]
+    assert 0.1 <= min(samples) < 0.15
+    assert 0.35 < max(samples) <= 0.4
+
+def test_lognormal_latency_has_the_given_median():
+    rng = random.Random(1)
+    sample = ezswitch_mock.parse_latency('lognormal:300:0.5')
+    assert statistics.median(sample(rng) for _ in range(2000)) == pytest.approx(0.3, rel=0.1)
+    assert ezswitch_mock.parse_latency('lognormal:300:0')(rng) == pytest.approx(0.3)
+    # The default sigma spreads samples
+    sample = ezswitch_mock.parse_latency('lognormal:300')
+    assert len({sample(rng) for _ in range(10)}) == 10
+
+@pytest.mark.parametrize('spec', ['', 'fast', '-5', '400-100', '100-', 'lognormal:', 'lognormal:0',
+                                  'lognormal:300:-1', 'lognormal:300:x', 'normal:300'])
+def test_bad_latency_specs_are_rejected(spec):
+    with pytest.raises(ValueError, match="Invalid latency"):
+        ezswitch_mock.parse_latency(spec)
+
+@pytest.mark.parametrize('options', [{'errors': 1.5}, {'rate_limit': 0.6, 'errors': 0.3, 'resets': 0.2},
+                                     {'error_status': 429}, {'tokens_per_second': -1}, {'output_tokens': 0}])
+def test_bad_options_are_rejected(options):
+    with pytest.raises(ValueError):
+        ezswitch_mock.MockServer(port=0, **options)
+
+def outcomes(server, count):
+    """Status of count requests sent one per connection, 'reset' for dropped connections"""
+    results = []
+    for index in range(count):
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=10)
+        body = json.dumps({'model': 'mock', 'max_tokens': 4, 'messages': [{'role': 'user', 'content': str(index)}]})
+        try:
+            connection.request('POST', ezswitch_mock.MESSAGES_PATH, body, {'x-api-key': 'test'})
+            response = connection.getresponse()
+            response.read()
+            results.append(response.status)
+        except (ConnectionError, http.client.HTTPException):
+            results.append('reset')
+        finally:
+            connection.close()
+    return results
+
+def test_seeded_faults_repeat():
+    options = {'rate_limit': 0.25, 'errors': 0.25, 'error_status': 503, 'resets': 0.25, 'seed': 7}
+    runs = []
+    for _ in range(2):
+        server = ezswitch_mock.MockServer(port=0, **options).start_in_thread()
+        try:
+            runs.append(outcomes(server, 40))
+            counts = server.counts
+        finally:
+            server.stop()
+    assert runs[0] == runs[1]
+    assert set(runs[0]) == {200, 429, 503, 'reset'}
+    assert counts == {'requests': 40, 'rate_limited': runs[0].count(429), 'errors': runs[0].count(503),
+                      'resets': runs[0].count('reset')}
@@ -0,0 +1,625 @@
+"""ezswitch_proxy: scheduling, failover and key selection, exercised against ezswitch_mock"""
+import asyncio
+import email.utils
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+import ezswitch_core as core
+import ezswitch_mock
+import ezswitch_proxy
+
+TOKEN = "test-proxy-token"
+
+@pytest.fixture
+def mock():
+    """Start MockServer(**options) on a free port; stopped after the test"""
+    servers = []
+
+    def start(**options):
+        server = ezswitch_mock.MockServer(port=0, **options).start_in_thread()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def proxy(store):
+    """Save store's values plus the proxy token and start a ProxyServer on a free port"""
+    servers = []
+
+    def start(**values):
+        store.update(proxy_token=TOKEN, **values)
+        store.save()
+        server = ezswitch_proxy.ProxyServer(store.path, port=0).start_in_thread()
+        server.port = server._server.sockets[0].getsockname()[1]
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+def post(port, model="claude-sonnet-4-5", stream=True, messages=None, headers=None):
+    """Send one Messages API request through the proxy; returns (status, body)"""
+    body = json.dumps({'model': model, 'max_tokens': 16, 'stream': stream,
+                       'messages': messages or [{'role': 'user', 'content': 'hello'}]})
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=15)
+    try:
+        connection.request('POST', '/v1/messages', body, dict({'Content-Type': 'application/json',
+                                                               'Authorization': f"Bearer {TOKEN}"}, **(headers or {})))
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def conversation(text):
+    """Messages of a new conversation, so failover affinity does not tie it to an earlier one"""
+    return [{'role': 'user', 'content': text}]
+
+def post_concurrently(port, count, **options):
+    """Send count requests at once; returns their statuses"""
+    statuses = [None] * count
+
+    def send(index):
+        statuses[index] = post(port, **options)[0]
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+def received_headers(upstream):
+    """Header lists of the requests a MockServer answers from now on"""
+    received = []
+    answer = upstream._answer
+
+    async def recording(method, target, headers, *args):
+        received.append(headers)
+        return await answer(method, target, headers, *args)
+    upstream._answer = recording
+    return received
+
+def test_wrong_proxy_token_is_rejected(mock, proxy):
+    upstream = mock()
+    server = proxy(custom_url=f"http://127.0.0.1:{upstream.port}", custom_key="custom-key", proxy_upstream='custom')
+    for headers in ({'Authorization': "Bearer wrong-token"}, {'Authorization': "", 'x-api-key': "wrong-token"}):
+        status, body = post(server.port, headers=headers)
+        assert status == 401
+        assert json.loads(body)['error']['type'] == 'authentication_error'
+    assert post(server.port, headers={'Authorization': "", 'x-api-key': TOKEN})[0] == 200
+    assert upstream.counts['requests'] == 1
+
+def test_proxy_token_is_replaced_by_the_upstream_key(mock, proxy):
+    upstream = mock()
+    received = received_headers(upstream)
+    server = proxy(custom_url=f"http://127.0.0.1:{upstream.port}", custom_key="custom-key", proxy_upstream='custom')
+    assert post(server.port)[0] == 200
+    headers = {name.lower(): value for name, value in received[0]}
+    assert headers['authorization'] == "Bearer custom-key"
+    assert 'x-api-key' not in headers
+    assert TOKEN not in json.dumps(received)
+
+def test_switching_the_upstream_applies_to_the_next_request(mock, proxy, store, monkeypatch):
+    custom, api = mock(), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{api.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{custom.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom')
+    assert post(server.port)[0] == 200
+    # As 'ezswitch apply proxy --upstream api' would from another process, with the session left open
+    other = core.ConfigStore(store.path, legacy_path=store.path).load()
+    other.update(proxy_upstream='api')
+    other.save()
+    assert post(server.port)[0] == 200
+    assert (custom.counts['requests'], api.counts['requests']) == (1, 1)
+    assert ezswitch_proxy.proxy_health(server.port)['upstream'] == 'api'
+
+def test_cancelled_waiter_does_not_leak_its_slot():
+    async def scenario():
+        scheduler = ezswitch_proxy.Scheduler()
+        await scheduler.acquire('key', 1, 'a', 'interactive')
+        first, second = (asyncio.ensure_future(scheduler.acquire('key', 1, session, 'interactive'))
+                         for session in ('b', 'c'))
+        await asyncio.sleep(0)
+        # Cancelling marks the waiter's future cancelled at once, but its cleanup only runs later
+        first.cancel()
+        scheduler.release('key')
+        await asyncio.sleep(0)
+        assert first.cancelled()
+        await asyncio.wait_for(second, 1)
+        assert scheduler.stats()['key']['active'] == 1
+        assert scheduler.stats()['key']['waiting'] == 0
+        scheduler.release('key')
+        assert scheduler.stats()['key']['active'] == 0
+    asyncio.run(scenario())
+
+def test_waiter_cancelled_while_queued_leaves_the_queue():
+    async def scenario():
+        scheduler = ezswitch_proxy.Scheduler()
+        await scheduler.acquire('key', 1, 'a', 'interactive')
+        waiter = asyncio.ensure_future(scheduler.acquire('key', 1, 'b', 'background'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.stats()['key']['waiting'] == 0
+        scheduler.release('key')
+        assert scheduler.stats()['key']['active'] == 0
+    asyncio.run(scenario())
+
+class Collector:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    async def drain(self):
+        pass
+
+def test_rewritten_body_shares_the_buffer_and_relays_intact():
+    async def scenario():
+        original = b'{"model":"claude-sonnet-4-5","max_tokens":8,"messages":[]}'
+        reader = asyncio.StreamReader()
+        reader.feed_data(original + b'TAIL')
+        reader.feed_eof()
+        request = ezswitch_proxy.RequestBody('length', len(original) + 4)
+        await request.buffer_prefix(reader, len(original))
+        start = original.index(b'"claude')
+        end = original.index(b'",') + 1
+        body = request.replaced(start, end, b'"glm-4.6"')
+        assert all(part.obj is request.prefix for part in body.parts if isinstance(part, memoryview))
+        writer = Collector()
+        await body.relay(reader, writer)
+        sent = b''.join(writer.writes)
+        assert sent == original.replace(b'claude-sonnet-4-5', b'glm-4.6') + b'TAIL'
+        assert len(sent) == body.length
+    asyncio.run(scenario())
+
+def test_breaker_opens_at_the_error_rate_and_probes_once():
+    now = [0.0]
+    breaker = ezswitch_proxy.CircuitBreaker(clock=lambda: now[0])
+    for _ in range(ezswitch_proxy.BREAKER_MIN_REQUESTS - 1):
+        breaker.record(False, 0.5)
+    # Too few outcomes to judge yet
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record(False, 0.5)
+    assert breaker.state == 'open' and not breaker.allow()
+    now[0] += ezswitch_proxy.BREAKER_OPEN_SECONDS
+    assert breaker.allow()
+    assert breaker.state == 'half-open' and not breaker.allow()
+    breaker.record(False, 0.5)
+    assert breaker.state == 'open'
+    assert breaker.open_seconds == 2 * ezswitch_proxy.BREAKER_OPEN_SECONDS
+    now[0] += breaker.open_seconds
+    assert breaker.allow()
+    breaker.record(True, 0.5)
+    assert breaker.state == 'closed'
+    assert breaker.open_seconds == ezswitch_proxy.BREAKER_OPEN_SECONDS
+
+def test_breaker_stays_closed_below_the_error_rate():
+    breaker = ezswitch_proxy.CircuitBreaker()
+    for ok in (True, False, True, False, True, True):
+        breaker.record(ok, 0.5)
+    assert breaker.state == 'closed'
+    assert breaker.stats()['failure_rate'] == round(2 / 6, 3)
+
+def test_errors_fail_over_and_open_the_circuit(mock, proxy, monkeypatch):
+    primary, fallback = mock(errors=1.0), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{fallback.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_failover={'upstreams': ['api']})
+    for index in range(ezswitch_proxy.BREAKER_MIN_REQUESTS):
+        assert post(server.port, messages=conversation(f"request {index}"))[0] == 200
+    assert primary.counts['requests'] == ezswitch_proxy.BREAKER_MIN_REQUESTS
+    # The open circuit sends the next request straight to the fallback
+    assert post(server.port, messages=conversation("after"))[0] == 200
+    assert primary.counts['requests'] == ezswitch_proxy.BREAKER_MIN_REQUESTS
+    assert fallback.counts['requests'] == ezswitch_proxy.BREAKER_MIN_REQUESTS + 1
+    failover = ezswitch_proxy.proxy_health(server.port)['failover']
+    assert failover['failovers'] == ezswitch_proxy.BREAKER_MIN_REQUESTS + 1
+    assert failover['breakers']['custom']['state'] == 'open'
+    assert failover['breakers']['api']['state'] == 'closed'
+
+def test_slow_stream_start_fails_over(mock, proxy, monkeypatch):
+    primary, fallback = mock(latency='500'), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{fallback.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_failover={'upstreams': ['api'], 'latency_ms': 100})
+    assert post(server.port, messages=conversation("streamed"))[0] == 200
+    assert fallback.counts['requests'] == 1
+    # Non-streamed responses only start once complete, so they are not held to the threshold
+    assert post(server.port, stream=False, messages=conversation("whole"))[0] == 200
+    assert fallback.counts['requests'] == 1
+    breakers = ezswitch_proxy.proxy_health(server.port)['failover']['breakers']
+    assert breakers['custom']['samples'] == 2
+    assert breakers['custom']['failure_rate'] == 0.5
+
+def test_retry_after_seconds_and_http_dates():
+    assert ezswitch_proxy.retry_after_seconds('12') == 12
+    assert ezswitch_proxy.retry_after_seconds('-5') == 0
+    assert ezswitch_proxy.retry_after_seconds('99999') == ezswitch_proxy.MAX_THROTTLE_SECONDS
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert ezswitch_proxy.retry_after_seconds(date) == pytest.approx(60, abs=2)
+    for junk in ('soon', None, ''):
+        assert ezswitch_proxy.retry_after_seconds(junk) == ezswitch_proxy.DEFAULT_THROTTLE_SECONDS == 30
+
+def test_key_pool_strategies_spread_requests():
+    pool = ezswitch_proxy.KeyPool()
+    upstreams = [ezswitch_proxy.Upstream(f"zai:{name}", "https://example.test", name, name) for name in ('a', 'b')]
+    rotated = [pool.acquire(upstreams, 'round-robin').key_name for _ in range(4)]
+    assert rotated in (['a', 'b', 'a', 'b'], ['b', 'a', 'b', 'a'])
+    pool = ezswitch_proxy.KeyPool()
+    busy = pool.acquire(upstreams, 'least-outstanding')
+    assert pool.acquire(upstreams, 'least-outstanding') is not busy
+    pool.release(busy)
+    assert pool.acquire(upstreams, 'least-outstanding') is busy
+
+def test_every_key_benched_answers_with_the_shortest_wait():
+    now = [0.0]
+    pool = ezswitch_proxy.KeyPool(clock=lambda: now[0])
+    upstreams = [ezswitch_proxy.Upstream(f"zai:{name}", "https://example.test", name, name) for name in ('a', 'b')]
+    for upstream, wait in zip(upstreams, ('40', '10')):
+        pool.acquire([upstream], 'round-robin')
+        pool.release(upstream, 429, [('Retry-After', wait)])
+    now[0] += 2.5
+    with pytest.raises(ezswitch_proxy.ProxyError) as raised:
+        pool.acquire(upstreams, 'round-robin')
+    assert raised.value.status == 429
+    assert raised.value.headers == [('Retry-After', '8')]
+    now[0] += 7.5
+    assert pool.acquire(upstreams, 'round-robin').key_name == 'b'
+
+def test_pooled_keys_rotate_and_rest_after_a_429(mock, proxy, monkeypatch):
+    upstream = mock()
+    received = received_headers(upstream)
+    monkeypatch.setattr(core, 'ZAI_BASE_URL', f"http://127.0.0.1:{upstream.port}")
+    server = proxy(zai_keys={'a': 'key-a', 'b': 'key-b'}, proxy_upstream='zai', proxy_key_pool=['a', 'b'],
+                   proxy_key_strategy='round-robin')
+    for index in range(4):
+        assert post(server.port, messages=conversation(str(index)))[0] == 200
+    keys = [dict((name.lower(), value) for name, value in headers)['authorization'] for headers in received]
+    assert sorted(keys) == ["Bearer key-a"] * 2 + ["Bearer key-b"] * 2
+    assert keys[0] != keys[1]
+
+    upstream.rate_limit = 1.0
+    # Each key's 429 is passed on and rests it for the mock's Retry-After
+    assert [post(server.port)[0] for _ in range(2)] == [429, 429]
+    status, body = post(server.port)
+    assert status == 429
+    assert b"All 2 pooled Z.ai keys are rate limited" in body
+    assert upstream.counts['requests'] == 6
+    keys = ezswitch_proxy.proxy_health(server.port)['keys']
+    assert [keys[name]['throttled'] for name in ('a', 'b')] == [1, 1]
+
+def test_find_fields_reads_top_level_values_only():
+    body = b'{"metadata": {"model": "nested"}, "model" : "claude-haiku-4-5", "messages": [{"role": "user"}, 2]}'
+    fields = ezswitch_proxy.find_fields(body, ('model',), ('messages',))
+    value, start, end = fields['model']
+    assert value == "claude-haiku-4-5"
+    assert body[start:end] == b'"claude-haiku-4-5"'
+    assert fields['messages'][0] == {'role': 'user'}
+
+def test_find_fields_handles_escaped_strings():
+    body = '{"system":"say \\"model\\": \\"no\\"","model":"glm-\\u00e9"}'.encode('utf-8')
+    fields = ezswitch_proxy.find_fields(body, ('model', 'system'))
+    assert fields['system'][0] == 'say "model": "no"'
+    assert fields['model'][0] == 'glm-\u00e9'
+
+def test_find_fields_ignores_values_past_the_prefix():
+    body = json.dumps({'messages': [{'role': 'user', 'content': 'x' * 100}], 'model': 'claude-haiku-4-5'}).encode()
+    assert ezswitch_proxy.find_fields(body[:60], ('model',)) == {}
+    # A value cut off part way is not guessed at either
+    assert ezswitch_proxy.find_fields(body[:-5], ('model',)) == {}
+    assert ezswitch_proxy.find_fields(body, ('model',))['model'][0] == 'claude-haiku-4-5'
+
+def test_routes_match_tiers_and_globs_in_order(store):
+    store.update(custom_url="https://custom.example", custom_key="custom-key", claude_key="sk-ant-test",
+                 proxy_upstream='custom',
+                 proxy_routes=[{'match': 'haiku', 'upstream': 'api', 'model': 'claude-haiku-renamed'},
+                               {'match': 'claude-sonnet-*', 'upstream': 'api'},
+                               {'match': 'claude-*', 'upstream': 'zai'},
+                               {'match': 'CLAUDE-OPUS-*', 'upstream': 'custom', 'model': 'big'}])
+    config = ezswitch_proxy.ProxyConfig(store)
+    # zai has no saved key, so its route is skipped with a warning
+    assert [route[1] for route in config.routes] == ['api', 'api', 'custom']
+    assert len(config.warnings) == 1 and config.warnings[0].startswith("Route 'claude-*' skipped: ")
+    assert config.route('claude-3-5-haiku-latest') == ('api', 'claude-haiku-renamed')
+    assert config.route('claude-sonnet-4-5') == ('api', None)
+    assert config.route('claude-opus-4-1') == ('custom', 'big')
+    assert config.route('gpt-4') == ('custom', None)
+
+def post_body(port, body, chunked=False):
+    """POST raw body bytes through the proxy, chunked if asked; returns (status, parsed response)"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=15)
+    try:
+        connection.request('POST', '/v1/messages', iter([body]) if chunked else body,
+                           {'Content-Type': 'application/json', 'Authorization': f"Bearer {TOKEN}"},
+                           encode_chunked=chunked)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+def test_haiku_route_goes_to_another_upstream_with_its_model(mock, proxy, monkeypatch):
+    custom, api = mock(), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{api.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{custom.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom',
+                   proxy_routes=[{'match': 'haiku', 'upstream': 'api', 'model': 'a-much-longer-haiku-model-name'}])
+    haiku = json.dumps({'model': 'claude-haiku-4-5', 'max_tokens': 8, 'messages': conversation("hi")}).encode()
+    status, message = post_body(server.port, haiku)
+    assert (status, message['model']) == (200, 'a-much-longer-haiku-model-name')
+    assert (custom.counts['requests'], api.counts['requests']) == (0, 1)
+    sonnet = haiku.replace(b'claude-haiku-4-5', b'claude-sonnet-4-5')
+    assert post_body(server.port, sonnet)[1]['model'] == 'claude-sonnet-4-5'
+    assert custom.counts['requests'] == 1
+
+    # Bodies whose model cannot be read up front go to the default upstream unchanged
+    status, message = post_body(server.port, haiku, chunked=True)
+    assert (status, message['model']) == (200, 'claude-haiku-4-5')
+    large = json.dumps({'messages': conversation('x' * ezswitch_proxy.ROUTE_SCAN_LIMIT), 'max_tokens': 8,
+                        'model': 'claude-haiku-4-5'}).encode()
+    assert post_body(server.port, large)[1]['model'] == 'claude-haiku-4-5'
+    assert (custom.counts['requests'], api.counts['requests']) == (3, 1)
+    assert ezswitch_proxy.proxy_health(server.port)['routed'] == {'api': 1, 'custom': 3}
+
+def test_fingerprint_ignores_moving_cache_markers_and_later_turns():
+    first = {'role': 'user', 'content': [{'type': 'text', 'text': 'hello'}]}
+    marked = {'role': 'user', 'content': [{'type': 'text', 'text': 'hello', 'cache_control': {'type': 'ephemeral'}}]}
+    fingerprint = ezswitch_proxy.conversation_fingerprint({'system': ('be brief',), 'messages': (first,)})
+    assert ezswitch_proxy.conversation_fingerprint({'system': ('be brief',), 'messages': (marked,)}) == fingerprint
+    assert ezswitch_proxy.conversation_fingerprint({'system': ('be terse',), 'messages': (first,)}) != fingerprint
+    assert ezswitch_proxy.conversation_fingerprint({'system': ('be brief',)}) is None
+
+def test_sticky_key_follows_the_fingerprint_and_skips_throttled_keys():
+    now = [0.0]
+    pool = ezswitch_proxy.KeyPool(clock=lambda: now[0])
+    upstreams = [ezswitch_proxy.Upstream(f"zai:{name}", "https://example.test", name, name) for name in ('a', 'b', 'c')]
+    chosen = {pool.acquire(upstreams, 'sticky', 'conversation').key_name for _ in range(6)}
+    assert len(chosen) == 1
+    key = chosen.pop()
+    other = next(name for name in ('a', 'b', 'c') if name != key)
+    assert pool.acquire(upstreams, 'sticky', 'conversation', prefer=other).key_name == other
+    pool.release(next(u for u in upstreams if u.key_name == key), 429, [('Retry-After', '30')])
+    assert pool.acquire(upstreams, 'sticky', 'conversation').key_name != key
+    now[0] += 30
+    assert pool.acquire(upstreams, 'sticky', 'conversation').key_name == key
+
+def test_affinity_expires_and_is_per_route():
+    now = [0.0]
+    table = ezswitch_proxy.AffinityTable(clock=lambda: now[0])
+    upstream = ezswitch_proxy.Upstream('zai:a', "https://example.test", 'key', 'a')
+    table.record('conversation', 'zai', 'zai', upstream)
+    assert table.lookup('conversation', 'zai') == ('zai', 'a')
+    assert table.lookup('conversation', 'api') is None
+    table.record('conversation', 'zai', 'zai', upstream)
+    assert table.stats()['hit_rate'] == 1.0
+    now[0] += ezswitch_proxy.AFFINITY_SECONDS
+    assert table.lookup('conversation', 'zai') is None
+
+def test_sticky_pool_keeps_each_conversation_on_one_key(mock, proxy, monkeypatch):
+    upstream = mock()
+    monkeypatch.setattr(core, 'ZAI_BASE_URL', f"http://127.0.0.1:{upstream.port}")
+    server = proxy(zai_keys={'a': 'key-a', 'b': 'key-b', 'c': 'key-c'}, proxy_upstream='zai',
+                   proxy_key_pool=['a', 'b', 'c'], proxy_key_strategy='sticky')
+    messages = conversation("hello")
+    for turn in range(3):
+        assert post(server.port, messages=messages)[0] == 200
+        messages = messages + [{'role': 'assistant', 'content': f"reply {turn}"},
+                               {'role': 'user', 'content': f"follow-up {turn}"}]
+    health = ezswitch_proxy.proxy_health(server.port)
+    assert sorted(key['requests'] for key in health['keys'].values()) == [0, 0, 3]
+    assert health['affinity']['follow_ups'] == 2
+    assert health['affinity']['hit_rate'] == 1.0
+
+def wait_for(condition, timeout=5.0):
+    """Poll condition until it holds; returns whether it did within timeout"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+def idle_connections(server):
+    return ezswitch_proxy.proxy_health(server.port)['upstream_connections']['idle']
+
+def test_slow_primary_is_hedged_and_its_connection_closed(mock, proxy, monkeypatch):
+    primary, hedge = mock(latency='1500'), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{hedge.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_hedge={'upstream': 'api', 'delay_ms': 200})
+    warm = ezswitch_proxy.PREWARM_CONNECTIONS
+    assert wait_for(lambda: idle_connections(server) == 2 * warm)
+    started = time.monotonic()
+    assert post(server.port)[0] == 200
+    assert 0.2 <= time.monotonic() - started < 1.0
+    stats = ezswitch_proxy.proxy_health(server.port)['hedging']['profiles']['custom']
+    assert (stats['hedged'], stats['hedge_wins']) == (1, 1)
+    # The primary's connection is closed rather than returned to the pool, so the mock sees it go
+    assert idle_connections(server) == 2 * warm - 1
+    assert wait_for(lambda: len(primary._client_writers) == warm - 1)
+
+def test_hedge_error_does_not_beat_a_successful_primary(mock, proxy, monkeypatch):
+    primary, hedge = mock(latency='400'), mock(errors=1.0)
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{hedge.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_hedge={'upstream': 'api', 'delay_ms': 100})
+    status, body = post(server.port, stream=False)
+    assert status == 200
+    assert json.loads(body)['type'] == 'message'
+    assert hedge.counts['errors'] == 1
+    stats = ezswitch_proxy.proxy_health(server.port)['hedging']['profiles']['custom']
+    assert (stats['hedged'], stats['hedge_wins']) == (1, 0)
+
+def test_hedge_delay_is_the_p95_once_there_are_enough_samples(store):
+    from collections import deque
+
+    store.update(custom_url="https://custom.example", custom_key="custom-key", claude_key="sk-ant-test",
+                 proxy_upstream='custom', proxy_hedge={'upstream': 'api'})
+    config = ezswitch_proxy.ProxyConfig(store)
+    server = ezswitch_proxy.ProxyServer(store.path, port=0)
+    assert server.hedge_delay(config, 'custom') == ezswitch_proxy.DEFAULT_HEDGE_DELAY
+    server.head_latency['custom'] = deque([0.01] * (ezswitch_proxy.HEDGE_MIN_SAMPLES - 1))
+    assert server.hedge_delay(config, 'custom') == ezswitch_proxy.DEFAULT_HEDGE_DELAY
+    server.head_latency['custom'] = deque(index / 100 for index in range(100, 0, -1))
+    assert server.hedge_delay(config, 'custom') == 0.96
+    store.update(proxy_hedge={'upstream': 'api', 'delay_ms': 250})
+    assert server.hedge_delay(ezswitch_proxy.ProxyConfig(store), 'custom') == 0.25
+
+def test_bodies_that_cannot_be_resent_are_not_hedged(mock, proxy, monkeypatch):
+    primary, hedge = mock(latency='300'), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{hedge.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_hedge={'upstream': 'api', 'delay_ms': 50})
+    small = json.dumps({'model': 'claude-sonnet-4-5', 'max_tokens': 8, 'messages': conversation("hi")}).encode()
+    large = json.dumps({'model': 'claude-sonnet-4-5', 'max_tokens': 8,
+                        'messages': conversation('x' * ezswitch_proxy.REPLAY_BODY_LIMIT)}).encode()
+    assert post_body(server.port, small, chunked=True)[0] == 200
+    assert post_body(server.port, large)[0] == 200
+    assert (primary.counts['requests'], hedge.counts['requests']) == (2, 0)
+
+class ClosingMock(ezswitch_mock.MockServer):
+    """Closes a keep-alive connection when a second request arrives on it, like a server timing it out just then"""
+    def __init__(self, **options):
+        super().__init__(port=0, **options)
+        self.served = set()
+        self.dropped = 0
+
+    async def _handle_request(self, head, reader, writer):
+        if writer in self.served:
+            self.dropped += 1
+            return False
+        self.served.add(writer)
+        return await super()._handle_request(head, reader, writer)
+
+def test_stale_pooled_connection_is_retried_once(proxy):
+    upstream = ClosingMock().start_in_thread()
+    try:
+        # A concurrency limit keeps small bodies whole, so they can be sent again
+        server = proxy(custom_url=f"http://127.0.0.1:{upstream.port}", custom_key="custom-key",
+                       proxy_upstream='custom', proxy_max_concurrency=8)
+        warm = ezswitch_proxy.PREWARM_CONNECTIONS
+        assert wait_for(lambda: idle_connections(server) == warm)
+        # The first request is answered on a prewarmed connection; the second, on the same one, is dropped
+        for index in range(2):
+            assert post(server.port, messages=conversation(str(index)))[0] == 200
+        connections = ezswitch_proxy.proxy_health(server.port)['upstream_connections']
+        assert upstream.dropped == connections['stale'] == 1
+        assert upstream.counts['requests'] == 2
+
+        # A body streamed from the client cannot be sent twice, so that failure is passed on
+        body = json.dumps({'model': 'claude-sonnet-4-5', 'max_tokens': 8, 'messages': conversation("x")}).encode()
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=15)
+        try:
+            connection.request('POST', '/v1/messages', iter([body]),
+                               {'Content-Type': 'application/json', 'Authorization': f"Bearer {TOKEN}"},
+                               encode_chunked=True)
+            assert connection.getresponse().status == 502
+        finally:
+            connection.close()
+        assert upstream.dropped == 2
+        assert ezswitch_proxy.proxy_health(server.port)['upstream_connections']['stale'] == 1
+    finally:
+        upstream.stop()
+
+def test_connections_are_reused_and_prewarmed_after_a_switch(mock, proxy, store, monkeypatch):
+    custom, api = mock(), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{api.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{custom.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom')
+    warm = ezswitch_proxy.PREWARM_CONNECTIONS
+    assert wait_for(lambda: idle_connections(server) == warm)
+    for _ in range(3):
+        assert post(server.port)[0] == 200
+    connections = ezswitch_proxy.proxy_health(server.port)['upstream_connections']
+    assert (connections['opened'], connections['reused']) == (warm, 3)
+
+    store.update(proxy_upstream='api')
+    store.save()
+    reply = ezswitch_proxy.proxy_prewarm(server.port, TOKEN)
+    assert reply == {'ok': True, 'opened': warm, 'upstream': 'api'}
+    # The old upstream's idle connections are closed, so only the new one's remain
+    assert idle_connections(server) == warm
+    assert wait_for(lambda: not custom._client_writers)
+    assert len(api._client_writers) == warm
+    assert ezswitch_proxy.proxy_prewarm(server.port, TOKEN)['opened'] == 0
+
+def trace_lines(path, count):
+    """The trace's entries once it has count (each is written after its response went out)"""
+    assert wait_for(lambda: path.exists() and len(path.read_text().splitlines()) >= count)
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+def test_recording_follows_config_reloads(mock, proxy, store, tmp_path):
+    upstream = mock()
+    trace = tmp_path / "traces" / "trace.jsonl"
+    server = proxy(custom_url=f"http://127.0.0.1:{upstream.port}", custom_key="custom-key", proxy_upstream='custom',
+                   proxy_record={'path': str(trace)})
+    assert post(server.port, stream=False)[0] == 200
+    [entry] = trace_lines(trace, 1)
+    assert trace.stat().st_mode & 0o777 == 0o600
+    assert entry['target'] == '/v1/messages'
+    assert (entry['model'], entry['tier'], entry['stream'], entry['max_tokens']) == \
+           ('claude-sonnet-4-5', 'sonnet', False, 16)
+    assert entry['status'] == 200 and entry['request_bytes'] > 0
+    assert 'body' not in entry
+
+    store.update(proxy_record=None)
+    store.save()
+    assert post(server.port)[0] == 200
+    # Once only the health request is active, the other one has finished (and would have been recorded)
+    assert wait_for(lambda: ezswitch_proxy.proxy_health(server.port)['active'] == 1)
+    assert len(trace_lines(trace, 1)) == 1
+
+    store.update(proxy_record={'path': str(trace), 'bodies': True})
+    store.save()
+    assert post(server.port, messages=conversation("kept"))[0] == 200
+    large = json.dumps({'model': 'claude-sonnet-4-5', 'max_tokens': 8,
+                        'messages': conversation('x' * ezswitch_proxy.REPLAY_BODY_LIMIT)}).encode()
+    assert post_body(server.port, large)[0] == 200
+    kept, too_large = trace_lines(trace, 3)[1:]
+    assert json.loads(kept['body'])['messages'] == conversation("kept")
+    assert 'body' not in too_large and too_large['request_bytes'] == len(large)
+
+def test_queue_time_does_not_count_towards_the_latency_threshold(mock, proxy, monkeypatch):
+    primary, fallback = mock(latency='600'), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{fallback.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_max_concurrency=1,
+                   proxy_failover={'upstreams': ['api'], 'latency_ms': 1000})
+    assert post_concurrently(server.port, 3) == [200, 200, 200]
+    assert primary.counts['requests'] == 3
+    assert fallback.counts['requests'] == 0
+    health = ezswitch_proxy.proxy_health(server.port)
+    assert health['scheduler']['custom']['active'] == 0
+    assert health['scheduler']['custom']['waiting'] == 0
+    assert health['failover']['breakers']['custom']['state'] == 'closed'
+
+def test_queue_time_does_not_trigger_hedging(mock, proxy, monkeypatch):
+    primary, hedge = mock(latency='300'), mock()
+    monkeypatch.setattr(core, 'ANTHROPIC_BASE_URL', f"http://127.0.0.1:{hedge.port}")
+    server = proxy(custom_url=f"http://127.0.0.1:{primary.port}", custom_key="custom-key", claude_key="sk-ant-test",
+                   proxy_upstream='custom', proxy_max_concurrency=1,
+                   proxy_hedge={'upstream': 'api', 'delay_ms': 500})
+    assert post_concurrently(server.port, 3) == [200, 200, 200]
+    assert hedge.counts['requests'] == 0
+    assert ezswitch_proxy.proxy_health(server.port)['hedging']['profiles']['custom']['hedged'] == 0
+
+def test_concurrency_limit_below_worker_count_is_rejected(mock, store):
+    upstream = mock()
+    store.update(custom_url=f"http://127.0.0.1:{upstream.port}", custom_key="custom-key", proxy_upstream='custom',
+                 proxy_token=TOKEN, proxy_max_concurrency=1)
+    store.save()
+    server = ezswitch_proxy.ProxyServer(store.path, port=0, workers=2).start_in_thread()
+    try:
+        port = server._server.sockets[0].getsockname()[1]
+        status, body = post(port)
+        assert status == 503
+        assert b"below the proxy's 2 worker processes" in body
+        assert upstream.counts['requests'] == 0
+    finally:
+        server.stop()
@@ -0,0 +1,160 @@
+"""ezswitch_usage: incremental reads, truncation, attribution and resumable backfill"""
+import json
+import os
+import signal
+from datetime import datetime, timezone
+
+import pytest
+
+import ezswitch_usage as usage
+
+T0 = 1750000000.0
+
+def stamp(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def user_line(t):
+    return json.dumps({'type': 'user', 'timestamp': stamp(t), 'message': {'role': 'user', 'content': 'hi'}},
+                      separators=(',', ':'))
+
+def assistant_line(t, message_id, output_tokens=10, model='glm-4.6'):
+    counts = {'input_tokens': 100, 'output_tokens': output_tokens, 'cache_creation_input_tokens': 0,
+              'cache_read_input_tokens': 50}
+    return json.dumps({'type': 'assistant', 'timestamp': stamp(t),
+                       'message': {'id': message_id, 'model': model, 'usage': counts}}, separators=(',', ':'))
+
+def exchange(t, message_id, output_tokens=10):
+    """A prompt answered two seconds later, written as two content-block lines of one response"""
+    return [user_line(t), assistant_line(t + 2, message_id, output_tokens),
+            assistant_line(t + 2, message_id, output_tokens)]
+
+def write(path, lines, mode='w', newline=True):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, mode) as f:
+        f.write('\n'.join(lines) + ('\n' if newline else ''))
+
+def responses(index):
+    """Responses and output tokens per profile"""
+    return {label: (report['total']['responses'], report['total']['output_tokens'])
+            for label, report in index.report().items()}
+
+@pytest.fixture
+def projects(tmp_path):
+    return tmp_path / "projects"
+
+def test_refresh_reads_only_appended_complete_lines(projects, tmp_path, monkeypatch):
+    # A tiny block size makes lines span several reads
+    monkeypatch.setattr(usage, 'READ_BLOCK', 7)
+    transcript = projects / "app" / "session.jsonl"
+    write(transcript, exchange(T0, 'msg_1'))
+    index = usage.UsageIndex(tmp_path / "index.json")
+    assert index.refresh(projects)['bytes'] == transcript.stat().st_size
+    assert responses(index) == {'unknown': (1, 10)}
+
+    # The last line is still being written
+    write(transcript, [user_line(T0 + 60), assistant_line(T0 + 62, 'msg_2', 20)], mode='a', newline=False)
+    index.refresh(projects)
+    assert responses(index) == {'unknown': (1, 10)}
+    write(transcript, [''], mode='a')
+    stats = index.refresh(projects)
+    assert responses(index) == {'unknown': (2, 30)}
+    assert index.refresh(projects)['bytes'] == 0
+    assert stats['updated'] == 1
+
+def test_duplicate_content_blocks_count_once_across_refreshes(projects, tmp_path):
+    transcript = projects / "app" / "session.jsonl"
+    write(transcript, [user_line(T0), assistant_line(T0 + 2, 'msg_1')])
+    index = usage.UsageIndex(tmp_path / "index.json")
+    index.refresh(projects)
+    write(transcript, [assistant_line(T0 + 2, 'msg_1')], mode='a')
+    index.refresh(projects)
+    assert responses(index) == {'unknown': (1, 10)}
+
+def test_truncated_or_replaced_transcript_is_read_again(projects, tmp_path):
+    transcript = projects / "app" / "session.jsonl"
+    write(transcript, exchange(T0, 'msg_1') + exchange(T0 + 60, 'msg_2'))
+    index = usage.UsageIndex(tmp_path / "index.json")
+    index.refresh(projects)
+    write(transcript, exchange(T0 + 120, 'msg_3'))
+    index.refresh(projects)
+    assert responses(index) == {'unknown': (3, 30)}
+    assert index.files[str(transcript)]['offset'] == transcript.stat().st_size
+
+    replacement = projects / "app" / "replacement.jsonl"
+    write(replacement, exchange(T0 + 180, 'msg_4') + exchange(T0 + 240, 'msg_5') + exchange(T0 + 300, 'msg_6'))
+    os.replace(replacement, transcript)
+    index.refresh(projects)
+    assert responses(index) == {'unknown': (6, 60)}
+
+def test_deleted_transcripts_are_forgotten_but_their_usage_kept(projects, tmp_path):
+    transcript = projects / "app" / "session.jsonl"
+    write(transcript, exchange(T0, 'msg_1'))
+    index = usage.UsageIndex(tmp_path / "index.json")
+    index.refresh(projects)
+    transcript.unlink()
+    assert index.refresh(projects)['files'] == 0
+    assert responses(index) == {'unknown': (1, 10)}
+
+def test_responses_are_attributed_to_the_profile_active_then(projects, tmp_path):
+    write(projects / "app" / "session.jsonl", exchange(T0, 'msg_1') + exchange(T0 + 100, 'msg_2', 20)
+          + exchange(T0 + 200, 'msg_3', 40))
+    index = usage.UsageIndex(tmp_path / "index.json")
+    index.refresh(projects, history=[(T0 + 50, 'zai'), (T0 + 150, 'api')])
+    assert responses(index) == {'unknown': (1, 10), 'zai': (1, 20), 'api': (1, 40)}
+    assert index.report()['zai']['total']['response_p50_ms'] == pytest.approx(2000, rel=0.2)
+
+def test_saved_index_resumes_where_it_left_off(projects, tmp_path):
+    transcript = projects / "app" / "session.jsonl"
+    write(transcript, exchange(T0, 'msg_1'))
+    index = usage.UsageIndex(tmp_path / "index.json")
+    index.refresh(projects)
+    index.save()
+    write(transcript, exchange(T0 + 60, 'msg_2', 20), mode='a')
+    resumed = usage.UsageIndex(tmp_path / "index.json").load()
+    assert resumed.refresh(projects)['bytes'] == len('\n'.join(exchange(T0 + 60, 'msg_2', 20))) + 1
+    assert responses(resumed) == {'unknown': (2, 30)}
+
+def write_history(projects, sessions=6, exchanges=20):
+    for session in range(sessions):
+        lines = []
+        for turn in range(exchanges):
+            lines += exchange(T0 + session * 10000 + turn * 60, f"msg_{session}_{turn}", session + 1)
+        write(projects / f"project-{session % 2}" / f"session-{session}.jsonl", lines)
+    # A response still being written
+    write(projects / "project-0" / "session-0.jsonl", [user_line(T0 + 90000)], mode='a', newline=False)
+
+def test_backfill_matches_a_sequential_refresh(projects, tmp_path, monkeypatch):
+    write_history(projects)
+    history = [(T0 + 25000, 'zai')]
+    sequential = usage.UsageIndex(tmp_path / "sequential.json")
+    sequential.refresh(projects, history)
+    monkeypatch.setattr(usage, 'BACKFILL_BYTES', 0)
+    monkeypatch.setattr(usage, 'READ_BLOCK', 1)
+    parallel = usage.UsageIndex(tmp_path / "parallel.json")
+    stats = parallel.refresh(projects, history, jobs=2)
+    assert stats['jobs'] == 2
+    assert parallel.usage == sequential.usage
+    assert parallel.files == sequential.files
+
+def test_interrupted_backfill_resumes_without_double_counting(projects, tmp_path, monkeypatch):
+    write_history(projects)
+    expected = usage.UsageIndex(tmp_path / "expected.json")
+    expected.refresh(projects)
+    monkeypatch.setattr(usage, 'BACKFILL_BYTES', 0)
+    monkeypatch.setattr(usage, 'READ_BLOCK', 1)
+    merge_usage = usage.merge_usage
+
+    def interrupt_after_first_shard(into, other):
+        merge_usage(into, other)
+        os.kill(os.getpid(), signal.SIGINT)
+    monkeypatch.setattr(usage, 'merge_usage', interrupt_after_first_shard)
+    index = usage.UsageIndex(tmp_path / "index.json")
+    with pytest.raises(KeyboardInterrupt):
+        index.refresh(projects, jobs=2)
+    monkeypatch.setattr(usage, 'merge_usage', merge_usage)
+
+    resumed = usage.UsageIndex(tmp_path / "index.json").load()
+    assert 0 < sum(state['offset'] for state in resumed.files.values()) < sum(
+        state['offset'] for state in expected.files.values())
+    resumed.refresh(projects)
+    assert resumed.usage == expected.usage